@@ -0,0 +1,92 @@
+"""Import-time benchmark of the relod modules.
+
+Every measurement runs in a fresh interpreter, since a module is only imported once per process:
+
+    python benchmark_imports.py --repeat 5 --out imports.json
+
+Reported per module: median seconds to import it, the optional heavy dependencies it pulled in
+(they should only load on first use), and the median time for a 'spawn' child process, as started by
+the async learners, to be up with the module imported.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+import multiprocessing as mp
+import numpy as np
+
+MODULES = [
+    'relod.algo.sac_rad_agent',
+    'relod.algo.sac_drq_agent',
+    'relod.algo.sac_svea_agent',
+    'relod.algo.sac_madi_agent',
+    'relod.algo.sac_sgqn_agent',
+    'relod.algo.sac_soda_agent',
+    'relod.algo.ppo_rad_agent',
+    'relod.algo.local_wrapper',
+    'relod.algo.remote_wrapper',
+    'relod.logger',
+    'relod.video_rec',
+]
+
+# imported on first use only: overlay augment, DrQ, plotting, wandb, recorders
+HEAVY = ['wandb', 'kornia', 'matplotlib', 'torchvision', 'cv2', 'imageio', 'captum']
+
+MEASURE = """
+import sys, time, json
+tic = time.perf_counter()
+import {module}
+print(json.dumps({{'seconds': time.perf_counter() - tic, 'heavy': [m for m in {heavy} if m in sys.modules]}}))
+"""
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modules', default=','.join(MODULES), type=str)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--out', default='imports.json', type=str)
+    args = parser.parse_args()
+    return args
+
+def measure_import(module):
+    out = subprocess.run([sys.executable, '-c', MEASURE.format(module=module, heavy=HEAVY)],
+                         stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def _child(module, queue):
+    __import__(module)
+    queue.put(time.time())
+
+def measure_spawn(module):
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    tic = time.time()
+    child = ctx.Process(target=_child, args=(module, queue))
+    child.start()
+    seconds = queue.get() - tic
+    child.join()
+    return seconds
+
+def main():
+    args = parse_args()
+
+    results = []
+    for module in args.modules.split(','):
+        imports = [measure_import(module) for _ in range(args.repeat)]
+        spawns = [measure_spawn(module) for _ in range(args.repeat)]
+        result = {
+            'module': module,
+            'import_s': float(np.median([i['seconds'] for i in imports])),
+            'spawn_s': float(np.median(spawns)),
+            'heavy': imports[-1]['heavy'],
+        }
+        print('{:32s} import {:.3f}s  spawn {:.3f}s  heavy: {}'.format(
+            module, result['import_s'], result['spawn_s'], ', '.join(result['heavy']) or '-'))
+        results.append(result)
+
+    with open(args.out, 'w') as f:
+        json.dump({'python': sys.version, 'repeat': args.repeat, 'results': results}, f, indent=2)
+    print(f'Results written to {args.out}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+"""Hardware-free benchmark of the local-remote pipeline.
+
+Runs DummyEnv through LocalWrapper (and, for the remote modes, a RemoteWrapper in a separate process
+over loopback) in each requested mode and writes the measurements to a JSON file:
+
+    python benchmark_pipeline.py --algorithm rad --modes l,rl,r,e --env_steps 2000 --out bench.json
+
+Reported per mode: env steps/s, updates/s, policy-sync latency (remote send to local apply), sample
+lag (local push to remote receive), policy lag (policy versions between the one acting and the latest
+one sent), transport counters of the local wrapper and peak memory.
+"""
+import argparse
+import json
+import resource
+import time
+import multiprocessing as mp
+import numpy as np
+import torch
+import relod.utils as utils
+from relod.algo.comm import MODE
+from relod.algo.local_wrapper import LocalWrapper
+from relod.algo.remote_wrapper import RemoteWrapper
+from relod.algo.sac_rad_agent import SACRADLearner, SACRADPerformer
+from relod.algo.sac_madi_agent import MaDiLearner, MaDiPerformer
+from relod.algo.ppo_rad_agent import PPORADLearner, PPORADPerformer
+from relod.envs.dummy_env import DummyEnv
+
+config = {
+    'conv': [
+        # in_channel, out_channel, kernel_size, stride
+        [-1, 32, 3, 2],
+        [32, 32, 3, 2],
+        [32, 32, 3, 2],
+        [32, 32, 3, 1],
+    ],
+
+    'latent': 50,
+
+    'mlp': [
+        [-1, 1024],
+        [1024, 1024],
+        [1024, -1]
+    ],
+}
+
+ALGORITHMS = {
+    'rad': (SACRADPerformer, SACRADLearner),
+    'madi': (MaDiPerformer, MaDiLearner),
+    'ppo': (PPORADPerformer, PPORADLearner),
+}
+
+MODES = {
+    'l': MODE.LOCAL_ONLY,
+    'r': MODE.REMOTE_ONLY,
+    'rl': MODE.REMOTE_LOCAL,
+    'e': MODE.EVALUATION,
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    # benchmark
+    parser.add_argument('--algorithm', default='rad', type=str, help="Algorithms in ['rad', 'madi', 'ppo']")
+    parser.add_argument('--modes', default='l,rl,r,e', type=str, help="Comma separated modes in ['l', 'rl', 'r', 'e']")
+    parser.add_argument('--out', default='benchmark.json', type=str)
+    # environment
+    parser.add_argument('--image_height', default=90, type=int)
+    parser.add_argument('--image_width', default=160, type=int)
+    parser.add_argument('--stack_frames', default=3, type=int)
+    parser.add_argument('--proprioception_dim', default=11, type=int)
+    parser.add_argument('--dt', default=0.04, type=float, help="Step period, 0 steps as fast as possible")
+    parser.add_argument('--episode_length_time', default=4.0, type=float)
+    parser.add_argument('--env_steps', default=2000, type=int)
+    # learner
+    parser.add_argument('--init_steps', default=200, type=int)
+    parser.add_argument('--batch_size', default=128, type=int)
+    parser.add_argument('--replay_buffer_capacity', default=10000, type=int)
+    parser.add_argument('--async_mode', default=False, action='store_true')
+    parser.add_argument('--update_every', default=2, type=int)
+    parser.add_argument('--update_epochs', default=1, type=int)
+    # agent
+    parser.add_argument('--port', default=9876, type=int)
+    parser.add_argument('--uplink_codec', default='raw', type=str, help="Codec of the image frames sent to the remote in ['raw', 'png', 'jpeg', 'lz4']")
+    parser.add_argument('--jpeg_quality', default=90, type=int)
+    parser.add_argument('--uplink_batch', default=1, type=int, help="Transitions sent per message in remote-local mode")
+    parser.add_argument('--spill_dir', default='', type=str, help="Directory of the uplink spill file, '' for the system temp directory")
+    parser.add_argument('--spill_max_mb', default=1024, type=float, help="Samples spilled to disk while the uplink stalls, 0 blocks instead")
+    parser.add_argument('--reconnect_timeout', default=300, type=float, help="Seconds to try reconnecting to the remote after the connection drops")
+    parser.add_argument('--connect_timeout', default=60, type=float)
+    # misc
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--device', default='', type=str)
+    args = parser.parse_args()
+    return args
+
+def make_args(args):
+    """Fills in the learner hyper-parameters the task scripts would set."""
+    defaults = {
+        'rad_offset': 0.01, 'max_updates_per_step': 1, 'load_model': -1, 'model_dir': '',
+        'critic_lr': 1e-3, 'critic_tau': 0.01, 'critic_target_update_freq': 1, 'bootstrap_terminal': 0,
+        'actor_lr': 1e-3, 'actor_update_freq': 1, 'encoder_tau': 0.05, 'discount': 0.99,
+        'init_temperature': 0.1, 'alpha_lr': 1e-4, 'amp': 'none',
+        # madi
+        'masker_lr': 3e-4, 'strong_augment': 'none', 'anneal_masker_lr': 'none', 'when_augm': 'before',
+        'save_mask': False,
+        # ppo
+        'freeze_cnn': 0, 'opt_batch_size': 64, 'n_epochs': 1, 'gamma': 0.99, 'lmbda': 0.97,
+        'clip_epsilon': 0.2, 'l2_reg': 1e-4,
+    }
+    for key, value in defaults.items():
+        if not hasattr(args, key):
+            setattr(args, key, value)
+
+    if args.device == '':
+        args.device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    args.image_shape = (3*args.stack_frames, args.image_height, args.image_width)
+    args.proprioception_shape = (args.proprioception_dim,)
+    args.action_shape = (2,)
+    args.net_params = config
+    return args
+
+def summarize(seconds):
+    if len(seconds) == 0:
+        return None
+    ms = np.asarray(seconds) * 1e3
+    return {
+        'count': len(ms),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max()),
+    }
+
+def memory_stats(device):
+    stats = {
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'children_max_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+    if torch.device(device).type == 'cuda':
+        stats['cuda_max_allocated_mb'] = torch.cuda.max_memory_allocated(device) / 2**20
+    return stats
+
+def make_env(args):
+    env = DummyEnv(args.image_shape, args.proprioception_shape)
+    env.image_space.seed(args.seed)
+    env.proprioception_space.seed(args.seed)
+    env.action_space.seed(args.seed)
+    return env
+
+def to_ppo_ob(image, propri):
+    return (torch.as_tensor(image.astype(np.float32))[None], torch.as_tensor(propri.astype(np.float32))[None])
+
+def run_local(args, mode):
+    utils.set_seed_everywhere(args.seed)
+    env = make_env(args)
+    episode_length_step = int(args.episode_length_time / args.dt) if args.dt > 0 else 100
+    is_ppo = args.algorithm == 'ppo'
+    performer_class, learner_class = ALGORITHMS[args.algorithm]
+
+    agent = LocalWrapper(episode_length_step, mode, port=args.port, connect_timeout=args.connect_timeout,
+                         uplink_codec=args.uplink_codec, jpeg_quality=args.jpeg_quality, uplink_batch=args.uplink_batch,
+                         spill_dir=args.spill_dir, spill_max_mb=args.spill_max_mb,
+                         reconnect_timeout=args.reconnect_timeout)
+    agent.send_data(args)
+    agent.init_performer(performer_class, args)
+    if mode != MODE.EVALUATION:
+        agent.init_learner(learner_class, args, agent.performer)
+    agent.apply_remote_policy(block=True)
+
+    image, propri = env.reset()
+    ob = to_ppo_ob(image, propri) if is_ppo else (image, propri)
+    agent.send_init_ob(ob)
+    num_updates = 0
+    epi_steps = 0
+    start_time = time.time()
+    for step in range(args.env_steps):
+        tic = time.time()
+        if is_ppo:
+            action, lprob = agent.sample_action(ob)
+            next_image, next_propri, reward, _, _ = env.step(action.cpu().numpy())
+            next_ob = to_ppo_ob(next_image, next_propri)
+        else:
+            action = agent.sample_action(ob)
+            next_image, next_propri, reward, _, _ = env.step(action)
+            next_ob = (next_image, next_propri)
+        epi_steps += 1
+        # DummyEnv never terminates, episodes end at the time out
+        epi_done = epi_steps >= episode_length_step and step + 1 < args.env_steps
+
+        kwargs = {'sent_at': time.time()} if mode in [MODE.REMOTE_ONLY, MODE.REMOTE_LOCAL] else {}
+        if is_ppo:
+            agent.push_sample(ob, action, reward, next_ob, epi_done, lprob, **kwargs)
+        else:
+            agent.push_sample(ob, action, reward, next_ob, 0, **kwargs)
+
+        if is_ppo:
+            if epi_done and mode == MODE.LOCAL_ONLY and agent.update_policy(epi_done, *next_ob):
+                num_updates += 1
+            if epi_done and mode == MODE.REMOTE_LOCAL and agent.recv_cmd() == 'new policy':
+                agent.apply_remote_policy(block=True)
+        elif mode != MODE.EVALUATION:
+            stat = agent.update_policy(step)
+            if stat is not None:
+                num_updates = stat['train/num_updates'] + 1
+
+        ob = next_ob
+        if epi_done:
+            epi_steps = 0
+            image, propri = env.reset()
+            ob = to_ppo_ob(image, propri) if is_ppo else (image, propri)
+            agent.send_init_ob(ob)
+
+        if args.dt > 0:
+            time.sleep(max(0, tic + args.dt - time.time()))
+    duration = time.time() - start_time
+
+    result = {
+        'env_steps_per_s': args.env_steps / duration,
+        'duration_s': duration,
+        'policy_sync_latency': summarize(agent.policy_delays) if mode == MODE.REMOTE_LOCAL else None,
+        'transport': agent.stats(),
+        'memory': memory_stats(args.device),
+    }
+    if mode == MODE.LOCAL_ONLY:
+        result['updates_per_s'] = num_updates / duration
+
+    agent.close()
+    env.close()
+    return result
+
+def run_remote(port, result_queue):
+    agent = RemoteWrapper(port=port)
+    args = agent.recv_data()
+    utils.set_seed_everywhere(args.seed)
+    episode_length_step = int(args.episode_length_time / args.dt) if args.dt > 0 else 100
+    is_ppo = args.algorithm == 'ppo'
+    performer_class, learner_class = ALGORITHMS[args.algorithm]
+
+    agent.init_performer(performer_class, args)
+    agent.init_learner(learner_class, args, agent.performer)
+    agent.send_policy()
+
+    lags = []
+    num_updates = 0
+    epi_steps = 0
+    ob = agent.receive_init_ob()
+    start_time = time.time()
+    for step in range(args.env_steps):
+        if is_ppo:
+            action, lprob = agent.sample_action(ob)
+            (reward, next_ob, epi_done, lprob, kwargs) = agent.receive_sample_from_onboard()
+        else:
+            action = agent.sample_action(ob)
+            (reward, next_ob, epi_done, kwargs) = agent.receive_sample_from_onboard()
+        lags.append(time.time() - kwargs['sent_at'])
+        epi_steps += 1
+
+        if is_ppo:
+            agent.push_sample(ob, action, reward, next_ob, epi_done, lprob)
+            if epi_done:
+                stat = agent.update_policy(epi_done, *next_ob)
+                num_updates += int(bool(stat))
+                if agent.mode == MODE.REMOTE_LOCAL:
+                    if stat:
+                        agent.send_cmd('new policy')
+                        agent.send_policy()
+                    else:
+                        agent.send_cmd('no policy')
+        else:
+            agent.push_sample(ob, action, reward, next_ob, epi_done)
+            stat = agent.update_policy(step)
+            if stat is not None:
+                num_updates = stat['train/num_updates'] + 1
+            if step + 1 > args.init_steps and (step + 1) % args.update_every == 0:
+                agent.send_policy()
+
+        ob = next_ob
+        if epi_steps >= episode_length_step and step + 1 < args.env_steps:
+            epi_steps = 0
+            if is_ppo:
+                ob = agent.receive_init_ob()
+            else:
+                agent.learner.begin_reset()
+                ob = agent.receive_init_ob()
+                agent.learner.end_reset()
+    duration = time.time() - start_time
+
+    result_queue.put({
+        'updates_per_s': num_updates / duration,
+        'sample_lag': summarize(lags),
+        'policy_lag_versions': agent.policy_lag(),
+        'memory': memory_stats(args.device),
+    })
+    agent.close()
+
+def main():
+    args = make_args(parse_args())
+    ctx = mp.get_context('spawn')
+
+    results = []
+    base_port = args.port
+    for i, mode_key in enumerate(args.modes.split(',')):
+        mode = MODES[mode_key]
+        print(f'Benchmarking {args.algorithm} in mode: {mode}')
+        args.port = base_port + 2*i # fresh ports, the previous ones may still be in TIME_WAIT
+        remote = None
+        if mode in [MODE.REMOTE_ONLY, MODE.REMOTE_LOCAL]:
+            result_queue = ctx.Queue()
+            remote = ctx.Process(target=run_remote, args=(args.port, result_queue))
+            remote.start()
+
+        result = {'mode': mode, 'local': run_local(args, mode)}
+        if remote is not None:
+            result['remote'] = result_queue.get()
+            remote.join()
+        results.append(result)
+
+    args.device = str(args.device)
+    with open(args.out, 'w') as f:
+        json.dump({
+            'config': {k: v for k, v in vars(args).items() if isinstance(v, (int, float, str, bool, tuple))},
+            'results': results,
+        }, f, indent=2)
+    print(f'Results written to {args.out}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""CPU placement of the robot-side processes.
+
+The camera and robot communicators, the control loop (env steps and the performer), the transport
+thread, the replay buffer process and the update process used to share every core, with torch
+spreading its intra-op threads over all of them: the learner could starve the sensor readers and
+the control loop. A placement gives each role its own core set and thread budget:
+
+    sensor=0;control=1;transport=1;buffer=2;update=3-5@3
+
+assigns cores (a taskset list such as 0,2-3) and optionally, after @, the OMP/MKL/torch thread count
+of each role. 'auto' splits the cores available to the process: the sensors, the control loop and
+the buffer get one each, the update process the rest. Roles left out are not placed, and '' places
+nothing.
+
+Each process places itself when it starts with apply(). Processes it does not run the code of, the
+senseact communicators, are placed from the parent with apply_children(). The thread budget of a
+spawned child is also exported in the environment while it starts, see spawn_env(). report() prints
+the context switches and run-queue waits of the processes placed from this one.
+"""
+import contextlib
+import multiprocessing as mp
+import os
+import sys
+import threading
+
+ROLES = ('sensor', 'control', 'transport', 'buffer', 'update')
+THREAD_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+AUTO_VAR = 'RELOD_AUTO_PLACEMENT'
+
+# (role, pid) of the processes placed from this one, for report()
+_placed = []
+
+
+def _parse_cores(text):
+    cores = set()
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cores.update(range(int(first), int(last) + 1))
+        else:
+            cores.add(int(part))
+    return cores
+
+
+def _format(plan):
+    entries = []
+    for role, (cores, threads) in plan.items():
+        entry = '{}={}'.format(role, ','.join(str(c) for c in sorted(cores)))
+        entries.append(entry + ('@{}'.format(threads) if threads else ''))
+    return ';'.join(entries)
+
+
+def _auto_plan():
+    # computed once, before the control loop is pinned: the child processes inherit it
+    spec = os.environ.get(AUTO_VAR)
+    if spec is not None:
+        return parse(spec)
+
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < 4:
+        print('Only {} cores available, not enough to place the processes'.format(len(cores)))
+        plan = {}
+    else:
+        rest = set(cores[3:])
+        plan = {
+            'sensor': ({cores[0]}, 1),
+            'control': ({cores[1]}, 1),
+            'transport': ({cores[1]}, None),
+            'buffer': ({cores[2]}, 1),
+            'update': (rest, len(rest)),
+        }
+        print('Placement: {}'.format(_format(plan)))
+    os.environ[AUTO_VAR] = _format(plan)
+    return plan
+
+
+def parse(spec):
+    """Returns {role: (cores or None, threads or None)}."""
+    if not spec:
+        return {}
+    if spec == 'auto':
+        return _auto_plan()
+
+    plan = {}
+    for entry in spec.split(';'):
+        role, _, value = entry.strip().partition('=')
+        assert role in ROLES, 'unknown role {} in placement {}, roles are {}'.format(role, spec, ROLES)
+        cores, _, threads = value.partition('@')
+        plan[role] = (_parse_cores(cores) if cores else None, int(threads) if threads else None)
+    return plan
+
+
+def _tasks(pid):
+    try:
+        return [int(tid) for tid in os.listdir('/proc/{}/task'.format(pid))]
+    except OSError:
+        return [pid]
+
+
+def _pin(pid, cores):
+    """Pins every thread of pid, threads started later inherit it."""
+    for tid in _tasks(pid):
+        try:
+            os.sched_setaffinity(tid, cores)
+        except OSError:  # the thread exited
+            pass
+
+
+def set_threads(threads):
+    for name in THREAD_VARS:
+        os.environ[name] = str(threads)
+    # the pools already created are resized by the libraries themselves
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(threads)
+    if 'cv2' in sys.modules:
+        sys.modules['cv2'].setNumThreads(threads)
+
+
+def apply(spec, role):
+    """Places the calling process, or only the calling thread when it is not the main thread."""
+    plan = parse(spec)
+    if role not in plan:
+        return
+    cores, threads = plan[role]
+
+    if threading.current_thread() is not threading.main_thread():
+        if cores:
+            os.sched_setaffinity(0, cores)
+        return
+
+    pid = os.getpid()
+    if cores:
+        _pin(pid, cores)
+    if threads:
+        set_threads(threads)
+    _placed.append((role, pid))
+
+
+def register(role, pid):
+    """Reports a child process that placed itself."""
+    _placed.append((role, pid))
+
+
+def apply_children(spec, role):
+    """Places the live child processes not placed yet, e.g. the communicators of a senseact env
+    right after env.start()."""
+    plan = parse(spec)
+    if role not in plan:
+        return
+    cores, _ = plan[role]
+    placed = set(pid for _, pid in _placed)
+    for child in mp.active_children():
+        if child.pid in placed:
+            continue
+        if cores:
+            _pin(child.pid, cores)
+        _placed.append((role, child.pid))
+
+
+@contextlib.contextmanager
+def spawn_env(spec, role):
+    """Exports the thread budget of role while a spawned child starts, so its OpenMP and BLAS pools
+    are created at that size."""
+    _, threads = parse(spec).get(role, (None, None))
+    saved = {name: os.environ.get(name) for name in THREAD_VARS}
+    if threads:
+        for name in THREAD_VARS:
+            os.environ[name] = str(threads)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def stats(pid):
+    """Scheduling counters of pid summed over its threads, or None once it exited."""
+    result = {'threads': 0, 'voluntary': 0, 'involuntary': 0, 'run_s': 0.0, 'wait_s': 0.0, 'slices': 0}
+    try:
+        result['cores'] = sorted(os.sched_getaffinity(pid))
+    except OSError:
+        return None
+    for tid in _tasks(pid):
+        try:
+            with open('/proc/{}/task/{}/status'.format(pid, tid)) as f:
+                for line in f:
+                    if line.startswith('voluntary_ctxt_switches'):
+                        result['voluntary'] += int(line.split()[1])
+                    elif line.startswith('nonvoluntary_ctxt_switches'):
+                        result['involuntary'] += int(line.split()[1])
+            # time on the cpu, time waiting on a run queue (ns), number of slices
+            with open('/proc/{}/task/{}/schedstat'.format(pid, tid)) as f:
+                run, wait, slices = f.read().split()
+        except (OSError, ValueError):
+            continue
+        result['threads'] += 1
+        result['run_s'] += int(run) / 1e9
+        result['wait_s'] += int(wait) / 1e9
+        result['slices'] += int(slices)
+    return result
+
+
+def report():
+    """Prints the scheduling counters of the processes placed from this one. Call it before
+    stopping them."""
+    if not _placed:
+        return []
+    try:
+        with open('/proc/loadavg') as f:
+            running = f.read().split()[3]
+    except OSError:
+        running = '?'
+    print('Placement (runnable/total tasks {}):'.format(running))
+    print('  {:10s} {:>7s} {:12s} {:>7s} {:>10s} {:>12s} {:>9s} {:>9s} {:>14s}'.format(
+        'role', 'pid', 'cores', 'threads', 'voluntary', 'involuntary', 'run s', 'wait s', 'wait/slice ms'))
+    results = []
+    for role, pid in _placed:
+        result = stats(pid)
+        if result is None:
+            continue
+        cores = ','.join(str(c) for c in result['cores'])
+        print('  {:10s} {:7d} {:12s} {:7d} {:10d} {:12d} {:9.1f} {:9.1f} {:14.3f}'.format(
+            role, pid, cores[:12], result['threads'], result['voluntary'], result['involuntary'], result['run_s'],
+            result['wait_s'], 1e3 * result['wait_s'] / max(result['slices'], 1)))
+        results.append(dict(result, role=role, pid=pid))
+    return results
@@ -0,0 +1,193 @@
+"""Full learner checkpoints.
+
+A checkpoint is the directory <model_dir>/checkpoint_<step>/ with
+    learner.pt  networks, optimizers, schedulers, log-alpha, update count and RNG states
+    buffer.pkl  manifest of the replay buffer snapshot (see RadReplayBuffer.snapshot)
+The replay buffer rows live in <model_dir>/buffer/ as chunk files shared by the checkpoints, so each
+checkpoint only writes the rows added since the previous one. Files are written under a temporary
+name and renamed into place, and <model_dir>/latest names the newest complete checkpoint: a crash
+while writing leaves the previous checkpoint intact. Chunks no longer referenced by the newest
+checkpoint are deleted, so only its buffer snapshot is guaranteed complete.
+"""
+import os
+import pickle
+import queue
+import random
+import shutil
+import threading
+import time
+import numpy as np
+import torch
+
+LATEST = 'latest'
+BUFFER_DIR = 'buffer'
+
+
+def checkpoint_dir(model_dir, step):
+    return os.path.join(model_dir, 'checkpoint_{}'.format(step))
+
+
+def buffer_dir(model_dir):
+    return os.path.join(model_dir, BUFFER_DIR)
+
+
+def latest(model_dir):
+    """Step of the newest complete checkpoint in model_dir, or None."""
+    try:
+        with open(os.path.join(model_dir, LATEST)) as f:
+            return int(f.read().strip().rsplit('_', 1)[-1])
+    except (OSError, ValueError):
+        return None
+
+
+def rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _to_cpu(value):
+    if isinstance(value, torch.Tensor):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {k: _to_cpu(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_cpu(v) for v in value)
+    return value
+
+
+def capture(objects, num_updates, step):
+    """Copies the learner state to the CPU. objects maps names to tensors or to anything with a
+    state_dict (modules, optimizers, schedulers, grad scalers); None entries are skipped.
+    Cheap next to writing it, so it runs between two updates and the write goes to the background.
+    """
+    state = {}
+    for name, obj in objects.items():
+        if obj is None:
+            continue
+        state[name] = _to_cpu(obj if isinstance(obj, torch.Tensor) else obj.state_dict())
+
+    return {'objects': state, 'num_updates': num_updates, 'step': step, 'rng': rng_state()}
+
+
+def restore(objects, checkpoint):
+    """Loads a captured state in place, keeping shared memory tensors shared."""
+    state = checkpoint['objects']
+    for name, obj in objects.items():
+        if obj is None:
+            continue
+        if name not in state:
+            print('Checkpoint has no {}, keeping it as initialized'.format(name))
+            continue
+
+        if isinstance(obj, torch.Tensor):
+            with torch.no_grad():
+                obj.copy_(state[name])
+        elif state[name]:  # e.g. a disabled grad scaler saves nothing
+            obj.load_state_dict(state[name])
+
+
+def save(model_dir, step, learner_state, buffer_manifest=None):
+    path = checkpoint_dir(model_dir, step)
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    with open(os.path.join(tmp, 'learner.pt'), 'wb') as f:
+        torch.save(learner_state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    with open(os.path.join(tmp, 'buffer.pkl'), 'wb') as f:
+        pickle.dump(buffer_manifest, f, protocol=4)
+        f.flush()
+        os.fsync(f.fileno())
+
+    # saved twice at the same step: the old checkpoint is moved aside, and deleted once replaced
+    old = path + '.old'
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.isdir(path):
+        os.rename(path, old)
+    os.rename(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+    _write_atomic(os.path.join(model_dir, LATEST), os.path.basename(path))
+
+    if buffer_manifest is not None:
+        for name in buffer_manifest['obsolete']:
+            try:
+                os.remove(os.path.join(buffer_dir(model_dir), name))
+            except OSError:
+                pass
+
+
+def load(model_dir, step):
+    """Returns (learner state, buffer manifest) of the checkpoint at step, or None without one."""
+    path = checkpoint_dir(model_dir, step)
+    if not os.path.isdir(path) and os.path.isdir(path + '.old'):
+        # stopped while replacing it
+        path = path + '.old'
+    if not os.path.isdir(path):
+        return None
+
+    tic = time.time()
+    learner_state = torch.load(os.path.join(path, 'learner.pt'), map_location='cpu')
+    with open(os.path.join(path, 'buffer.pkl'), 'rb') as f:
+        buffer_manifest = pickle.load(f)
+    print('Loaded checkpoint {} in {:.3f}s'.format(path, time.time()-tic))
+    return learner_state, buffer_manifest
+
+
+def _write_atomic(path, text):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints on a background thread, one at a time and in order.
+    saved is an optional multiprocessing Value counting the checkpoints done, for another process
+    to wait on.
+    """
+    def __init__(self, saved=None):
+        self._saved = saved
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def write(self, model_dir, step, learner_state, buffer_manifest=None, replay_buffer=None):
+        """Without a buffer_manifest, the snapshot of replay_buffer (if any) is taken by the writer."""
+        self._queue.put((model_dir, step, learner_state, buffer_manifest, replay_buffer))
+
+    def wait(self):
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            model_dir, step, learner_state, buffer_manifest, replay_buffer = self._queue.get()
+            try:
+                tic = time.time()
+                if replay_buffer is not None:
+                    buffer_manifest = replay_buffer.snapshot(buffer_dir(model_dir))
+                save(model_dir, step, learner_state, buffer_manifest)
+                print('Saved checkpoint at step {} in {:.3f}s'.format(step, time.time()-tic))
+            except Exception as e:
+                print('Failed to save the checkpoint at step {}: {}'.format(step, e))
+            finally:
+                if self._saved is not None:
+                    with self._saved.get_lock():
+                        self._saved.value += 1
+                self._queue.task_done()
@@ -0,0 +1,121 @@
+import cv2
+import numpy as np
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+CODECS = ['raw', 'png', 'jpeg', 'lz4']
+
+
+class Frame(object):
+    """Encoded image of an observation: the whole stack (key frame) or only the newest frames."""
+    __slots__ = ('key', 'codec', 'shape', 'channels', 'data')
+
+    def __init__(self, key, codec, shape, channels, data):
+        self.key = key
+        self.codec = codec
+        self.shape = shape          # (C, H, W) of the whole stack
+        self.channels = channels    # channels per frame
+        self.data = data            # one encoded buffer per frame
+
+    def __getstate__(self):
+        return (self.key, self.codec, self.shape, self.channels, self.data)
+
+    def __setstate__(self, state):
+        self.key, self.codec, self.shape, self.channels, self.data = state
+
+    def __len__(self):
+        return sum(len(d) for d in self.data)
+
+
+def _is_image(image):
+    return isinstance(image, np.ndarray) and image.ndim == 3 and image.dtype == np.uint8 and image.size > 0
+
+
+class FrameEncoder(object):
+    """Local side of the uplink. Observations are (image, ...) tuples with a (C, H, W) uint8 image made
+    of stacked frames, the newest last. When the new stack is the previous one shifted by one frame,
+    only the newest frame is sent; otherwise (first observation of an episode) the whole stack is.
+    Observations without such an image are passed through unchanged.
+    """
+    def __init__(self, codec='raw', channels=3, jpeg_quality=90, png_compression=1):
+        assert codec in CODECS, 'codec must be one of {}'.format(CODECS)
+        if codec == 'lz4' and lz4_frame is None:
+            raise ImportError('the lz4 codec needs the lz4 package: pip install lz4')
+        self._codec = codec
+        self._channels = channels
+        self._jpeg_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+        self._png_params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+        self._last = None
+
+        # statistics
+        self.raw_bytes = 0
+        self.encoded_bytes = 0
+        self.key_frames = 0
+
+    def encode(self, ob, key=False):
+        if not isinstance(ob, tuple) or len(ob) == 0 or not _is_image(ob[0]):
+            return ob
+
+        image = ob[0]
+        c = self._channels
+        if not key and self._last is not None and self._last.shape == image.shape and \
+                np.array_equal(self._last[c:], image[:-c]):
+            frames = [image[-c:]]
+        else:
+            key = True
+            frames = [image[i:i+c] for i in range(0, image.shape[0], c)]
+            self.key_frames += 1
+        self._last = image.copy()
+
+        frame = Frame(key, self._codec, image.shape, c, [self._encode(f) for f in frames])
+        self.raw_bytes += sum(f.nbytes for f in frames)
+        self.encoded_bytes += len(frame)
+        return (frame,) + ob[1:]
+
+    def _encode(self, frame):
+        if self._codec == 'raw':
+            return frame.tobytes()
+        if self._codec == 'lz4':
+            return lz4_frame.compress(frame.tobytes())
+
+        # the image codecs take (H, W, C)
+        frame = np.ascontiguousarray(frame.transpose(1, 2, 0))
+        if self._codec == 'png':
+            ok, buf = cv2.imencode('.png', frame, self._png_params)
+        else:
+            ok, buf = cv2.imencode('.jpg', frame, self._jpeg_params)
+        assert ok, 'failed to encode frame with {}'.format(self._codec)
+        return buf.tobytes()
+
+
+class FrameDecoder(object):
+    """Remote side of the uplink, rebuilds the image stacks encoded by FrameEncoder."""
+    def __init__(self):
+        self._stack = None
+
+    def decode(self, ob):
+        if not isinstance(ob, tuple) or len(ob) == 0 or not isinstance(ob[0], Frame):
+            return ob
+
+        frame = ob[0]
+        frames = [self._decode(frame, data) for data in frame.data]
+        if frame.key:
+            image = np.concatenate(frames)
+        else:
+            assert self._stack is not None, 'received a partial frame before a key frame'
+            image = np.concatenate([self._stack[frame.channels*len(frames):]] + frames)
+        self._stack = image
+        return (image,) + ob[1:]
+
+    def _decode(self, frame, data):
+        c, h, w = frame.channels, frame.shape[1], frame.shape[2]
+        if frame.codec == 'raw':
+            return np.frombuffer(data, dtype=np.uint8).reshape(c, h, w)
+        if frame.codec == 'lz4':
+            return np.frombuffer(lz4_frame.decompress(data), dtype=np.uint8).reshape(c, h, w)
+
+        decoded = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        return decoded.reshape(h, w, c).transpose(2, 0, 1)
@@ -1,4 +1,7 @@
+import collections
 import pickle
+import struct
+import relod.tracing as tracing
 
 class MODE:
     LOCAL_ONLY = 'local only'
@@ -6,29 +9,72 @@ class MODE:
     REMOTE_LOCAL = 'remote local'
     EVALUATION = 'evaluation'
 
-def recv_message(client_sock):
-    bytes_to_recv = 4 # recieve message length first
-    message_buffer = bytearray()
-    while bytes_to_recv > 0:
-        chunk = client_sock.recv(bytes_to_recv)
-        if chunk == b'':
-            raise RuntimeError("socket connection broken")
-        message_buffer += chunk
-        bytes_to_recv -= len(chunk)
-    
-    bytes_to_recv = int.from_bytes(message_buffer, byteorder='big')
-    message_buffer = bytearray() # recieve actual parameters
-    while bytes_to_recv > 0:
-        chunk = client_sock.recv(bytes_to_recv)
-        if chunk == b'':
-            raise RuntimeError("socket connection broken")
-        message_buffer += chunk
-        bytes_to_recv -= len(chunk)
-            
-    return pickle.loads(message_buffer)
-
-def send_message(mess, client_sock):
-    mess = pickle.dumps(mess)
-    length = (len(mess)).to_bytes(4, 'big')
-    client_sock.sendall(length)
-    client_sock.sendall(mess)
+class CHANNEL:
+    CMD = 0
+    DATA = 1
+    POLICY = 2
+    SESSION = 3 # hello, acks and heartbeats of the session, never seen by the wrappers
+
+# what the remote sends on CHANNEL.POLICY: the policy, numbered by the remote in the order it was sent
+# (version), with the number of learner updates it reflects and the time.time() it was sent at
+PolicyUpdate = collections.namedtuple('PolicyUpdate', ['version', 'num_updates', 'timestamp', 'policy'])
+
+class Batch(list):
+    """Several data messages sent as one; RemoteWrapper and RemoteServer unpack it on arrival."""
+    pass
+
+# a frame is this header (channel, sequence number, payload length) followed by the pickled message
+HEADER = struct.Struct('>BQI')
+
+# protocol 4 can be read by every Python the robot and the workstation may run (>= 3.4)
+PICKLE_PROTOCOL = 4
+
+def encode_frame(channel, mess, seq=0):
+    payload = pickle.dumps(mess, protocol=PICKLE_PROTOCOL)
+    return HEADER.pack(channel, seq, len(payload)), payload
+
+def send_message(mess, client_sock, channel=CHANNEL.DATA, seq=0):
+    """Blocking send of one frame."""
+    with tracing.span('send'):
+        for part in encode_frame(channel, mess, seq):
+            client_sock.sendall(part)
+
+class Session(object):
+    """Sequence numbers of one end of a connection, kept across reconnections.
+
+    Every frame but the SESSION ones is numbered; written frames are kept until the peer acknowledges
+    them, and resent in order after a reconnection. The receiver drops frames it already has, so a
+    resumed connection delivers every message exactly once. Policies are the exception: only the
+    newest unacknowledged one is kept, the peer only wants the latest and they are the largest frames.
+    """
+    def __init__(self, session_id=None):
+        self.id = session_id
+        self.send_seq = 0   # last number given to an outgoing frame
+        self.recv_seq = 0   # last number received
+        self.unacked = collections.deque() # (seq, frame)
+        self.superseded_policies = 0    # unacked policies dropped for a newer one
+        self._policy = None     # the entry of unacked holding the newest policy
+
+    def next_seq(self):
+        self.send_seq += 1
+        return self.send_seq
+
+    def sent(self, seq, frame):
+        entry = (seq, frame)
+        if HEADER.unpack_from(frame[0])[0] == CHANNEL.POLICY:
+            if self._policy is not None and self.unacked and self.unacked[0][0] <= self._policy[0]:
+                self.unacked.remove(self._policy)
+                self.superseded_policies += 1
+            self._policy = entry
+        self.unacked.append(entry)
+
+    def acked(self, seq):
+        while self.unacked and self.unacked[0][0] <= seq:
+            self.unacked.popleft()
+
+    def received(self, seq):
+        """Returns False for a frame that was already received before a reconnection."""
+        if seq <= self.recv_seq:
+            return False
+        self.recv_seq = seq
+        return True
@@ -0,0 +1,83 @@
+"""Data-parallel updates over several update processes.
+
+With update_workers K > 1 an async learner starts K update processes instead of one. The buffer
+process splits each minibatch into K shards, one per worker (see AsyncRadReplayBuffer). Each worker
+computes the gradients of its shard, and every optimizer step first averages the gradients of all
+the workers with an all-reduce, so the workers take the same steps and keep the same weights. The
+all-reduce is torch.distributed with the gloo backend, which also runs on CPU-only hosts.
+
+Worker 0 publishes the weights to the performer (see relod.algo.weights), writes the checkpoints and
+reports the update stats. The other workers update private copies of all the learner state.
+The cores of the update role are split between the workers.
+"""
+import os
+import socket
+import torch
+import torch.distributed as dist
+
+
+def free_address():
+    """A rendezvous address for the workers, on a free local port."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return 'tcp://127.0.0.1:{}'.format(sock.getsockname()[1])
+
+
+def split_cores(rank, world_size):
+    """Keeps every world_size-th core of the calling process for worker rank, with as many threads."""
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) >= world_size:
+        cores = cores[rank::world_size]
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(max(1, min(len(cores), torch.get_num_threads() // world_size)))
+
+
+def privatize(obj):
+    """Moves the tensors of obj to memory of the calling process only."""
+    if isinstance(obj, torch.nn.Module):
+        for tensor in list(obj.parameters()) + list(obj.buffers()):
+            tensor.data = tensor.data.clone()
+    elif isinstance(obj, torch.Tensor):
+        obj.data = obj.data.clone()
+    elif isinstance(obj, torch.optim.Optimizer):
+        for state in obj.state.values():
+            for key, value in state.items():
+                if isinstance(value, torch.Tensor):
+                    state[key] = value.clone()
+
+
+class AllReduceOptimizer(object):
+    """Wraps an optimizer: step() averages the gradients over the workers first. The rest goes to the
+    wrapped optimizer."""
+    def __init__(self, optimizer):
+        self.optimizer = optimizer
+
+    def __getattr__(self, name):
+        return getattr(self.optimizer, name)
+
+    def step(self, closure=None):
+        grads = [p.grad for group in self.optimizer.param_groups for p in group['params'] if p.grad is not None]
+        if grads:
+            flat = torch.cat([grad.reshape(-1) for grad in grads])
+            dist.all_reduce(flat)
+            flat /= dist.get_world_size()
+            offset = 0
+            for grad in grads:
+                grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+                offset += grad.numel()
+        return self.optimizer.step(closure)
+
+
+def setup(learner, rank, world_size, address):
+    """Joins the workers. The spawned learners all hold the shared tensors of the parent: the workers
+    other than 0 switch to private copies of the state, then the optimizers are wrapped."""
+    dist.init_process_group('gloo', init_method=address, rank=rank, world_size=world_size)
+    split_cores(rank, world_size)
+    if rank > 0:
+        for obj in learner._checkpoint_objects().values():
+            privatize(obj)
+        # different augmentations and policy samples on each shard
+        torch.manual_seed(torch.initial_seed() + rank)
+    for name, value in list(vars(learner).items()):
+        if isinstance(value, torch.optim.Optimizer):
+            setattr(learner, name, AllReduceOptimizer(value))
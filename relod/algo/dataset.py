@@ -0,0 +1,308 @@
+"""Offline datasets of collected transitions.
+
+A dataset is a directory of chunk files and index.json. Each chunk holds up to chunk_steps
+consecutive transitions of one run as compressed columns: the replay buffer fields and the episode
+number of each row. The index lists the chunks in order with the observation and action shapes.
+Chunks also end at the episode ends, and are written under a temporary name and renamed into place,
+the index after them: a learner stopped while recording loses the episode in progress only.
+Recording into an existing dataset appends to it, so the runs of a task add up to one dataset.
+
+Datasets are recorded by a replay buffer created with record (see RadReplayBuffer). They are read a
+chunk at a time, so they need not fit in memory, and either seed a replay buffer or are sampled
+directly, e.g. for offline pretraining:
+
+    data = Dataset('ur5_runs')
+    data.fill(replay_buffer)            # the newest rows that fit
+    batch = data.sample(batch_size)     # same tuple as RadReplayBuffer.sample()
+
+The rows do not depend on the algorithm: any learner with the same observation and action shapes
+can use them. From the command line:
+
+    python -m relod.algo.dataset info ur5_runs
+    python -m relod.algo.dataset import ur5_runs <save_buffer_path>   # .npy dumps of AsyncRadReplayBuffer.save
+"""
+import argparse
+import collections
+import json
+import os
+import pickle
+import queue
+import threading
+import numpy as np
+
+INDEX = 'index.json'
+# in the order of RadReplayBuffer.sample()
+FIELDS = ['images', 'propris', 'actions', 'rewards', 'next_images', 'next_propris', 'dones']
+DTYPES = {
+    'images': np.uint8,
+    'next_images': np.uint8,
+    'propris': np.float32,
+    'next_propris': np.float32,
+    'actions': np.float32,
+    'rewards': np.float32,
+    'dones': np.float32,
+}
+
+
+def _read_index(directory):
+    try:
+        with open(os.path.join(directory, INDEX)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_atomic(path, write):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _shapes(image_shape, proprioception_shape, action_shape):
+    """Shape of a row of each field, the image and proprioception fields only when there are some."""
+    shapes = {'actions': tuple(action_shape), 'rewards': (1,), 'dones': (1,)}
+    if image_shape[-1] != 0:
+        shapes['images'] = shapes['next_images'] = tuple(image_shape)
+    if proprioception_shape[-1] != 0:
+        shapes['propris'] = shapes['next_propris'] = tuple(proprioception_shape)
+    return shapes
+
+
+class DatasetWriter(object):
+    """Appends transitions to the dataset in directory. The chunks are compressed and written on a
+    background thread, one writer per directory at a time.
+    """
+    def __init__(self, directory, image_shape, proprioception_shape, action_shape, chunk_steps=128):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.chunk_steps = chunk_steps
+        self._shapes = _shapes(image_shape, proprioception_shape, action_shape)
+
+        self._index = _read_index(directory)
+        if self._index is None:
+            self._index = {
+                'version': 1,
+                'image_shape': list(image_shape),
+                'proprioception_shape': list(proprioception_shape),
+                'action_shape': list(action_shape),
+                'chunks': [],
+            }
+        shapes = (list(image_shape), list(proprioception_shape), list(action_shape))
+        assert shapes == (self._index['image_shape'], self._index['proprioception_shape'], self._index['action_shape']), \
+            'cannot append shapes {} to the dataset {} of shapes {}'.format(
+                shapes, directory, (self._index['image_shape'], self._index['proprioception_shape'], self._index['action_shape']))
+
+        chunks = self._index['chunks']
+        self._episode = chunks[-1]['last_episode'] + 1 if chunks else 0
+        self._episode_rows = 0
+        self._rows = []
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def add(self, image, propri, action, reward, next_image, next_propri, done):
+        self._rows.append((self._episode, (image, propri, action, reward, next_image, next_propri, done)))
+        self._episode_rows += 1
+        if done:
+            self.end_episode()
+        elif len(self._rows) >= self.chunk_steps:
+            self._write_chunk()
+
+    def end_episode(self):
+        """The last row added ends an episode, a done or a timeout."""
+        if self._episode_rows == 0:
+            return
+        self._write_chunk()
+        self._episode += 1
+        self._episode_rows = 0
+
+    def close(self):
+        """Writes the rows left, the episode in progress included, and waits for the writes."""
+        self._write_chunk()
+        self._queue.join()
+
+    def _write_chunk(self):
+        if self._rows:
+            self._queue.put(self._rows)
+            self._rows = []
+
+    def _run(self):
+        while True:
+            rows = self._queue.get()
+            try:
+                self._save(rows)
+            except Exception as e:
+                print('Failed to write {} rows to the dataset {}: {}'.format(len(rows), self.directory, e))
+            finally:
+                self._queue.task_done()
+
+    def _save(self, rows):
+        episodes, transitions = zip(*rows)
+        columns = dict(zip(FIELDS, zip(*transitions)))
+        arrays = {'episodes': np.asarray(episodes, dtype=np.int64)}
+        for field, shape in self._shapes.items():
+            arrays[field] = np.asarray(columns[field], dtype=DTYPES[field]).reshape(len(rows), *shape)
+
+        chunks = self._index['chunks']
+        name = 'chunk_{:06d}.npz'.format(len(chunks))
+        _write_atomic(os.path.join(self.directory, name), lambda f: np.savez_compressed(f, **arrays))
+        chunks.append({
+            'file': name,
+            'rows': len(rows),
+            'first_episode': int(episodes[0]),
+            'last_episode': int(episodes[-1]),
+        })
+        index = json.dumps(self._index, indent=1).encode()
+        _write_atomic(os.path.join(self.directory, INDEX), lambda f: f.write(index))
+
+
+class Dataset(object):
+    """Reads the dataset in directory, keeping the cache_chunks chunks used last in memory."""
+    def __init__(self, directory, cache_chunks=8):
+        self.directory = directory
+        self._index = _read_index(directory)
+        assert self._index is not None, 'no dataset in {}'.format(directory)
+        self.image_shape = tuple(self._index['image_shape'])
+        self.proprioception_shape = tuple(self._index['proprioception_shape'])
+        self.action_shape = tuple(self._index['action_shape'])
+
+        self._chunks = self._index['chunks']
+        self._starts = np.concatenate([[0], np.cumsum([chunk['rows'] for chunk in self._chunks])]).astype(np.int64)
+        self._cache = collections.OrderedDict()
+        self._cache_chunks = cache_chunks
+
+    def __len__(self):
+        return int(self._starts[-1])
+
+    @property
+    def num_chunks(self):
+        return len(self._chunks)
+
+    @property
+    def num_episodes(self):
+        if not self._chunks:
+            return 0
+        return self._chunks[-1]['last_episode'] - self._chunks[0]['first_episode'] + 1
+
+    def _load(self, i):
+        with np.load(os.path.join(self.directory, self._chunks[i]['file'])) as data:
+            arrays = {name: data[name] for name in data.files}
+        # a row ends an episode on a done, before a new episode, and at the end of the dataset
+        episodes = arrays['episodes']
+        following = self._chunks[i+1]['first_episode'] if i + 1 < len(self._chunks) else -1
+        arrays['ends'] = ((np.append(episodes[1:], following) != episodes)[:, None]) | (arrays['dones'] > 0)
+        return arrays
+
+    def chunk(self, i):
+        """The columns of chunk i, with the episode ends."""
+        if i in self._cache:
+            self._cache.move_to_end(i)
+            return self._cache[i]
+        arrays = self._load(i)
+        self._cache[i] = arrays
+        if len(self._cache) > self._cache_chunks:
+            self._cache.popitem(last=False)
+        return arrays
+
+    def read(self, idxs):
+        """The rows idxs, in the order of RadReplayBuffer.sample(). Each chunk is read once."""
+        idxs = np.asarray(idxs, dtype=np.int64)
+        chunks = np.searchsorted(self._starts, idxs, side='right') - 1
+        batch = {}
+        for i in np.unique(chunks):
+            selected = chunks == i
+            arrays = self.chunk(i)
+            for field in FIELDS:
+                if field not in arrays:
+                    continue
+                if field not in batch:
+                    batch[field] = np.empty((len(idxs), *arrays[field].shape[1:]), dtype=arrays[field].dtype)
+                batch[field][selected] = arrays[field][idxs[selected] - self._starts[i]]
+        return tuple(batch.get(field) for field in FIELDS)
+
+    def sample(self, batch_size):
+        return self.read(np.random.randint(0, len(self), size=batch_size))
+
+    def fill(self, replay_buffer):
+        """Adds the newest rows that fit to replay_buffer, oldest first, and returns their number."""
+        if not replay_buffer.ignore_image:
+            assert tuple(replay_buffer.image_shape) == self.image_shape, \
+                'the dataset images are {}, not {}'.format(self.image_shape, tuple(replay_buffer.image_shape))
+        if not replay_buffer.ignore_propri:
+            assert tuple(replay_buffer.proprioception_shape) == self.proprioception_shape, \
+                'the dataset proprioceptions are {}, not {}'.format(self.proprioception_shape,
+                                                                   tuple(replay_buffer.proprioception_shape))
+        assert tuple(replay_buffer.action_shape) == self.action_shape, \
+            'the dataset actions are {}, not {}'.format(self.action_shape, tuple(replay_buffer.action_shape))
+
+        first = max(0, len(self) - replay_buffer.capacity)
+        for i in range(len(self._chunks)):
+            if self._starts[i+1] <= first:
+                continue
+            # read once, not kept in the cache
+            arrays = self._load(i)
+            lo = max(0, first - self._starts[i])
+            replay_buffer.extend(*[arrays[field][lo:] if field in arrays else None for field in FIELDS],
+                                 ends=arrays['ends'][lo:])
+        print('Added {} samples from the dataset {}'.format(len(self) - first, self.directory))
+        return len(self) - first
+
+
+def import_buffer_dump(directory, loadpath, chunk_steps=128):
+    """Appends the buffer saved to loadpath by AsyncRadReplayBuffer.save to the dataset in directory.
+    The dumps have no timeouts, their episodes end on the dones only."""
+    with open(os.path.join(loadpath, "buffer_data.pkl"), "rb") as handle:
+        data = pickle.load(handle)
+    arrays = {field: np.load(os.path.join(loadpath, field + ".npy"), mmap_mode='r') for field in FIELDS}
+    capacity = len(arrays['actions'])
+    # oldest first
+    first = data['idx'] if data['count'] == capacity else 0
+    rows = (first + np.arange(data['count'])) % capacity
+
+    writer = DatasetWriter(directory, arrays['images'].shape[1:], arrays['propris'].shape[1:],
+                           arrays['actions'].shape[1:], chunk_steps)
+    for row in rows:
+        writer.add(*[arrays[field][row] for field in FIELDS])
+    writer.close()
+    return len(rows)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command')
+    info = commands.add_parser('info', help="Print the size and the episode returns of a dataset")
+    info.add_argument('directory', type=str)
+    load = commands.add_parser('import', help="Append a buffer saved with --save_buffer_path to a dataset")
+    load.add_argument('directory', type=str)
+    load.add_argument('loadpath', type=str)
+    load.add_argument('--chunk_steps', default=128, type=int, help="Transitions per chunk")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.command == 'import':
+        rows = import_buffer_dump(args.directory, args.loadpath, args.chunk_steps)
+        print('Imported {} samples from {} to {}'.format(rows, args.loadpath, args.directory))
+    elif args.command == 'info':
+        data = Dataset(args.directory)
+        print('{}: {} samples, {} episodes in {} chunks'.format(args.directory, len(data), data.num_episodes,
+                                                                data.num_chunks))
+        print('image {}, proprioception {}, action {}'.format(data.image_shape, data.proprioception_shape,
+                                                              data.action_shape))
+        returns = collections.OrderedDict()
+        for i in range(data.num_chunks):
+            arrays = data._load(i)
+            for episode, reward in zip(arrays['episodes'], arrays['rewards'][:, 0]):
+                returns[episode] = returns.get(episode, 0.0) + float(reward)
+        if returns:
+            values = np.array(list(returns.values()))
+            print('episode return: mean {:.2f}, min {:.2f}, max {:.2f}'.format(values.mean(), values.min(),
+                                                                               values.max()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,10 @@
-import socket
-import multiprocessing as mp
 import queue
-from relod.algo.comm import MODE
+import time
+import relod.tracing as tracing
+import relod.affinity as affinity
+from relod.algo.comm import MODE, CHANNEL, Batch
+from relod.algo.codec import FrameEncoder
+from relod.algo.transport import Transport
 from relod.algo.rl_agent import BasePerformer, BaseLearner, BaseWrapper
 
 class LocalWrapper(BaseWrapper):
@@ -9,77 +12,50 @@ class LocalWrapper(BaseWrapper):
                        mode,
                        remote_ip='localhost', 
                        port=9876,
+                       connect_timeout=0,
+                       uplink_codec='raw',
+                       jpeg_quality=90,
+                       uplink_batch=1,
+                       spill_dir='',
+                       spill_max_mb=1024,
+                       reconnect_timeout=300,
+                       placement='',
                        ):
         super().__init__()
         self._mode = mode
         print("Mode:", mode)
         if self._mode in [MODE.REMOTE_ONLY, MODE.REMOTE_LOCAL]:
-            self._cmd_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._cmd_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            self._cmd_sock.connect((remote_ip, port))
-            print('Command socket connected!')
-
-            self._data_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._data_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            self._data_sock.connect((remote_ip, port+1))
-            print('Data socket connected!')
+            # samples, commands and policies share one connection, served by the transport's thread.
+            # When the link stalls, the samples queued past an episode's worth go to a spill file
+            # instead of blocking the control loop, and are coalesced into batches as it catches up.
+            self._transport = Transport.connect(remote_ip, port, timeout=connect_timeout,
+                                                send_queue_size=3*max_samples_per_episode+100,
+                                                spill_dir=spill_dir, spill_max_bytes=int(spill_max_mb*(1 << 20)),
+                                                coalesce=True, reconnect_timeout=reconnect_timeout)
+            print('Connected to the remote!')
+            # the transport thread gets its own cores, see relod.affinity
+            self._transport.call_soon(affinity.apply, placement, 'transport')
 
             print('Sending mode to server...', end='')
             self.send_data(self._mode)
             print('done.')
 
-            if self._mode == MODE.REMOTE_LOCAL:
-                self._sample_queue = mp.Queue(3*max_samples_per_episode+100)
-                self._policy_queue = mp.Queue(2)
-
-                self._start_send_and_receive_event = mp.Event()
-                self._send_started_event = mp.Event()
-                self._receive_started_event = mp.Event()
-                self._send_started_event.clear()
-                self._receive_started_event.clear()
-
-                # statistics
-                self._sent_samples = mp.Value('L', 0, lock=False)
-                self._received_policies = mp.Value('L', 0, lock=False)
-                self._dropped_policies = mp.Value('L', 0, lock=False)
-                self._applied_policies = 0
+            self._applied_policies = 0
+            self._policy_version = None     # version of the policy acting, tagged on each sample
+            self._policy_num_updates = 0
+            self.policy_delays = []         # seconds from the remote sending a policy to its application
 
-                self._send_p = mp.Process(target=self._send_sample_p)
-                self._recv_p = mp.Process(target=self._receive_remote_policy_p)
-
-                self._send_p.start()
-                self._recv_p.start()
-
-                # wait for processes to start
-                self._send_started_event.wait()
-                self._receive_started_event.wait()
+            # only the newest frame of each image stack is sent, optionally compressed
+            self._encoder = FrameEncoder(uplink_codec, jpeg_quality=jpeg_quality)
+            # REMOTE_ONLY needs every sample right away to send back the next action
+            self._uplink_batch = uplink_batch if self._mode == MODE.REMOTE_LOCAL else 1
+            self._batch = Batch()
 
         elif self._mode in [MODE.LOCAL_ONLY, MODE.EVALUATION]:
             pass
         else:
             raise NotImplementedError('init: {} mode is not supported'.format(self._mode))
 
-    def _send_sample_p(self):
-        print('Send process started.')
-        self._send_started_event.set()
-        while True:
-            sample = self._sample_queue.get()
-            self.send_data(sample)
-            
-            self._sent_samples.value += 1
-
-    def _receive_remote_policy_p(self): # run in a child process
-        print('Receive process started.')
-        self._receive_started_event.set()
-        while True:
-            policy = self.recv_data()
-            
-            self._received_policies.value += 1
-            try:
-                self._policy_queue.put_nowait(policy)
-            except queue.Full:
-                self._dropped_policies.value += 1
-
     def init_performer(self, performer_class: BasePerformer, *args, **kwargs):
         if self._mode in [MODE.LOCAL_ONLY, MODE.REMOTE_LOCAL, MODE.EVALUATION]:
             self._performer = performer_class(*args, **kwargs)
@@ -96,25 +72,44 @@ class LocalWrapper(BaseWrapper):
         else:
             raise NotImplementedError('init_learner: {} mode is not supported'.format(self._mode))
 
+    def begin_reset(self):
+        """Call before resetting the env on a timeout, send_init_ob ends the reset. A done sample begins
+        the reset on its own, and so does the remote learner: it is waiting for the initial observation."""
+        if self._mode == MODE.LOCAL_ONLY:
+            self._learner.begin_reset()
+        elif self._mode in [MODE.REMOTE_ONLY, MODE.REMOTE_LOCAL, MODE.EVALUATION]:
+            pass
+        else:
+            raise NotImplementedError('begin_reset: {} mode is not supported'.format(self._mode))
+
     def send_init_ob(self, ob):
         if self._mode == MODE.REMOTE_ONLY:
             assert self.recv_cmd() == 'wait for new episode'
-            self.send_data(ob)
+            self.send_data(self._encoder.encode(ob, key=True))
         elif self._mode == MODE.REMOTE_LOCAL:
+            self._flush_batch() # the remote asks for the new episode after the last sample
             assert self.recv_cmd() == 'wait for new episode'
-            self._sample_queue.put_nowait(ob) # fatal error if sample queue is full
-        elif self._mode in [MODE.LOCAL_ONLY, MODE.EVALUATION]:
+            self.send_data(self._encoder.encode(ob, key=True))
+        elif self._mode == MODE.LOCAL_ONLY:
+            self._learner.end_reset()
+        elif self._mode == MODE.EVALUATION:
             pass
         else:
             raise NotImplementedError('send_init_ob: {} mode is not supported'.format(self._mode))
     
     def push_sample(self, ob, action, reward, next_ob, done, *args, **kwargs):
+        with tracing.span('push_sample'):
+            self._push_sample(ob, action, reward, next_ob, done, *args, **kwargs)
+
+    def _push_sample(self, ob, action, reward, next_ob, done, *args, **kwargs):
         if self._mode == MODE.LOCAL_ONLY:
             self._learner.push_sample(ob, action, reward, next_ob, done, *args, **kwargs)
-        elif self._mode == MODE.REMOTE_ONLY:
-            self.send_data((reward, next_ob, done, *args, kwargs))
-        elif self._mode == MODE.REMOTE_LOCAL:
-            self._sample_queue.put_nowait((reward, next_ob, done, *args, kwargs)) # fatal error if sample queue is full
+            if done:
+                self._learner.begin_reset()
+        elif self._mode in [MODE.REMOTE_ONLY, MODE.REMOTE_LOCAL]:
+            if self._mode == MODE.REMOTE_LOCAL:
+                kwargs['behavior_version'] = self._policy_version
+            self._send_step((reward, self._encoder.encode(next_ob), done, *args, kwargs), flush=bool(done))
         elif self._mode == MODE.EVALUATION:
             pass
         else:
@@ -124,21 +119,42 @@ class LocalWrapper(BaseWrapper):
         if self._mode == MODE.REMOTE_ONLY:
             action = self.recv_data()
         elif self._mode in [MODE.REMOTE_LOCAL, MODE.LOCAL_ONLY, MODE.EVALUATION]:
-            action = self._performer.sample_action(ob, *args, **kwargs)
+            with tracing.span('sample_action'):
+                action = self._performer.sample_action(ob, *args, **kwargs)
             if self._mode == MODE.REMOTE_LOCAL:
-                self._sample_queue.put_nowait(action)
+                self._send_step(action)
         else:
             raise NotImplementedError('sample_action: {} mode is not supported'.format(self._mode))
         
         return action
 
+    def _send_step(self, msg, flush=False):
+        if self._uplink_batch == 1:
+            self.send_data(msg)
+            return
+
+        self._batch.append(msg)
+        # an action and a sample per step
+        if flush or len(self._batch) >= 2*self._uplink_batch:
+            self._flush_batch()
+
+    def _flush_batch(self):
+        if self._batch:
+            self.send_data(self._batch)
+            self._batch = Batch()
+
     def apply_remote_policy(self, block=False):
         if self._mode == MODE.REMOTE_LOCAL:
             try:
-                policy = self._policy_queue.get(block=block)
-                self.performer.load_policy(policy)
+                update = self._transport.recv(CHANNEL.POLICY, block=block)
+                with tracing.span('policy_apply'):
+                    self.performer.load_policy(update.policy)
+                # clocks of the robot and the workstation are assumed in sync (e.g. NTP)
+                self.policy_delays.append(time.time() - update.timestamp)
+                self._policy_version = update.version
+                self._policy_num_updates = update.num_updates
                 self._applied_policies += 1
-                print('applied update:', self._applied_policies)
+                print('applied policy: version {}, {} updates'.format(update.version, update.num_updates))
             except queue.Empty:
                 pass
 
@@ -181,27 +197,31 @@ class LocalWrapper(BaseWrapper):
             raise NotImplementedError('save_buffer: {} mode is not supported'.format(self._mode))
     
 
+    def stats(self):
+        """Transport and uplink counters of the remote modes."""
+        if self._mode not in [MODE.REMOTE_ONLY, MODE.REMOTE_LOCAL]:
+            return {}
+        return {
+            **self._transport.stats(),
+            'applied_policies': self._applied_policies,
+            'policy_version': self._policy_version,
+            'policy_num_updates': self._policy_num_updates,
+            'uplink_raw_bytes': self._encoder.raw_bytes,
+            'uplink_encoded_bytes': self._encoder.encoded_bytes,
+            'uplink_key_frames': self._encoder.key_frames,
+        }
+
     def close(self, *args, **kwargs):
         if self._mode in [MODE.REMOTE_ONLY, MODE.REMOTE_LOCAL]:
+            self._flush_batch()
             assert self.recv_cmd() == 'close'
 
             if self._mode == MODE.REMOTE_LOCAL:
                 self._performer.close(*args, **kwargs)
-                self._send_p.terminate()
-                self._send_p.join()
-                print('Send process finished')
-
-                self._policy_queue.cancel_join_thread() # don't care the remaining policies 
-                self._recv_p.terminate()
-                self._recv_p.join()
-                print('Receive process finished')
-                print('Sent samples', self._sent_samples.value)
-                print('Received policies', self._received_policies.value)
-                print('Dropped policies', self._dropped_policies.value)
-                print('Applied policies', self._applied_policies)
-            
-            self._cmd_sock.close()
-            self._data_sock.close()
+            for key, value in self.stats().items():
+                print(key.replace('_', ' ').capitalize(), value)
+
+            self._transport.close()
             
         elif self._mode in [MODE.LOCAL_ONLY, MODE.EVALUATION]:
             self._performer.close(*args, **kwargs)
@@ -3,7 +3,7 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 from torch.nn import Parameter
-from relod.utils import random_augment
+from relod.utils import crop_images
 
 
 def weight_init(m):
@@ -120,15 +120,8 @@ class EncoderModel(nn.Module):
             return proprioceptions
 
         if self.encoder_type == 'pixel' or self.encoder_type == 'multi':
-            images = images / 255.
-            if random_rad:
-                images = random_augment(images, self.rad_h, self.rad_w)
-            else:
-                n, c, h, w = images.shape
-                images = images[:, :,
-                  self.rad_h : h-self.rad_h,
-                  self.rad_w : w-self.rad_w,
-                  ]
+            # accepts uint8 images straight from the replay buffer, only the cropped float tensor is created
+            images = crop_images(images, self.rad_h, self.rad_w, random_crop=random_rad)
 
             h = self.ss(self.convs(images))
             if detach:
@@ -193,7 +186,8 @@ class ActorModel(nn.Module):
     def forward(
         self, images, proprioceptions, random_rad=True, compute_pi=True, compute_log_pi=True, detach_encoder=False):
         latents = self.encoder(images, proprioceptions, random_rad, detach=detach_encoder)
-        mu, log_std = self.trunk(latents).chunk(2, dim=-1)
+        # the distribution and entropy math stays in fp32 under autocast
+        mu, log_std = self.trunk(latents).float().chunk(2, dim=-1)
 
         # constrain log_std inside [log_std_min, log_std_max]
         log_std = torch.tanh(log_std)
@@ -263,8 +257,9 @@ class CriticModel(nn.Module):
     def forward(self, images, proprioceptions, actions, detach_encoder=False):
         # detach_encoder allows to stop gradient propogation to encoder
         latents = self.encoder(images, proprioceptions, detach=detach_encoder)
-        q1s = self.Q1(latents, actions)
-        q2s = self.Q2(latents, actions)
+        # Q-values are returned in fp32 so the TD targets and losses are computed in full precision under autocast
+        q1s = self.Q1(latents, actions).float()
+        q2s = self.Q2(latents, actions).float()
 
         self.outputs['q1'] = q1s
         self.outputs['q2'] = q2s
@@ -341,15 +336,35 @@ class AttributionDecoder(nn.Module):
         return x
 
 
-class ModelWrapper(torch.nn.Module):
-    def __init__(self, model, propris, action):
-        super(ModelWrapper, self).__init__()
+class GuidedBackprop(object):
+    """Guided backpropagation saliency of a critic's Q1 w.r.t. its input images.
+    The ReLU hooks are registered once and only rewrite gradients while an attribution is computed,
+    so regular forward/backward passes through the critic are unaffected."""
+    def __init__(self, model):
         self.model = model
-        self.propris = propris
-        self.action = action
-
-    def forward(self, obs):
-        return self.model(obs, self.propris, self.action)[0]
+        self._active = False
+        for module in model.modules():
+            if isinstance(module, nn.ReLU):
+                module.register_forward_hook(self._relu_hook)
+
+    def _relu_hook(self, module, inputs, output):
+        if self._active and output.requires_grad:
+            output.register_hook(_positive_grad)
+
+    def attribute(self, images, propris, action):
+        images = images.detach().requires_grad_(True)
+        self._active = True
+        try:
+            q1 = self.model(images, propris, action)[0]
+            obs_grad, = torch.autograd.grad(q1.sum(), images)
+        finally:
+            self._active = False
+        return obs_grad
+
+
+def _positive_grad(grad):
+    # guided backprop: only positive gradients flow back through a ReLU
+    return grad.clamp(min=0)
 
 
 class SODAMLP(nn.Module):
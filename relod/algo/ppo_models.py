@@ -1,6 +1,6 @@
 import torch
 
-from algo.models import EncoderModel, weight_init
+from relod.algo.models import EncoderModel, weight_init
 from torch import nn
 from torch.distributions import Normal
 
@@ -1,14 +1,14 @@
 
 import time
 import torch
-import utils
+import relod.utils as utils
 
 import numpy as np
 import torch.multiprocessing as mp
 
-from algo.rl_agent import BaseLearner, BasePerformer
-from algo.ppo_rad_buffer import VisuomotorReplayBuffer 
-from algo.ppo_models import ActorModel, CriticModel
+from relod.algo.rl_agent import BaseLearner, BasePerformer
+from relod.algo.ppo_rad_buffer import VisuomotorReplayBuffer 
+from relod.algo.ppo_models import ActorModel, CriticModel
 from torch.optim import Adam
 from torch import nn
 
@@ -0,0 +1,499 @@
+import collections
+import os
+import pickle
+import queue
+import socket
+import selectors
+import threading
+import time
+import relod.utils as utils
+import relod.affinity as affinity
+from relod.algo.comm import MODE, CHANNEL, HEADER, Batch, PolicyUpdate, Session, encode_frame
+from relod.algo.codec import FrameDecoder
+from relod.algo.rl_agent import BaseLearner, BasePerformer
+
+
+class RobotSession:
+    """Server side of one LocalWrapper (REMOTE_ONLY or REMOTE_LOCAL), driven by the messages it sends.
+
+    The protocol is the one of remote_learner.py: mode and args first, then per episode an initial
+    observation after 'wait for new episode', and per step the action (REMOTE_LOCAL) and the sample.
+    The session outlives the socket: while the robot is disconnected, sock is None and what is sent
+    to it is kept until it resumes. The messages are handled on a learner thread, which hands what it
+    sends to post(); the server loop numbers and writes it.
+    """
+    def __init__(self, robot_id, sock, session, post):
+        self.id = robot_id
+        self.sock = sock
+        self.session = session
+        self.post = post
+        self.last_heard = time.time()
+        self.decoder = FrameDecoder()
+        self.mode = None
+        self.args = None
+        self.episode_length_step = None
+        self.learner = None
+        self.performer = None
+        self.state = 'mode'
+
+        self.ob = None
+        self.action = None
+        self.total_steps = 0
+        self.sub_steps = 0
+        self.epi_steps = 0
+        self.ret = 0
+        self.returns = []
+        self.epi_lens = []
+
+    def send_cmd(self, cmd):
+        self._send(cmd, CHANNEL.CMD)
+
+    def send_data(self, msg):
+        self._send(msg, CHANNEL.DATA)
+
+    def send_policy(self, policy):
+        self._send(policy, CHANNEL.POLICY)
+
+    def _send(self, msg, channel):
+        self.post(('send', self, channel, msg))
+
+
+class RemoteServer:
+    """Remote learner for many robots at once.
+
+    Every robot connects a LocalWrapper as it would to remote_learner.py; connections are accepted and
+    served from one selector loop, which never blocks: the sockets are non-blocking, with what is left
+    to write kept per socket until it takes more, and the learners are created, updated and queried on
+    learner threads (one for the shared learner, one per robot otherwise). With buffer_mode 'shared' all robots push into one learner (created
+    from the first robot's args) and every new policy is broadcast to all REMOTE_LOCAL robots; with
+    'per_robot' each robot gets its own learner and policy.
+
+    Robots are told apart by the session id of their hello, and follow the session protocol of
+    Transport: a robot that reconnects resumes where it left off, with its learner untouched.
+    """
+    def __init__(self, performer_class: BasePerformer, learner_class: BaseLearner, port=9876,
+                 buffer_mode='shared', num_robots=1, device='', heartbeat_interval=1.0, heartbeat_timeout=5.0,
+                 placement='', replay_storage='', update_workers=0):
+        assert buffer_mode in ['shared', 'per_robot'], 'buffer_mode must be one of [shared, per_robot]'
+        self._performer_class = performer_class
+        self._learner_class = learner_class
+        self._buffer_mode = buffer_mode
+        self._num_robots = num_robots
+        self._device = device
+        self._placement = placement   # the robots' placement is for their own cores
+        self._replay_storage = replay_storage
+        self._update_workers = update_workers
+        self._heartbeat_interval = heartbeat_interval
+        self._heartbeat_timeout = heartbeat_timeout
+
+        self._selector = selectors.DefaultSelector()
+        server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_sock.bind(('', port))
+        server_sock.listen(num_robots)
+        self._selector.register(server_sock, selectors.EVENT_READ, 'accept')
+        print(f'Listening for {num_robots} robots on port {port}...')
+
+        self._inbox = {}            # sock -> bytes received and not parsed yet
+        self._outbox = {}           # sock -> bytes left to write
+        self._closing = set()       # sockets dropped once written out
+        # the learner threads hand what they send to the loop, and wake it up
+        self._outgoing = queue.Queue()
+        self._wakeup, wakeup = socket.socketpair()
+        self._wakeup.setblocking(False)
+        wakeup.setblocking(False)
+        self._selector.register(wakeup, selectors.EVENT_READ, 'wakeup')
+        self._jobs = {}             # 'shared' or robot id -> messages for its learner thread
+        self._threads = []
+        self._robots = []
+        self._sessions = {}         # session id -> robot
+        self._finished = 0          # robots told to close
+        self._learners_done = 0     # robots the learner threads are done with
+
+        # shared mode
+        self._learner = None
+        self._performer = None
+        self._learner_steps = {}    # learner -> number of samples pushed into it
+        self._learner_updates = {}  # learner -> number of updates, as far as its stats tell
+        self._policy_versions = {}  # learner -> version of the last policy sent
+
+    def serve(self):
+        next_heartbeat = time.time() + self._heartbeat_interval
+        # until the last bye is written out
+        while self._finished < self._num_robots or self._closing:
+            for key, events in self._selector.select(timeout=self._heartbeat_interval):
+                if key.data == 'accept':
+                    self._accept(key.fileobj)
+                    continue
+                if key.data == 'wakeup':
+                    try:
+                        key.fileobj.recv(1 << 16)
+                    except BlockingIOError:
+                        pass
+                    continue
+                if key.fileobj not in self._inbox:  # dropped meanwhile
+                    continue
+                if events & selectors.EVENT_WRITE:
+                    self._flush(key.fileobj)
+                if not events & selectors.EVENT_READ or key.fileobj not in self._inbox:
+                    continue
+                try:
+                    frames = list(self._read(key.fileobj))
+                except OSError as e:
+                    self._disconnect(key.fileobj, key.data, e)
+                    continue
+                robot = key.data
+                if isinstance(robot, RobotSession) and robot.sock is key.fileobj:
+                    # any part of a frame will do, a large one may take longer than the timeout
+                    robot.last_heard = time.time()
+                for channel, seq, msg in frames:
+                    if robot == 'hello':
+                        robot = self._hello(key.fileobj, msg)
+                    elif robot is not None and robot.sock is key.fileobj:
+                        self._receive(robot, channel, seq, msg)
+
+            self._deliver()
+            if time.time() >= next_heartbeat:
+                self._heartbeat()
+                next_heartbeat = time.time() + self._heartbeat_interval
+
+        for jobs in self._jobs.values():
+            jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self._learner is not None:
+            affinity.report()
+            self._learner.close()
+        self._selector.close()
+
+    def _accept(self, server_sock):
+        sock, address = server_sock.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        self._inbox[sock] = b''
+        self._outbox[sock] = collections.deque()
+        # a robot until its hello says which
+        self._selector.register(sock, selectors.EVENT_READ, 'hello')
+        print('Connection from', address)
+
+    def _hello(self, sock, msg):
+        assert msg[0] == 'hello', 'unexpected handshake {}'.format(msg)
+        session_id, peer_recv_seq = msg[1], msg[2]
+        robot = self._sessions.get(session_id)
+        if robot is not None and robot.state == 'done':
+            self._write(sock, encode_frame(CHANNEL.SESSION, ('hello', None, 0)))
+            self._close_when_written(sock)
+            return None
+
+        if robot is None:
+            robot = RobotSession(len(self._robots), sock, Session(session_id), self._post)
+            self._robots.append(robot)
+            self._sessions[session_id] = robot
+            print(f'Robot {robot.id} connected')
+        else:
+            if robot.sock is not None:
+                self._drop(robot.sock)
+            robot.sock = sock
+            print(f'Robot {robot.id} is back, resending {len(robot.session.unacked)} frames')
+        robot.last_heard = time.time()
+        self._selector.modify(sock, self._selector.get_key(sock).events, robot)
+        self._write(sock, encode_frame(CHANNEL.SESSION, ('hello', session_id, robot.session.recv_seq)))
+        robot.session.acked(peer_recv_seq)
+        for _, frame in robot.session.unacked:
+            self._write(sock, frame)
+        return robot
+
+    def _receive(self, robot, channel, seq, msg):
+        if robot.state == 'done':
+            return
+        if channel == CHANNEL.SESSION:
+            if msg[0] == 'ack':
+                robot.session.acked(msg[1])
+            return
+        assert channel == CHANNEL.DATA, 'robots only send on the data channel'
+        if robot.session.received(seq):
+            jobs = self._learner_jobs(robot)
+            for m in (msg if isinstance(msg, Batch) else [msg]):
+                jobs.put((robot, m))
+
+    def _learner_jobs(self, robot):
+        """The queue of the thread that handles the messages of robot, started on first use."""
+        key = 'shared' if self._buffer_mode == 'shared' else robot.id
+        if key not in self._jobs:
+            self._jobs[key] = queue.Queue()
+            thread = threading.Thread(target=self._learner_thread, args=(self._jobs[key],), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self._jobs[key]
+
+    def _learner_thread(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            try:
+                self._handle(*job)
+            except Exception as e:
+                # raised again by the server loop
+                self._post(('error', e))
+                return
+
+    def _post(self, item):
+        """Hands ('send', robot, channel, msg), ('finish', robot) or ('error', exception) to the loop."""
+        self._outgoing.put(item)
+        try:
+            self._wakeup.send(b'\0')
+        except BlockingIOError:  # woken up already
+            pass
+
+    def _deliver(self):
+        """Carries out what the learner threads posted, in order."""
+        while True:
+            try:
+                item = self._outgoing.get_nowait()
+            except queue.Empty:
+                return
+            if item[0] == 'send':
+                _, robot, channel, msg = item
+                # numbered and kept until acknowledged, even while disconnected, to be resent on resume
+                seq = robot.session.next_seq()
+                frame = encode_frame(channel, msg, seq)
+                robot.session.sent(seq, frame)
+                if robot.sock is not None:
+                    self._write(robot.sock, frame)
+            elif item[0] == 'finish':
+                self._finish_connection(item[1])
+            else:
+                raise item[1]
+
+    def _write(self, sock, frame):
+        """Queues the parts of frame on sock and writes what the socket takes now."""
+        if sock not in self._outbox:  # dropped on an earlier write
+            return
+        self._outbox[sock].extend(memoryview(part) for part in frame)
+        self._flush(sock)
+
+    def _flush(self, sock):
+        outbox = self._outbox[sock]
+        try:
+            while outbox:
+                sent = sock.send(outbox[0])
+                if sent < len(outbox[0]):
+                    outbox[0] = outbox[0][sent:]
+                    break
+                outbox.popleft()
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            self._disconnect(sock, self._selector.get_key(sock).data, e)
+            return
+        if not outbox and sock in self._closing:
+            self._drop(sock)
+            return
+        # woken up when the socket takes more, while there is some left
+        key = self._selector.get_key(sock)
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if outbox else 0)
+        if events != key.events:
+            self._selector.modify(sock, events, key.data)
+
+    def _close_when_written(self, sock):
+        """Drops sock once its outbox is written, reading nothing more from it meanwhile."""
+        self._closing.add(sock)
+        self._selector.modify(sock, self._selector.get_key(sock).events, None)
+        self._flush(sock)
+
+    def _heartbeat(self):
+        now = time.time()
+        for robot in self._robots:
+            if robot.sock is None or robot.state == 'done':
+                continue
+            if now - robot.last_heard > self._heartbeat_timeout:
+                self._disconnect(robot.sock, robot, TimeoutError('no heartbeat'))
+                continue
+            self._write(robot.sock, encode_frame(CHANNEL.SESSION, ('ack', robot.session.recv_seq)))
+
+    def _disconnect(self, sock, robot, error):
+        """Drops a broken connection; its robot, if any, keeps its learner until it comes back."""
+        self._drop(sock)
+        if isinstance(robot, RobotSession) and robot.sock is sock:
+            robot.sock = None
+            print(f'Robot {robot.id} disconnected,', repr(error))
+
+    def _drop(self, sock):
+        try:
+            self._selector.unregister(sock)
+        except KeyError:
+            pass
+        self._inbox.pop(sock, None)
+        self._outbox.pop(sock, None)
+        self._closing.discard(sock)
+        sock.close()
+
+    def _read(self, sock):
+        """Yields the complete (channel, seq, message) frames that arrived on sock."""
+        try:
+            chunk = sock.recv(1 << 20)
+        except BlockingIOError:
+            return
+        if chunk == b'':
+            raise ConnectionResetError('connection closed by the robot')
+        buffer = self._inbox[sock] + chunk
+        while len(buffer) >= HEADER.size:
+            channel, seq, length = HEADER.unpack_from(buffer)
+            end = HEADER.size + length
+            if len(buffer) < end:
+                break
+            yield channel, seq, pickle.loads(buffer[HEADER.size:end])
+            buffer = buffer[end:]
+        self._inbox[sock] = buffer
+
+    def _handle(self, robot, msg):
+        if robot.state == 'mode':
+            robot.mode = msg
+            assert robot.mode in [MODE.REMOTE_ONLY, MODE.REMOTE_LOCAL], 'robot mode {} is not supported'.format(robot.mode)
+            print(f'Robot {robot.id} mode:', robot.mode)
+            robot.state = 'args'
+        elif robot.state == 'args':
+            self._init_robot(robot, msg)
+            self._begin_episode(robot)
+        elif robot.state == 'init_ob':
+            robot.ob = robot.decoder.decode(msg)
+            if self._buffer_mode == 'per_robot':
+                robot.learner.end_reset()
+            self._next_action(robot)
+        elif robot.state == 'action':
+            robot.action = msg
+            robot.state = 'sample'
+        elif robot.state == 'sample':
+            self._step(robot, *msg)
+        else:
+            raise NotImplementedError('unexpected message in state {}'.format(robot.state))
+
+    def _init_robot(self, robot, args):
+        if self._device != '':
+            args.device = self._device
+        args.placement = self._placement
+        if self._replay_storage != '':
+            args.replay_storage = self._replay_storage
+        if self._update_workers > 0:
+            args.update_workers = self._update_workers
+        # the n-step returns need the samples of one robot in order
+        assert self._buffer_mode == 'per_robot' or self._num_robots == 1 or getattr(args, 'n_step', 1) == 1, \
+            'n_step > 1 needs buffer_mode per_robot'
+        assert self._buffer_mode == 'per_robot' or self._num_robots == 1 or not getattr(args, 'record_dataset', ''), \
+            'recording the episodes needs buffer_mode per_robot'
+        if self._buffer_mode == 'per_robot':
+            args.model_dir = os.path.join(args.model_dir, f'robot{robot.id}')
+            if getattr(args, 'record_dataset', ''):
+                args.record_dataset = os.path.join(args.record_dataset, f'robot{robot.id}')
+        os.makedirs(args.model_dir, exist_ok=True)
+        os.makedirs(args.return_dir, exist_ok=True)
+        robot.args = args
+        robot.episode_length_step = int(args.episode_length_time / args.dt)
+
+        if self._buffer_mode == 'shared':
+            if self._learner is None:
+                self._performer = self._performer_class(args)
+                self._learner = self._learner_class(args, self._performer)
+                self._add_learner(self._learner)
+            robot.performer, robot.learner = self._performer, self._learner
+        else:
+            robot.performer = self._performer_class(args)
+            robot.learner = self._learner_class(args, robot.performer)
+            self._add_learner(robot.learner)
+
+        if robot.mode == MODE.REMOTE_LOCAL:
+            robot.send_policy(self._policy_update(robot.learner))
+
+    def _add_learner(self, learner):
+        self._learner_steps[learner] = 0
+        self._learner_updates[learner] = 0
+        self._policy_versions[learner] = -1
+
+    def _policy_update(self, learner):
+        self._policy_versions[learner] += 1
+        return PolicyUpdate(self._policy_versions[learner], self._learner_updates[learner], time.time(), learner.get_policy())
+
+    def _begin_episode(self, robot):
+        if self._buffer_mode == 'per_robot':
+            robot.learner.begin_reset()
+        robot.sub_steps = 0
+        robot.send_cmd('wait for new episode')
+        robot.state = 'init_ob'
+
+    def _next_action(self, robot):
+        if robot.mode == MODE.REMOTE_ONLY:
+            robot.action = robot.performer.sample_action(robot.ob)
+            robot.send_data(robot.action)
+            robot.state = 'sample'
+        else:
+            robot.state = 'action'
+
+    def _step(self, robot, reward, next_ob, epi_done, kwargs):
+        next_ob = robot.decoder.decode(next_ob)
+        learner = robot.learner
+        learner.push_sample(robot.ob, robot.action, reward, next_ob, epi_done)
+        self._learner_steps[learner] += 1
+        steps = self._learner_steps[learner]
+        stat = learner.update_policy(steps)
+        if isinstance(stat, dict) and 'train/num_updates' in stat:
+            self._learner_updates[learner] = stat['train/num_updates'] + 1
+        if steps > robot.args.init_steps and steps % robot.args.update_every == 0:
+            self._broadcast_policy(learner)
+
+        robot.total_steps += 1
+        robot.sub_steps += 1
+        robot.epi_steps += 1
+        robot.ret += reward
+        robot.ob = next_ob
+
+        if robot.args.save_model and robot.total_steps % robot.args.save_model_freq == 0:
+            learner.save_policy_to_file(robot.args.model_dir, robot.total_steps)
+
+        if robot.total_steps >= robot.args.env_steps:
+            self._finish(robot)
+        elif epi_done:
+            robot.returns.append(robot.ret)
+            robot.epi_lens.append(robot.epi_steps)
+            utils.save_returns(os.path.join(robot.args.return_dir, f'robot{robot.id}_return.txt'), robot.returns, robot.epi_lens)
+            print(f'Robot {robot.id} episode {len(robot.returns)}: return {robot.ret}, steps {robot.total_steps}')
+            robot.ret = 0
+            robot.epi_steps = 0
+            self._begin_episode(robot)
+        elif robot.sub_steps >= robot.episode_length_step: # time out
+            robot.ret += getattr(robot.args, 'reset_penalty_steps', 0) * getattr(robot.args, 'reward', 0)
+            self._begin_episode(robot)
+        else:
+            self._next_action(robot)
+
+    def _broadcast_policy(self, learner):
+        policy = None
+        for robot in self._robots:
+            if robot.learner is learner and robot.mode == MODE.REMOTE_LOCAL and robot.state != 'done':
+                if policy is None:
+                    policy = self._policy_update(learner)
+                robot.send_policy(policy)
+
+    def _finish(self, robot):
+        robot.state = 'done'
+        if self._buffer_mode == 'per_robot':
+            robot.learner.pause_update()
+            robot.learner.save_policy_to_file(robot.args.model_dir, robot.total_steps)
+        elif self._learners_done + 1 == self._num_robots: # the last robot of the shared learner
+            robot.learner.save_policy_to_file(robot.args.model_dir, self._learner_steps[robot.learner])
+
+        robot.send_cmd('close')
+        if self._buffer_mode == 'per_robot':
+            affinity.report()
+            robot.learner.close()
+        self._learners_done += 1
+        self._post(('finish', robot))
+
+    def _finish_connection(self, robot):
+        if robot.sock is not None:
+            self._write(robot.sock, encode_frame(CHANNEL.SESSION, ('bye',)))
+            if robot.sock in self._inbox:
+                self._close_when_written(robot.sock)
+            robot.sock = None
+        self._finished += 1
+        print(f'Robot {robot.id} finished after {robot.total_steps} steps')
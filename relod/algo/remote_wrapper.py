@@ -1,27 +1,23 @@
-from relod.algo.comm import MODE
+import collections
+import time
+import numpy as np
+from relod.algo.comm import MODE, CHANNEL, Batch, PolicyUpdate
+from relod.algo.codec import FrameDecoder
+from relod.algo.transport import Transport
 from relod.algo.rl_agent import BaseLearner, BasePerformer, BaseWrapper
-import socket
 
 class RemoteWrapper(BaseWrapper):
-    def __init__(self, port=9876):
+    def __init__(self, port=9876, reconnect_timeout=300):
         super().__init__()
-        server_cmd_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_data_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_cmd_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        server_data_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-
-        server_cmd_sock.bind(('', port))
-        server_data_sock.bind(('', port+1))
-
-        server_cmd_sock.listen(1)
-        server_data_sock.listen(1)
-
-        print('Command socket created, listening...')
-        print('Data socket created, listening...')
-
-        (self._cmd_sock, address) = server_cmd_sock.accept()
-        (self._data_sock, address) = server_data_sock.accept()
-        print('Command and Data sockets are connected, ip:', address)
+        self._decoder = FrameDecoder()
+        self._pending = collections.deque() # unpacked from a Batch, not read yet
+        self._policy_version = -1
+        self._num_updates = 0
+        self._policy_lags = []              # versions between the latest policy and the one acting
+        print('Listening...')
+        # the learner waits up to reconnect_timeout seconds for a robot whose connection dropped
+        self._transport = Transport.accept(port, reconnect_timeout=reconnect_timeout)
+        print('Connected to the local agent!')
 
         self._mode = self.recv_data()
         print("Mode:", self._mode)
@@ -43,7 +39,7 @@ class RemoteWrapper(BaseWrapper):
     def receive_init_ob(self):
         if self._mode in [MODE.REMOTE_LOCAL, MODE.REMOTE_ONLY]:
             self.send_cmd('wait for new episode')
-            return self.recv_data()
+            return self._decoder.decode(self.recv_data())
         else:
             raise NotImplementedError('receive_init_ob: {} mode is not supported'.format(self._mode))
 
@@ -60,19 +56,34 @@ class RemoteWrapper(BaseWrapper):
 
     def receive_sample_from_onboard(self):
         if self._mode in [MODE.REMOTE_ONLY, MODE.REMOTE_LOCAL]:
-            return self.recv_data()
+            (reward, next_ob, *rest, kwargs) = self.recv_data()
+            behavior_version = kwargs.pop('behavior_version', None)
+            if behavior_version is not None:
+                self._policy_lags.append(self._policy_version - behavior_version)
+            return (reward, self._decoder.decode(next_ob), *rest, kwargs)
         else: 
             raise NotImplementedError('receive_sample: {} mode is not supported'.format(self._mode))
 
+    def recv_data(self):
+        if not self._pending:
+            msg = super().recv_data()
+            if not isinstance(msg, Batch):
+                return msg
+            self._pending.extend(msg)
+        return self._pending.popleft()
+
     def push_sample(self, ob, action, reward, next_ob, done, *args, **kwargs):
         if self._mode in [MODE.REMOTE_ONLY, MODE.REMOTE_LOCAL]:
             self._learner.push_sample(ob, action, reward, next_ob, done, *args, **kwargs)
         else:
             raise NotImplementedError('push_sample: {} mode is not supported'.format(self._mode))
             
-    def send_policy(self):
+    def send_policy(self, policy=None):
         if self._mode == MODE.REMOTE_LOCAL:
-            self.send_data(self.learner.get_policy())
+            if policy is None:
+                policy = self.learner.get_policy()
+            self._policy_version += 1
+            self._transport.send(CHANNEL.POLICY, PolicyUpdate(self._policy_version, self._num_updates, time.time(), policy))
         elif self._mode == MODE.REMOTE_ONLY:
             pass
         else:
@@ -80,10 +91,22 @@ class RemoteWrapper(BaseWrapper):
 
     def update_policy(self, *args, **kwargs):
         if self._mode in [MODE.REMOTE_ONLY, MODE.REMOTE_LOCAL]:
-            return self._learner.update_policy(*args, **kwargs)
+            stat = self._learner.update_policy(*args, **kwargs)
+            if isinstance(stat, dict) and 'train/num_updates' in stat:
+                self._num_updates = stat['train/num_updates'] + 1
+            return stat
         else:
             raise NotImplementedError('update_policy: {} mode is not supported'.format(self._mode))
 
+    def policy_lag(self):
+        """Mean number of policy versions the samples received since the last call were behind the
+        latest policy sent, None if there were none (REMOTE_ONLY)."""
+        if len(self._policy_lags) == 0:
+            return None
+        lag = float(np.mean(self._policy_lags))
+        self._policy_lags = []
+        return lag
+
     def save_policy_to_file(self, *args, **kwargs):
         if self._mode in [MODE.REMOTE_ONLY, MODE.REMOTE_LOCAL]:
             self._learner.save_policy_to_file(*args, **kwargs)
@@ -103,8 +126,7 @@ class RemoteWrapper(BaseWrapper):
                 self._performer.close(*args, **kwargs)
 
             self._learner.close(*args, **kwargs)  
-            self._cmd_sock.close()
-            self._data_sock.close()
+            self._transport.close()
         else:
             raise NotImplementedError('close: {} mode is not supported'.format(self._mode))
 
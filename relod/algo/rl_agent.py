@@ -1,12 +1,11 @@
-from relod.algo.comm import MODE, send_message, recv_message
+from relod.algo.comm import MODE, CHANNEL
 
 class BaseWrapper:
     def __init__(self) -> None:
         self._performer = None
         self._learner = None
         self._mode = MODE.REMOTE_ONLY
-        self._data_sock = None
-        self._cmd_sock = None
+        self._transport = None
          
     def init_performer(self, *args, **kwargs):
         raise NotImplementedError()
@@ -34,7 +33,7 @@ class BaseWrapper:
 
     def send_cmd(self, cmd):
         if self._mode in [MODE.REMOTE_LOCAL, MODE.REMOTE_ONLY]:
-            send_message(cmd, self._cmd_sock)
+            self._transport.send(CHANNEL.CMD, cmd)
         elif self._mode in [MODE.LOCAL_ONLY, MODE.EVALUATION]:
             pass
         else:
@@ -42,7 +41,7 @@ class BaseWrapper:
 
     def recv_cmd(self):
         if self._mode in [MODE.REMOTE_LOCAL, MODE.REMOTE_ONLY]:
-            return recv_message(self._cmd_sock)
+            return self._transport.recv(CHANNEL.CMD)
         elif self._mode in [MODE.LOCAL_ONLY, MODE.EVALUATION]:
             pass
         else:
@@ -50,7 +49,7 @@ class BaseWrapper:
 
     def send_data(self, msg):
         if self._mode in [MODE.REMOTE_LOCAL, MODE.REMOTE_ONLY]:
-            send_message(msg, self._data_sock)
+            self._transport.send(CHANNEL.DATA, msg)
         elif self._mode in [MODE.LOCAL_ONLY, MODE.EVALUATION]:
             pass
         else:
@@ -58,7 +57,7 @@ class BaseWrapper:
 
     def recv_data(self):
         if self._mode in [MODE.REMOTE_LOCAL, MODE.REMOTE_ONLY]:
-            return recv_message(self._data_sock)
+            return self._transport.recv(CHANNEL.DATA)
         elif self._mode in [MODE.LOCAL_ONLY, MODE.EVALUATION]:
             pass
         else:
@@ -92,6 +91,13 @@ class BaseLearner:
     def load_policy_from_file(self, *args, **kwargs):
         raise NotImplementedError()
 
+    def begin_reset(self):
+        """Called when the env starts resetting, a learner may use the idle time."""
+        pass
+
+    def end_reset(self):
+        pass
+
     def close(self, *args, **kwargs):
         raise NotImplementedError()
 
@@ -17,7 +17,7 @@ class SACDrQLearner(SACRADLearner):
         assert performer != None, "DrQ needs the performer to be SACDrQPerformer"
         assert 'conv' in self._args.net_params, "DrQ needs image input"
 
-    def _update(self, images, propris, actions, rewards, next_images, next_propris, dones):
+    def _update(self, images, propris, actions, rewards, next_images, next_propris, dones, info=None):
         tic = time.time()
         # regular update of SAC_RAD, sequentially augment data and train
         if images is not None:
@@ -35,12 +35,18 @@ class SACDrQLearner(SACRADLearner):
         rewards = torch.as_tensor(rewards, device=self._args.device)
         dones = torch.as_tensor(dones, device=self._args.device)
         
-        stats = self._update_critic(images, propris, actions, rewards, next_images, next_propris, dones)
+        # importance weights of prioritized replay, bootstrap discounts of n-step returns
+        weights, discounts = self._replay_info(info)
+
+        stats, td_errors = self._update_critic(images, propris, actions, rewards, next_images, next_propris, dones, weights,
+                                               discounts)
+        self._update_priorities(info, td_errors)
         if self._num_updates % self._args.actor_update_freq == 0:
             actor_stats = self._update_actor_and_alpha(images, propris)
             stats = {**stats, **actor_stats}
         if self._num_updates % self._args.critic_target_update_freq == 0:
             self._soft_update_target()
+        self._grad_scaler.update()
         stats['train/batch_reward'] = rewards.mean().item()
         stats['train/num_updates'] = self._num_updates
         self._num_updates += 1
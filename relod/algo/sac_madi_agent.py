@@ -1,14 +1,12 @@
 import copy
 import torch
-import time
-import queue
 
 import relod.utils as utils
+import relod.warmup as warmup
 import numpy as np
-import torch.multiprocessing as mp
 
-from relod.algo.sac_rad_buffer import AsyncRadReplayBuffer, RadReplayBuffer
-from relod.algo.rl_agent import BaseLearner, BasePerformer
+from relod.algo.sac_rad_agent import SACRADLearner
+from relod.algo.rl_agent import BasePerformer
 from relod.algo.models import ActorModel, CriticModel, MaskerNet
 from relod.augmentations import strong_augment
 from torch.optim.lr_scheduler import CosineAnnealingLR
@@ -36,6 +34,9 @@ class MaDiPerformer(BasePerformer):
         if not 'conv' in self._args.net_params:  # no image
             self._args.image_shape = (0, 0, 0)
 
+        # before the models are moved to the device, which initializes CUDA
+        warmup.init_kernel_cache(self._args)
+
         self.num_masks = 3  # args.frame_stack (how many frames per obs)
         self._masker = MaskerNet(self._args.image_shape).to(self._args.device)
 
@@ -57,14 +58,28 @@ class MaDiPerformer(BasePerformer):
 
         self.train()
 
-    def apply_mask(self, obs):
-        # obs: tensor shaped as (B, 9, H, W)
-        frames = obs.chunk(self.num_masks, dim=1)  # chunk into num_masks pieces. frames: list of tensors [ (B,3,H,W) , (B,3,H,W) , (B,3,H,W) ]
-        frames_cat = torch.cat(frames, dim=0)  # concat in batch dim. frames_cat: tensor shaped (B*3, 3, H, W)
-        masks_cat = self._masker(frames_cat)  # apply MaskerNet just once, saves 2 forward passes. masks_cat: (B*3, 1, H, W)
-        masks = masks_cat.chunk(self.num_masks, dim=0)  # split the batch dim back into channel dim. masks: list of tensors [ (B,1,H,W) , (B,1,H,W) , (B,1,H,W) ]
-        masked_frames = [m * f for m, f in zip(masks, frames)]  # element-wise multiplication, uses broadcasting over the 3 RGB channels within 1 frame. masked_frames: list of tensors [ (B,3,H,W) , (B,3,H,W) , (B,3,H,W) ]
-        return torch.cat(masked_frames, dim=1)  # concat in channel dim. returns: tensor shaped (B, 9, H, W)
+        # the weights an async learner publishes, see relod.algo.weights
+        self._weights = None
+
+        # pay the first inference latency now rather than at the first action
+        if not hasattr(self._args, "warmup"):
+            self._args.warmup = True
+        if self._args.warmup:
+            warmup.warmup_performer(self, self._args)
+
+    def compute_masks(self, obs):
+        # obs: tensor shaped as (B, 9, H, W). The frames are viewed as a (B*3, 3, H, W) batch without copying,
+        # so MaskerNet runs once over all frames. returns: masks shaped (B, 3, 1, H, W), one mask per frame
+        n, c, h, w = obs.shape
+        masks = self._masker(obs.reshape(n * self.num_masks, c // self.num_masks, h, w))
+        return masks.reshape(n, self.num_masks, 1, h, w)
+
+    def apply_mask(self, obs, masks=None):
+        # element-wise multiplication, broadcasting each frame's mask over its 3 RGB channels. returns: tensor shaped (B, 9, H, W)
+        if masks is None:
+            masks = self.compute_masks(obs)
+        n, c, h, w = obs.shape
+        return (obs.reshape(n, self.num_masks, c // self.num_masks, h, w) * masks).reshape(n, c, h, w)
 
     def train(self, is_training=True):
         self._actor.train(is_training)
@@ -97,13 +112,18 @@ class MaDiPerformer(BasePerformer):
         self._masker.load_state_dict(masker_weights)
 
     def sample_action(self, ob):
+        if self._weights is not None:
+            return self._weights.read(self._sample_action, ob)
+        return self._sample_action(ob)
+
+    def _sample_action(self, ob):
         # sample action for data collection
         with utils.eval_mode(self):
             (image, propri) = ob
 
             with torch.no_grad():
                 if image is not None:
-                    image = torch.FloatTensor(image).to(self._args.device)
+                    image = torch.as_tensor(image, device=self._args.device)
                     image.unsqueeze_(0)
                     image = self.apply_mask(image)
 
@@ -124,116 +144,28 @@ class MaDiPerformer(BasePerformer):
         del self
 
 
-class MaDiLearner(BaseLearner):
+class MaDiLearner(SACRADLearner):
+    """SAC-RAD with a MaskerNet in front of the actor and critic, trained through the critic loss on
+    strongly augmented batches"""
     def __init__(self, args, performer=None, augm_rec=None) -> None:
-        self._args = args
-        self._args.device = torch.device(args.device)
+        # set before SACRADLearner spawns the update process with a copy of the learner
         self.augm_rec = augm_rec
-
-        if not 'conv' in self._args.net_params:  # no image
-            self._args.image_shape = (0, 0, 0)
-
-        if self._args.async_mode:
-            # initialize processes in 'spawn' mode, required by CUDA runtime
-            ctx = mp.get_context('spawn')
-            episode_length_step = int(self._args.episode_length_time / self._args.dt)
-            self._sample_queue = ctx.Queue(episode_length_step+100)
-            self._minibatch_queue = ctx.Queue(100)
-
-            if not hasattr(self._args, "save_buffer_path"):
-                self._args.save_buffer_path = ''
-
-            if not hasattr(self._args, "load_buffer_path"):
-                self._args.load_buffer_path = ''
-
-            # initialize data augmentation process
-            self._replay_buffer_process = ctx.Process(target=AsyncRadReplayBuffer,
-                                    args=(
-                                        self._args.image_shape,
-                                        self._args.proprioception_shape,
-                                        self._args.action_shape,
-                                        self._args.replay_buffer_capacity,
-                                        self._args.batch_size,
-                                        self._sample_queue,
-                                        self._minibatch_queue,
-                                        self._args.init_steps,
-                                        self._args.max_updates_per_step,
-                                        self._args.save_buffer_path,
-                                        self._args.load_buffer_path,
-                                        )
-                                )
-            self._replay_buffer_process.start()
-        else:
-            self._replay_buffer = RadReplayBuffer(
-                image_shape=self._args.image_shape,
-                proprioception_shape=self._args.proprioception_shape,
-                action_shape=self._args.action_shape,
-                capacity=self._args.replay_buffer_capacity,
-                batch_size=self._args.batch_size)
-
         if performer == None:
             performer = MaDiPerformer(args)
-
-        self._performer = performer
-        self._actor = performer._actor
-        self._critic = performer._critic
-        self._critic_target = performer._critic_target
         self._masker = performer._masker
+        self._masked_images = None  # masked batch of the current update step, shared by the critic and actor updates
+        super().__init__(args, performer)
 
-        if self._args.load_model > -1:
-            self._performer.load_policy_from_file(args.model_dir, args.load_model)
-
-        self._log_alpha = torch.tensor(np.log(self._args.init_temperature)).to(self._args.device)
-        self._log_alpha.requires_grad = True
-        # set target entropy to -|A|
-        self._target_entropy = -np.prod(self._args.action_shape)
-
-        self._num_updates = 0
-
-        # optimizers
-        self._init_optimizers()
-        
-        self._performer.train()
-
-        if self._args.async_mode:
-            self._share_memory()
-
-            self._update_queue = ctx.Queue(2)
-            self._update_process = ctx.Process(target=self._async_update)
-            self._update_process.start()
-
-    def get_policy(self):
-        actor_weights = self._actor.state_dict()
-        for key in actor_weights:
-            actor_weights[key] = actor_weights[key].cpu().numpy()
-
-        critic_weights = self._critic.state_dict()
-        for key in critic_weights:
-            critic_weights[key] = critic_weights[key].cpu().numpy()
-
+    def _get_policy(self):
+        policy = super()._get_policy()
         masker_weights = self._masker.state_dict()
         for key in masker_weights:
             masker_weights[key] = masker_weights[key].cpu().numpy()
-
-        return {
-                'actor': actor_weights,
-                'critic': critic_weights,
-                'masker': masker_weights,
-            }
+        policy['masker'] = masker_weights
+        return policy
 
     def _init_optimizers(self):
-        self._actor_optimizer = torch.optim.Adam(
-            self._actor.parameters(), lr=self._args.actor_lr, betas=(0.9, 0.999)
-        )
-
-        self._critic_optimizer = torch.optim.Adam(
-            self._critic.parameters(), lr=self._args.critic_lr, betas=(0.9, 0.999)
-        )
-
-        self._log_alpha_optimizer = torch.optim.Adam(
-            [self._log_alpha], lr=self._args.alpha_lr, betas=(0.5, 0.999)
-        )
-
+        super()._init_optimizers()
         self._masker_optimizer = torch.optim.Adam(
             self._masker.parameters(), lr=self._args.masker_lr, betas=(0.9, 0.999)
         )
@@ -246,98 +178,100 @@ class MaDiLearner(BaseLearner):
             self._masker_scheduler = CustomCosineDecay(self._masker_optimizer, 10000)
 
     def _share_memory(self):
-        self._actor.share_memory()
-        self._critic.share_memory()
-        self._critic_target.share_memory()
-        self._log_alpha.share_memory_()
+        super()._share_memory()
         self._masker.share_memory()
 
-    def update_policy(self, step):
-        if self._args.async_mode:
-            try:
-                stat = self._update_queue.get_nowait()
-            except queue.Empty:
-                return None
-
-            return stat
-        
-        if step > self._args.init_steps and (step % self._args.update_every == 0):
-            for _ in range(self._args.update_epochs):
-                stat = self._update(*self._replay_buffer.sample())
-            return stat
-        
-        return None
-    
-    def _update_critic(self, images, proprioceptions, actions, rewards, next_images, next_proprioceptions, dones):
-        with torch.no_grad():
+    def _published_modules(self):
+        return super()._published_modules() + [self._masker]
+
+    def _checkpoint_objects(self):
+        return {
+            **super()._checkpoint_objects(),
+            'masker': self._masker,
+            'masker_optimizer': self._masker_optimizer,
+            'masker_scheduler': getattr(self, '_masker_scheduler', None),
+        }
+
+    def _update_critic(self, images, proprioceptions, actions, rewards, next_images, next_proprioceptions, dones, weights=None,
+                       discounts=None):
+        with torch.no_grad(), utils.autocast(self._args.device, self._args.amp):
             next_images = self._performer.apply_mask(next_images)
             _, policy_actions, log_pis, _ = self._actor(next_images, next_proprioceptions)
             target_Q1, target_Q2 = self._critic_target(next_images, next_proprioceptions, policy_actions)
             target_V = torch.min(target_Q1, target_Q2) - self._alpha.detach() * log_pis
+            discount = self._args.discount if discounts is None else discounts
             if self._args.bootstrap_terminal:
                 # enable infinite bootstrap
-                target_Q = rewards + (self._args.discount * target_V)
+                target_Q = rewards + (discount * target_V)
             else:
-                target_Q = rewards + ((1.0 - dones) * self._args.discount * target_V)
-
-        if self._args.strong_augment != 'none':
-            if self._args.when_augm == 'before':
-                images_augm = strong_augment(images, self._args.strong_augment)
-                if self.augm_rec is not None:
-                    self.augm_rec.record(images, images_augm, self._num_updates)
-                images = torch.cat([images, images_augm], dim=0)
-                proprioceptions = torch.cat([proprioceptions, proprioceptions], dim=0)
-                actions = torch.cat([actions, actions], dim=0)
-                target_Q = torch.cat([target_Q, target_Q], dim=0)
-
-                images = self._performer.apply_mask(images)
-                if self.augm_rec is not None:
-                    self.augm_rec.record(images[:images.shape[0]//2], images[images.shape[0]//2:], self._num_updates, masked=True)
-            elif self._args.when_augm == 'after':
-                images = self._performer.apply_mask(images)
-                images_augm = strong_augment(images, self._args.strong_augment)
-                if self.augm_rec is not None:
-                    self.augm_rec.record(images, images_augm, self._num_updates, masked=True)
-                images = torch.cat([images, images_augm], dim=0)
-                proprioceptions = torch.cat([proprioceptions, proprioceptions], dim=0)
-                actions = torch.cat([actions, actions], dim=0)
-                target_Q = torch.cat([target_Q, target_Q], dim=0)
-            elif self._args.when_augm == 'both':
-                images_augm = strong_augment(images, self._args.strong_augment)
-                if self.augm_rec is not None:
-                    self.augm_rec.record(images, images_augm, self._num_updates)
-                images = torch.cat([images, images_augm], dim=0)
-                proprioceptions = torch.cat([proprioceptions, proprioceptions], dim=0)
-                actions = torch.cat([actions, actions], dim=0)
-                target_Q = torch.cat([target_Q, target_Q], dim=0)
-
-                images = self._performer.apply_mask(images)
-                if self.augm_rec is not None:
-                    self.augm_rec.record(images[:images.shape[0]//2], images[images.shape[0]//2:], self._num_updates, masked=True)
-                images_augm = strong_augment(images, self._args.strong_augment)
-                if self.augm_rec is not None:
-                    self.augm_rec.record(images, images_augm, self._num_updates, masked=True, descr='_after')
-                images = torch.cat([images, images_augm], dim=0)
-                proprioceptions = torch.cat([proprioceptions, proprioceptions], dim=0)
-                actions = torch.cat([actions, actions], dim=0)
-                target_Q = torch.cat([target_Q, target_Q], dim=0)
+                target_Q = rewards + ((1.0 - dones) * discount * target_V)
+
+        # the masker and critic forward passes share one autocast region, the masker is trained through the critic loss
+        with utils.autocast(self._args.device, self._args.amp):
+            if self._args.strong_augment != 'none':
+                if self._args.when_augm == 'before':
+                    images_augm = strong_augment(images, self._args.strong_augment)
+                    if self.augm_rec is not None:
+                        self.augm_rec.record(images, images_augm, self._num_updates)
+                    images = torch.cat([images, images_augm], dim=0)
+                    proprioceptions = torch.cat([proprioceptions, proprioceptions], dim=0)
+                    actions = torch.cat([actions, actions], dim=0)
+                    target_Q = torch.cat([target_Q, target_Q], dim=0)
+
+                    images = self._performer.apply_mask(images)
+                    masked_images = images[:images.shape[0]//2]
+                    if self.augm_rec is not None:
+                        self.augm_rec.record(images[:images.shape[0]//2], images[images.shape[0]//2:], self._num_updates, masked=True)
+                elif self._args.when_augm == 'after':
+                    images = self._performer.apply_mask(images)
+                    masked_images = images
+                    images_augm = strong_augment(images, self._args.strong_augment)
+                    if self.augm_rec is not None:
+                        self.augm_rec.record(images, images_augm, self._num_updates, masked=True)
+                    images = torch.cat([images, images_augm], dim=0)
+                    proprioceptions = torch.cat([proprioceptions, proprioceptions], dim=0)
+                    actions = torch.cat([actions, actions], dim=0)
+                    target_Q = torch.cat([target_Q, target_Q], dim=0)
+                elif self._args.when_augm == 'both':
+                    images_augm = strong_augment(images, self._args.strong_augment)
+                    if self.augm_rec is not None:
+                        self.augm_rec.record(images, images_augm, self._num_updates)
+                    images = torch.cat([images, images_augm], dim=0)
+                    proprioceptions = torch.cat([proprioceptions, proprioceptions], dim=0)
+                    actions = torch.cat([actions, actions], dim=0)
+                    target_Q = torch.cat([target_Q, target_Q], dim=0)
+
+                    images = self._performer.apply_mask(images)
+                    masked_images = images[:images.shape[0]//2]
+                    if self.augm_rec is not None:
+                        self.augm_rec.record(images[:images.shape[0]//2], images[images.shape[0]//2:], self._num_updates, masked=True)
+                    images_augm = strong_augment(images, self._args.strong_augment)
+                    if self.augm_rec is not None:
+                        self.augm_rec.record(images, images_augm, self._num_updates, masked=True, descr='_after')
+                    images = torch.cat([images, images_augm], dim=0)
+                    proprioceptions = torch.cat([proprioceptions, proprioceptions], dim=0)
+                    actions = torch.cat([actions, actions], dim=0)
+                    target_Q = torch.cat([target_Q, target_Q], dim=0)
+                else:
+                    raise NotImplementedError(f"Unknown arg for when_augm: {self._args.when_augm}")
             else:
-                raise NotImplementedError(f"Unknown arg for when_augm: {self._args.when_augm}")
-        else:
-            images = self._performer.apply_mask(images)
+                images = self._performer.apply_mask(images)
+                masked_images = images
 
-        # get current Q estimates
-        current_Q1, current_Q2 = self._critic(images, proprioceptions, actions, detach_encoder=False)
+            # get current Q estimates
+            current_Q1, current_Q2 = self._critic(images, proprioceptions, actions, detach_encoder=False)
 
-        critic_loss = torch.mean((current_Q1 - target_Q) ** 2 + (current_Q2 - target_Q) ** 2)
+        critic_loss, td_errors = utils.critic_loss(current_Q1, current_Q2, target_Q, weights)
+        # cache the masked (non-augmented) batch for the actor update of this step
+        self._masked_images = masked_images.detach()
 
         # Optimize the critic and masker
         self._masker_optimizer.zero_grad()
         self._critic_optimizer.zero_grad()
-        critic_loss.backward()
+        self._grad_scaler.scale(critic_loss).backward()
         #torch.nn.utils.clip_grad_norm_(self.critic.parameters(), 1)
-        self._critic_optimizer.step()
-        self._masker_optimizer.step()
+        self._grad_scaler.step(self._critic_optimizer)
+        self._grad_scaler.step(self._masker_optimizer)
 
 
         critic_stats = {
@@ -348,14 +282,21 @@ class MaDiLearner(BaseLearner):
             self._masker_scheduler.step()
             critic_stats['train/masker_lr'] = self._masker_scheduler.get_last_lr()[0]
 
-        return critic_stats
+        return critic_stats, td_errors
 
     def _update_actor_and_alpha(self, images, proprioceptions):
-        images = self._performer.apply_mask(images)
+        with utils.autocast(self._args.device, self._args.amp):
+            # The actor loss never reaches the masker (the encoder is detached), so the masked batch
+            # from the critic update is reused instead of running MaskerNet again. It was masked
+            # before this step's masker update, the same lag the target masks have.
+            if self._masked_images is not None:
+                images = self._masked_images
+            else:
+                images = self._performer.apply_mask(images)
 
-        # detach encoder, so we don't update it with the actor loss
-        _, pis, log_pis, log_stds = self._actor(images, proprioceptions, detach_encoder=True)
-        actor_Q1, actor_Q2 = self._critic(images, proprioceptions, pis, detach_encoder=True)
+            # detach encoder, so we don't update it with the actor loss
+            _, pis, log_pis, log_stds = self._actor(images, proprioceptions, detach_encoder=True)
+            actor_Q1, actor_Q2 = self._critic(images, proprioceptions, pis, detach_encoder=True)
 
         actor_Q = torch.min(actor_Q1, actor_Q2)
         actor_loss = (self._alpha.detach() * log_pis - actor_Q).mean()
@@ -365,8 +306,8 @@ class MaDiLearner(BaseLearner):
 
         # optimize the actor
         self._actor_optimizer.zero_grad()
-        actor_loss.backward()
-        self._actor_optimizer.step()
+        self._grad_scaler.scale(actor_loss).backward()
+        self._grad_scaler.step(self._actor_optimizer)
 
         self._log_alpha_optimizer.zero_grad()
         alpha_loss = (self._alpha *
@@ -384,104 +325,12 @@ class MaDiLearner(BaseLearner):
         }
         return actor_stats
 
-    def _soft_update_target(self):
-        utils.soft_update_params(
-            self._critic.Q1, self._critic_target.Q1, self._args.critic_tau
-        )
-        utils.soft_update_params(
-            self._critic.Q2, self._critic_target.Q2, self._args.critic_tau
-        )
-        utils.soft_update_params(
-            self._critic.encoder, self._critic_target.encoder,
-            self._args.encoder_tau
-        )
-
-    def _update(self, images, propris, actions, rewards, next_images, next_propris, dones):
-        tic = time.time()
-        # regular update of SAC_RAD, sequentially augment data and train
-        if images is not None:
-            images = torch.as_tensor(images, device=self._args.device).float()
-            next_images = torch.as_tensor(next_images, device=self._args.device).float()
-            # images = self._performer.apply_mask(images)
-            # next_images = self._performer.apply_mask(next_images)
-            # this was wrong: should wait until it's augmented before applying mask!
-        if propris is not None:
-            propris = torch.as_tensor(propris, device=self._args.device).float()
-            next_propris = torch.as_tensor(next_propris, device=self._args.device).float()
-        actions = torch.as_tensor(actions, device=self._args.device)
-        rewards = torch.as_tensor(rewards, device=self._args.device)
-        dones = torch.as_tensor(dones, device=self._args.device)
-        
-        stats = self._update_critic(images, propris, actions, rewards, next_images, next_propris, dones)
-        if self._num_updates % self._args.actor_update_freq == 0:
-            actor_stats = self._update_actor_and_alpha(images, propris)
-            stats = {**stats, **actor_stats}
-        if self._num_updates % self._args.critic_target_update_freq == 0:
-            self._soft_update_target()
-        stats['train/batch_reward'] = rewards.mean().item()
-        stats['train/num_updates'] = self._num_updates
-        self._num_updates += 1
-        if self._num_updates % 100 == 0:
-            print("Update {} took {:.4f}s to update the model".format(self._num_updates, time.time()-tic))
-        
+    def _update(self, images, propris, actions, rewards, next_images, next_propris, dones, info=None):
+        # the images are masked only once augmented, in _update_critic
+        stats = super()._update(images, propris, actions, rewards, next_images, next_propris, dones, info)
+        self._masked_images = None
         return stats
-        
-    def _async_update(self):
-        while True:
-            try:
-                self._update_queue.put_nowait(self._update(*self._minibatch_queue.get()))
-            except queue.Full:
-                pass
-
-    def push_sample(self, ob, action, reward, next_ob, done):
-        (image, propri) = ob
-        (next_image, next_propri) = next_ob
-
-        if self._args.async_mode:
-            self._sample_queue.put((image, propri, action, reward, next_image, next_propri, done))
-        else:
-            self._replay_buffer.add(image, propri, action, reward, next_image, next_propri, done)
-
-    def pause_update(self):
-        if self._args.async_mode:
-            self._sample_queue.put('pause')
-    
-    def save_buffer(self):
-        if self._args.async_mode:
-            self._sample_queue.put('save')
-    
-    def resume_update(self):
-        if self._args.async_mode:
-            self._sample_queue.put('resume')
-
-    def flush_buffer(self):
-        if self._args.async_mode:
-            self._sample_queue.put('flush')
-
-    def save_policy_to_file(self, model_dir, step):
-        torch.save(self._actor.state_dict(), '%s/actor_%s.pt' % (model_dir, step))
-        torch.save(self._critic.state_dict(), '%s/critic_%s.pt' % (model_dir, step))
-        torch.save(self._masker.state_dict(), '%s/masker_%s.pt' % (model_dir, step))
-        # torch.save(self._actor_optimizer.state_dict(), '%s/_actor_optimizer_%s.pt' % (model_dir, step))
-        # torch.save(self._critic_optimizer.state_dict(), '%s/_critic_optimizer_%s.pt' % (model_dir, step))
-        # torch.save(self._log_alpha_optimizer.state_dict(), '%s/_log_alpha_optimizer_%s.pt' % (model_dir, step))
-
-    def load_policy_from_file(self, model_dir, step):
-        self._performer.load_policy_from_file(model_dir, step)
-        # self._actor_optimizer.load_state_dict(torch.load('%s/_actor_optimizer_%s.pt' % (model_dir, step)))
-        # self._critic_optimizer.load_state_dict(torch.load('%s/_critic_optimizer_%s.pt' % (model_dir, step)))
-        # self._log_alpha_optimizer.load_state_dict(torch.load('%s/_log_alpha_optimizer_%s.pt' % (model_dir, step)))
-
-    def close(self):
-        if self._args.async_mode:
-            self._replay_buffer_process.terminate()
-            self._update_process.terminate()
-            self._replay_buffer_process.join()
-            self._update_process.join()
-
-        del self
-
-    @property
-    def _alpha(self):
-        return self._log_alpha.exp()
 
+    def _save_policy(self, model_dir, step):
+        super()._save_policy(model_dir, step)
+        torch.save(self._masker.state_dict(), '%s/masker_%s.pt' % (model_dir, step))
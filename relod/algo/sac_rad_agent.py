@@ -4,10 +4,17 @@ import time
 import queue
 
 import relod.utils as utils
+import relod.tracing as tracing
+import relod.warmup as warmup
+import relod.affinity as affinity
 import numpy as np
 import torch.multiprocessing as mp
 
 from relod.algo.sac_rad_buffer import AsyncRadReplayBuffer, RadReplayBuffer
+from relod.algo import checkpoint
+from relod.algo import data_parallel
+from relod.algo.dataset import Dataset
+from relod.algo.weights import WeightSlabs
 from relod.algo.rl_agent import BaseLearner, BasePerformer
 from relod.algo.models import ActorModel, CriticModel
 
@@ -20,6 +27,9 @@ class SACRADPerformer(BasePerformer):
         if not 'conv' in self._args.net_params:  # no image
             self._args.image_shape = (0, 0, 0)
 
+        # before the models are moved to the device, which initializes CUDA
+        warmup.init_kernel_cache(self._args)
+
         self._actor = ActorModel(self._args.image_shape,
                                  self._args.proprioception_shape,
                                  self._args.action_shape[0],
@@ -37,6 +47,15 @@ class SACRADPerformer(BasePerformer):
 
         self.train()
 
+        # the weights an async learner publishes, see relod.algo.weights
+        self._weights = None
+
+        # pay the first inference latency now rather than at the first action
+        if not hasattr(self._args, "warmup"):
+            self._args.warmup = True
+        if self._args.warmup:
+            warmup.warmup_performer(self, self._args)
+
     def train(self, is_training=True):
         self._actor.train(is_training)
         self._critic.train(is_training)
@@ -61,13 +80,18 @@ class SACRADPerformer(BasePerformer):
         self._critic.load_state_dict(critic_weights)
 
     def sample_action(self, ob):
+        if self._weights is not None:
+            return self._weights.read(self._sample_action, ob)
+        return self._sample_action(ob)
+
+    def _sample_action(self, ob):
         # sample action for data collection
         with utils.eval_mode(self):
             (image, propri) = ob
 
             with torch.no_grad():
                 if image is not None:
-                    image = torch.FloatTensor(image).to(self._args.device)
+                    image = torch.as_tensor(image, device=self._args.device)
                     image.unsqueeze_(0)
 
                 if propri is not None:
@@ -94,12 +118,42 @@ class SACRADLearner(BaseLearner):
         if not 'conv' in self._args.net_params: # no image
             self._args.image_shape = (0, 0, 0)
 
+        # handed to the spawned processes, which record into the same trace
+        self._tracer = tracing.get_tracer()
+
+        # full state saved by save_policy_to_file, restored with --load_model
+        learner_state, buffer_restore = None, None
+        if self._args.load_model > -1:
+            loaded = checkpoint.load(self._args.model_dir, self._args.load_model)
+            if loaded is not None:
+                learner_state, buffer_manifest = loaded
+                if buffer_manifest is not None:
+                    buffer_restore = (checkpoint.buffer_dir(self._args.model_dir), buffer_manifest)
+
+        # prioritized replay, per_alpha 0 samples uniformly
+        if not hasattr(self._args, "per_alpha"):
+            self._args.per_alpha = 0.0
+        if not hasattr(self._args, "per_beta"):
+            self._args.per_beta = 0.4
+        # length of the returns sampled from the buffer
+        if not hasattr(self._args, "n_step"):
+            self._args.n_step = 1
+        # where the replay rows live: 'numpy' arrays, or torch tensors on the learner 'device' or in
+        # 'pinned' host memory, which in async mode keeps the buffer in the update process
+        if not hasattr(self._args, "replay_storage"):
+            self._args.replay_storage = 'numpy'
+        assert self._args.replay_storage != 'pinned' or self._args.device.type == 'cuda', "pinned storage needs CUDA"
+        # dataset directories the samples are recorded to, and the buffer is seeded from, see relod.algo.dataset
+        if not hasattr(self._args, "record_dataset"):
+            self._args.record_dataset = ''
+        if not hasattr(self._args, "seed_dataset"):
+            self._args.seed_dataset = ''
+
         if self._args.async_mode:
             # initialize processes in 'spawn' mode, required by CUDA runtime
             ctx = mp.get_context('spawn')
             episode_length_step = int(self._args.episode_length_time / self._args.dt)
             self._sample_queue = ctx.Queue(episode_length_step+100)
-            self._minibatch_queue = ctx.Queue(100)
 
             if not hasattr(self._args, "save_buffer_path"):
                 self._args.save_buffer_path = ''
@@ -107,30 +161,61 @@ class SACRADLearner(BaseLearner):
             if not hasattr(self._args, "load_buffer_path"):
                 self._args.load_buffer_path = ''
 
-            # initialize data augmentation process
-            self._replay_buffer_process = ctx.Process(target=AsyncRadReplayBuffer,
-                                    args=(
-                                        self._args.image_shape,
-                                        self._args.proprioception_shape,
-                                        self._args.action_shape,
-                                        self._args.replay_buffer_capacity,
-                                        self._args.batch_size,
-                                        self._sample_queue,
-                                        self._minibatch_queue,
-                                        self._args.init_steps,
-                                        self._args.max_updates_per_step,
-                                        self._args.save_buffer_path,
-                                        self._args.load_buffer_path,
-                                        )
-                                )
-            self._replay_buffer_process.start()
+            # replay ratio cap of the extra updates while the env resets, 0 for none
+            if not hasattr(self._args, "burst_updates_per_step"):
+                self._args.burst_updates_per_step = 0
+
+            # cores and threads of the buffer and update processes, see relod.affinity
+            if not hasattr(self._args, "placement"):
+                self._args.placement = ''
+
+            # update processes splitting each minibatch, see relod.algo.data_parallel
+            if not hasattr(self._args, "update_workers"):
+                self._args.update_workers = 1
+            if self._args.update_workers > 1:
+                assert self._args.replay_storage == 'numpy', "data-parallel updates need the numpy replay storage"
+                assert getattr(self._args, 'amp', 'none') != 'fp16', "data-parallel updates do not support fp16 gradient scaling"
+                assert self._args.batch_size >= self._args.update_workers, "fewer samples than update workers"
+                self._data_parallel_address = data_parallel.free_address()
+
+            # updates between the weights published to the performer, see relod.algo.weights
+            if not hasattr(self._args, "publish_every"):
+                self._args.publish_every = 1
+
+            self._buffer_restore = buffer_restore
+            self._buffer_closed = ctx.Event()
+            self._replay_buffer = None
+            if self._args.replay_storage == 'numpy':
+                # initialize data augmentation process
+                if self._args.update_workers > 1:
+                    self._minibatch_queue = [ctx.Queue(100) for _ in range(self._args.update_workers)]
+                else:
+                    self._minibatch_queue = ctx.Queue(100)
+                self._replay_buffer_process = ctx.Process(target=AsyncRadReplayBuffer,
+                                                          args=self._async_buffer_args(self._args.placement))
+                with affinity.spawn_env(self._args.placement, 'buffer'):
+                    self._replay_buffer_process.start()
+                affinity.register('buffer', self._replay_buffer_process.pid)
+            else:
+                # created by the update process, see _async_update
+                self._replay_buffer_process = None
         else:
             self._replay_buffer = RadReplayBuffer(
                 image_shape=self._args.image_shape,
                 proprioception_shape=self._args.proprioception_shape,
                 action_shape=self._args.action_shape,
                 capacity=self._args.replay_buffer_capacity,
-                batch_size=self._args.batch_size)
+                batch_size=self._args.batch_size,
+                priority_alpha=self._args.per_alpha,
+                priority_beta=self._args.per_beta,
+                n_step=self._args.n_step,
+                discount=self._args.discount,
+                record=self._args.record_dataset,
+                **self._replay_storage())
+            if buffer_restore is not None:
+                self._replay_buffer.restore(*buffer_restore)
+            elif self._args.seed_dataset:
+                Dataset(self._args.seed_dataset).fill(self._replay_buffer)
 
         if performer == None:
             performer = SACRADPerformer(args)
@@ -140,7 +225,7 @@ class SACRADLearner(BaseLearner):
         self._critic = performer._critic
         self._critic_target = performer._critic_target
 
-        if self._args.load_model > -1:
+        if self._args.load_model > -1 and learner_state is None:
             self._performer.load_policy_from_file(args.model_dir, args.load_model)
 
         self._log_alpha = torch.tensor(np.log(self._args.init_temperature)).to(self._args.device)
@@ -150,19 +235,95 @@ class SACRADLearner(BaseLearner):
 
         self._num_updates = 0
 
+        # mixed precision: forward passes run under autocast, fp16 gradients are scaled
+        if not hasattr(self._args, "amp"):
+            self._args.amp = 'none'
+        assert self._args.amp != 'fp16' or self._args.device.type == 'cuda', "fp16 training needs CUDA, use bf16 on CPU"
+        self._grad_scaler = torch.cuda.amp.GradScaler(enabled=self._args.amp == 'fp16')
+
+        # warm up the update passes at construction, or in the update process in async mode
+        if not hasattr(self._args, "warmup"):
+            self._args.warmup = True
+
         # optimizers
         self._init_optimizers()
         
         self._performer.train()
 
+        self._resumed_step = 0
+        self._resumed_rng = None
+        if learner_state is not None:
+            self._restore_checkpoint(learner_state)
+
+        # created where the checkpoints are written: here, or in the update process in async mode
+        self._checkpoint_writer = None
+
+        self._weights = None
         if self._args.async_mode:
+            # the performer runs the weights the update process publishes, never the ones it writes
+            self._weights = WeightSlabs(self._published_modules())
+            self._performer._weights = self._weights
             self._share_memory()
 
+            self._checkpoints_requested = 0
+            self._checkpoints_saved = ctx.Value('i', 0)
+
             self._update_queue = ctx.Queue(2)
-            self._update_process = ctx.Process(target=self._async_update)
-            self._update_process.start()
+            self._update_processes = [ctx.Process(target=self._async_update, args=(rank,))
+                                      for rank in range(self._args.update_workers)]
+            for update_process in self._update_processes:
+                with affinity.spawn_env(self._args.placement, 'update'):
+                    update_process.start()
+                affinity.register('update', update_process.pid)
+        elif self._args.warmup:
+            warmup.warmup_learner(self, self._args)
+
+    def __getstate__(self):
+        # handed to the update process without the process handles, a started one cannot be pickled
+        state = self.__dict__.copy()
+        state['_replay_buffer_process'] = None
+        state['_update_processes'] = None
+        return state
+
+    def _async_buffer_args(self, placement):
+        return (
+            self._args.image_shape,
+            self._args.proprioception_shape,
+            self._args.action_shape,
+            self._args.replay_buffer_capacity,
+            self._args.batch_size,
+            self._sample_queue,
+            self._minibatch_queue,
+            self._args.init_steps,
+            self._args.max_updates_per_step,
+            self._args.save_buffer_path,
+            self._args.load_buffer_path,
+            self._tracer,
+            self._buffer_restore,
+            self._args.burst_updates_per_step,
+            placement,
+            self._args.per_alpha,
+            self._args.per_beta,
+            self._args.n_step,
+            self._args.discount,
+            self._args.record_dataset,
+            self._args.seed_dataset,
+            self._buffer_closed,
+        )
+
+    def _replay_storage(self):
+        """Storage arguments of the replay buffer for replay_storage, see RadReplayBuffer."""
+        if self._args.replay_storage == 'device':
+            return {'device': self._args.device}
+        if self._args.replay_storage == 'pinned':
+            return {'device': torch.device('cpu'), 'pin_memory': True, 'sample_device': self._args.device}
+        assert self._args.replay_storage == 'numpy', "unknown replay storage {}".format(self._args.replay_storage)
+        return {}
 
     def get_policy(self):
+        return self._read_weights(self._get_policy)
+
+    def _get_policy(self):
         actor_weights = self._actor.state_dict()
         for key in actor_weights:
             actor_weights[key] = actor_weights[key].cpu().numpy()
@@ -195,6 +356,29 @@ class SACRADLearner(BaseLearner):
         self._critic_target.share_memory()
         self._log_alpha.share_memory_()
 
+    def _published_modules(self):
+        """The models of the performer, which the update process publishes."""
+        return [self._actor, self._critic]
+
+    def _read_weights(self, fn, *args):
+        """fn(*args) on one version of the weights, the newest one published in async mode."""
+        if self._weights is None:
+            return fn(*args)
+        return self._weights.read(fn, *args)
+
+    def _checkpoint_objects(self):
+        """The learner state a checkpoint holds, by name."""
+        return {
+            'actor': self._actor,
+            'critic': self._critic,
+            'critic_target': self._critic_target,
+            'log_alpha': self._log_alpha,
+            'actor_optimizer': self._actor_optimizer,
+            'critic_optimizer': self._critic_optimizer,
+            'log_alpha_optimizer': self._log_alpha_optimizer,
+            'grad_scaler': self._grad_scaler,
+        }
+
     def update_policy(self, step):
         if self._args.async_mode:
             try:
@@ -204,45 +388,71 @@ class SACRADLearner(BaseLearner):
 
             return stat
         
-        if step > self._args.init_steps and (step % self._args.update_every == 0):
+        # a resumed learner is past its warmup
+        if step + self._resumed_step > self._args.init_steps and (step % self._args.update_every == 0):
             for _ in range(self._args.update_epochs):
-                stat = self._update(*self._replay_buffer.sample())
+                with tracing.span('replay_sample'):
+                    batch = self._replay_buffer.sample()
+                with tracing.span('update'):
+                    stat = self._update(*batch)
             return stat
         
         return None
     
-    def _update_critic(self, images, proprioceptions, actions, rewards, next_images, next_proprioceptions, dones):
-        with torch.no_grad():
+    def _replay_info(self, info):
+        """The importance weights and bootstrap discounts a replay buffer sample may come with."""
+        if info is None:
+            return None, None
+        return [None if info.get(key) is None else torch.as_tensor(info[key], device=self._args.device)
+                for key in ('weights', 'discounts')]
+
+    def _update_priorities(self, info, td_errors):
+        """Hands the TD errors of a prioritized batch back to the replay buffer."""
+        if info is None or 'idxs' not in info:
+            return
+        # averaged over the augmented copies of each sampled transition
+        td_errors = td_errors.float().reshape(-1, len(info['idxs'])).mean(0).cpu().numpy()
+        if self._replay_buffer is None:  # in the buffer process
+            self._sample_queue.put(('priorities', info, td_errors))
+        else:
+            self._replay_buffer.update_priorities(info, td_errors)
+
+    def _update_critic(self, images, proprioceptions, actions, rewards, next_images, next_proprioceptions, dones, weights=None,
+                       discounts=None):
+        with torch.no_grad(), utils.autocast(self._args.device, self._args.amp):
             _, policy_actions, log_pis, _ = self._actor(next_images, next_proprioceptions)
             target_Q1, target_Q2 = self._critic_target(next_images, next_proprioceptions, policy_actions)
             target_V = torch.min(target_Q1, target_Q2) - self._alpha.detach() * log_pis
+            discount = self._args.discount if discounts is None else discounts
             if self._args.bootstrap_terminal:
                 # enable infinite bootstrap
-                target_Q = rewards + (self._args.discount * target_V)
+                target_Q = rewards + (discount * target_V)
             else:
-                target_Q = rewards + ((1.0 - dones) * self._args.discount * target_V)
+                target_Q = rewards + ((1.0 - dones) * discount * target_V)
 
         # get current Q estimates
-        current_Q1, current_Q2 = self._critic(images, proprioceptions, actions, detach_encoder=False)
+        with utils.autocast(self._args.device, self._args.amp):
+            current_Q1, current_Q2 = self._critic(images, proprioceptions, actions, detach_encoder=False)
 
-        critic_loss = torch.mean((current_Q1 - target_Q) ** 2 + (current_Q2 - target_Q) ** 2)
+        critic_loss, td_errors = utils.critic_loss(current_Q1, current_Q2, target_Q, weights)
 
         # Optimize the critic
         self._critic_optimizer.zero_grad()
-        critic_loss.backward()
+        self._grad_scaler.scale(critic_loss).backward()
         #torch.nn.utils.clip_grad_norm_(self.critic.parameters(), 1)
-        self._critic_optimizer.step()
+        self._grad_scaler.step(self._critic_optimizer)
 
         critic_stats = {
             'train/critic_loss': critic_loss.item()
         }
 
-        return critic_stats
+        return critic_stats, td_errors
 
     def _update_actor_and_alpha(self, images, proprioceptions):
         # detach encoder, so we don't update it with the actor loss
-        _, pis, log_pis, log_stds = self._actor(images, proprioceptions ,detach_encoder=True)
-        actor_Q1, actor_Q2 = self._critic(images, proprioceptions, pis, detach_encoder=True)
+        with utils.autocast(self._args.device, self._args.amp):
+            _, pis, log_pis, log_stds = self._actor(images, proprioceptions, detach_encoder=True)
+            actor_Q1, actor_Q2 = self._critic(images, proprioceptions, pis, detach_encoder=True)
 
         actor_Q = torch.min(actor_Q1, actor_Q2)
         actor_loss = (self._alpha.detach() * log_pis - actor_Q).mean()
@@ -252,8 +462,8 @@ class SACRADLearner(BaseLearner):
 
         # optimize the actor
         self._actor_optimizer.zero_grad()
-        actor_loss.backward()
-        self._actor_optimizer.step()
+        self._grad_scaler.scale(actor_loss).backward()
+        self._grad_scaler.step(self._actor_optimizer)
 
         self._log_alpha_optimizer.zero_grad()
         alpha_loss = (self._alpha *
@@ -283,12 +493,13 @@ class SACRADLearner(BaseLearner):
             self._args.encoder_tau
         )
 
-    def _update(self, images, propris, actions, rewards, next_images, next_propris, dones):
+    def _update(self, images, propris, actions, rewards, next_images, next_propris, dones, info=None):
         tic = time.time()
         # regular update of SAC_RAD, sequentially augment data and train
         if images is not None:
-            images = torch.as_tensor(images, device=self._args.device).float()
-            next_images = torch.as_tensor(next_images, device=self._args.device).float()
+            # images stay uint8 on the way to the encoder, which crops and normalizes them in one pass
+            images = torch.as_tensor(images, device=self._args.device)
+            next_images = torch.as_tensor(next_images, device=self._args.device)
         if propris is not None:
             propris = torch.as_tensor(propris, device=self._args.device).float()
             next_propris = torch.as_tensor(next_propris, device=self._args.device).float()
@@ -296,12 +507,18 @@ class SACRADLearner(BaseLearner):
         rewards = torch.as_tensor(rewards, device=self._args.device)
         dones = torch.as_tensor(dones, device=self._args.device)
         
-        stats = self._update_critic(images, propris, actions, rewards, next_images, next_propris, dones)
+        # importance weights of prioritized replay, bootstrap discounts of n-step returns
+        weights, discounts = self._replay_info(info)
+
+        stats, td_errors = self._update_critic(images, propris, actions, rewards, next_images, next_propris, dones, weights,
+                                               discounts)
+        self._update_priorities(info, td_errors)
         if self._num_updates % self._args.actor_update_freq == 0:
             actor_stats = self._update_actor_and_alpha(images, propris)
             stats = {**stats, **actor_stats}
         if self._num_updates % self._args.critic_target_update_freq == 0:
             self._soft_update_target()
+        self._grad_scaler.update()
         stats['train/batch_reward'] = rewards.mean().item()
         stats['train/num_updates'] = self._num_updates
         self._num_updates += 1
@@ -310,10 +527,39 @@ class SACRADLearner(BaseLearner):
         
         return stats
         
-    def _async_update(self):
+    def _async_update(self, rank=0):
+        affinity.apply(self._args.placement, 'update')
+        # the spawned models still share their tensors with the performer, train copies of them
+        for module in self._published_modules():
+            data_parallel.privatize(module)
+        if self._args.update_workers > 1:
+            data_parallel.setup(self, rank, self._args.update_workers, self._data_parallel_address)
+        tracing.set_tracer(self._tracer)
+        if self._resumed_rng is not None:
+            checkpoint.set_rng_state(self._resumed_rng)
+        if self._args.warmup:
+            warmup.warmup_learner(self, self._args)
+        if self._args.replay_storage != 'numpy':
+            # the buffer samples on the device and hands the batches over in this process, nothing
+            # is pickled or uploaded; its sampling thread keeps the next two ready
+            self._minibatch_queue = queue.Queue(2)
+            self._replay_buffer = AsyncRadReplayBuffer(*self._async_buffer_args(''), **self._replay_storage())
+        minibatch_queue = self._minibatch_queue
+        if self._args.update_workers > 1:  # the shards of this worker
+            minibatch_queue = minibatch_queue[rank]
         while True:
+            batch = minibatch_queue.get()
+            if isinstance(batch[0], str):  # ('checkpoint', model_dir, step, buffer manifest)
+                self._write_checkpoint(*batch[1:])
+                continue
             try:
-                self._update_queue.put_nowait(self._update(*self._minibatch_queue.get()))
+                with tracing.span('update'):
+                    stat = self._update(*batch)
+                if rank == 0:
+                    if self._num_updates % self._args.publish_every == 0:
+                        with tracing.span('publish_weights'):
+                            self._weights.publish(self._published_modules())
+                    self._update_queue.put_nowait(stat)
             except queue.Full:
                 pass
 
@@ -337,30 +583,86 @@ class SACRADLearner(BaseLearner):
     def resume_update(self):
         if self._args.async_mode:
             self._sample_queue.put('resume')
+
+    def begin_reset(self):
+        """The env is resetting: the n-step returns stop at the last sample, and the idle time goes to
+        extra updates, up to burst_updates_per_step. Only the async mode can, the sync updates run in
+        the thread waiting on the reset."""
+        if self._args.async_mode:
+            self._sample_queue.put('begin reset')
+        else:
+            self._replay_buffer.mark_episode_end()
+
+    def end_reset(self):
+        if self._args.async_mode:
+            self._sample_queue.put('end reset')
     
     def flush_buffer(self):
         if self._args.async_mode:
             self._sample_queue.put('flush')
 
     def save_policy_to_file(self, model_dir, step):
+        self._read_weights(self._save_policy, model_dir, step)
+        self.save_checkpoint(model_dir, step)
+
+    def _save_policy(self, model_dir, step):
         torch.save(self._actor.state_dict(), '%s/actor_%s.pt' % (model_dir, step))
         torch.save(self._critic.state_dict(), '%s/critic_%s.pt' % (model_dir, step))
-        # torch.save(self._actor_optimizer.state_dict(), '%s/_actor_optimizer_%s.pt' % (model_dir, step))
-        # torch.save(self._critic_optimizer.state_dict(), '%s/_critic_optimizer_%s.pt' % (model_dir, step))
-        # torch.save(self._log_alpha_optimizer.state_dict(), '%s/_log_alpha_optimizer_%s.pt' % (model_dir, step))
+
+    def save_checkpoint(self, model_dir, step):
+        """Saves the full learner state and a snapshot of the replay buffer in the background."""
+        if self._args.async_mode:
+            # the buffer process snapshots the buffer, then the update process, which holds the
+            # optimizers and the update count, writes the rest
+            self._checkpoints_requested += 1
+            self._sample_queue.put(('checkpoint', model_dir, step, checkpoint.buffer_dir(model_dir)))
+        else:
+            if self._checkpoint_writer is None:
+                self._checkpoint_writer = checkpoint.CheckpointWriter()
+            self._checkpoint_writer.write(model_dir, step, self._capture_checkpoint(step),
+                                          replay_buffer=self._replay_buffer)
+
+    def _write_checkpoint(self, model_dir, step, buffer_manifest):
+        if self._checkpoint_writer is None:
+            self._checkpoint_writer = checkpoint.CheckpointWriter(self._checkpoints_saved)
+        self._checkpoint_writer.write(model_dir, step, self._capture_checkpoint(step), buffer_manifest)
+
+    def _capture_checkpoint(self, step):
+        return checkpoint.capture(self._checkpoint_objects(), self._num_updates, step)
+
+    def _restore_checkpoint(self, state):
+        checkpoint.restore(self._checkpoint_objects(), state)
+        self._num_updates = state['num_updates']
+        self._resumed_step = state['step']
+        checkpoint.set_rng_state(state['rng'])
+        self._resumed_rng = state['rng']  # for the async update process
+        print('Resumed the learner at step {} after {} updates'.format(state['step'], state['num_updates']))
 
     def load_policy_from_file(self, model_dir, step):
         self._performer.load_policy_from_file(model_dir, step)
-        # self._actor_optimizer.load_state_dict(torch.load('%s/_actor_optimizer_%s.pt' % (model_dir, step)))
-        # self._critic_optimizer.load_state_dict(torch.load('%s/_critic_optimizer_%s.pt' % (model_dir, step)))
-        # self._log_alpha_optimizer.load_state_dict(torch.load('%s/_log_alpha_optimizer_%s.pt' % (model_dir, step)))
 
     def close(self):
         if self._args.async_mode:
-            self._replay_buffer_process.terminate()
-            self._update_process.terminate()
-            self._replay_buffer_process.join()
-            self._update_process.join()
+            # let the update process finish writing the checkpoints
+            deadline = time.time() + 600
+            while self._checkpoints_saved.value < self._checkpoints_requested and time.time() < deadline:
+                time.sleep(0.1)
+            # the buffer writes out the samples it is recording before it is stopped
+            self._sample_queue.put('close')
+            if not self._buffer_closed.wait(60):
+                print('The replay buffer did not close in time, its recording may miss the last samples')
+            if self._replay_buffer_process is not None:
+                self._replay_buffer_process.terminate()
+            for update_process in self._update_processes:
+                update_process.terminate()
+            if self._replay_buffer_process is not None:
+                self._replay_buffer_process.join()
+            for update_process in self._update_processes:
+                update_process.join()
+        else:
+            self._replay_buffer.close()
+            if self._checkpoint_writer is not None:
+                self._checkpoint_writer.wait()
 
         del self
 
@@ -1,14 +1,81 @@
-from email.mime import image
 import threading
 import time
 import pickle
 import os
+import uuid
 import numpy as np
+import relod.tracing as tracing
+import relod.affinity as affinity
+from relod.algo.dataset import Dataset, DatasetWriter
+
+
+class SumTree(object):
+    """Binary tree of sums over capacity leaves, in one array: node i has the children 2i and 2i+1
+    and the leaves start at index self._leaves. Updates and searches take a batch of leaves at once
+    and walk the log2(capacity) levels with vectorized numpy ops.
+    """
+    def __init__(self, capacity):
+        self._leaves = 1 << int(np.ceil(np.log2(max(capacity, 1))))
+        self._tree = np.zeros(2 * self._leaves, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self._tree[1]
+
+    def __getitem__(self, idxs):
+        return self._tree[np.asarray(idxs) + self._leaves]
+
+    def update(self, idxs, values):
+        nodes = np.asarray(idxs) + self._leaves
+        self._tree[nodes] = values
+        # the leaves are all on the last level, so the parents of a level are one level up
+        nodes = np.unique(nodes // 2)
+        while nodes[0] > 0:
+            self._tree[nodes] = self._tree[2 * nodes] + self._tree[2 * nodes + 1]
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values):
+        """Leaf of each value, the first whose prefix sum exceeds it."""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while self._leaves > 1 and nodes[0] < self._leaves:
+            left = 2 * nodes
+            right = values >= self._tree[left]
+            values = np.where(right, values - self._tree[left], values)
+            nodes = np.where(right, left + 1, left)
+        return nodes - self._leaves
+
+    def clear(self):
+        self._tree[:] = 0
 
 
 class RadReplayBuffer(object):
-    """Buffer to store environment transitions."""
-    def __init__(self, image_shape, proprioception_shape, action_shape, capacity, batch_size):
+    """Buffer to store environment transitions.
+
+    With priority_alpha > 0 it is a prioritized replay buffer (Schaul et al., 2016): transitions
+    are sampled with probability p_i^alpha / sum_k p_k^alpha from a SumTree, one per stratum of
+    the total, new ones with the highest priority seen. sample() then returns an 8th element, the
+    info dict with the buffer positions and importance weights (N * P(i))^-beta / max_j w_j of the
+    batch, and the learner hands it back to update_priorities() with the TD errors.
+
+    With n_step > 1 the rewards are the discounted sums over the next n_step rows, up to the end
+    of the episode or the newest row, and the next observations and dones are those of the last
+    row summed, computed at sample time from the circular storage. The info dict then holds the
+    discount of each bootstrap, discount^k for k rows summed. The episode ends are the dones and
+    the timeouts marked with mark_episode_end(); the rows must come from one env in order.
+
+    With a device the rows live as torch tensors there, the learner GPU or, with pin_memory, page
+    locked host memory: add() uploads one transition, and sample() draws the batch with torch.randint
+    and index_select, returning tensors on sample_device (default device) the update uses as they
+    are. The index arithmetic of prioritized and n-step sampling stays on the host, with host copies
+    of the rewards and the episode ends.
+
+    With record, the transitions added are also appended to the dataset in that directory, see
+    relod.algo.dataset; extend() adds the rows of a dataset back.
+    """
+    def __init__(self, image_shape, proprioception_shape, action_shape, capacity, batch_size,
+                 priority_alpha=0.0, priority_beta=0.4, priority_eps=1e-6, n_step=1, discount=0.99,
+                 device=None, pin_memory=False, sample_device=None, record=''):
         self.image_shape = image_shape
         self.proprioception_shape = proprioception_shape
         self.action_shape = action_shape
@@ -16,108 +83,419 @@ class RadReplayBuffer(object):
         self.capacity = capacity
         self.batch_size = batch_size
 
+        self.device = device
+        self.pin_memory = pin_memory
+        self.sample_device = device if sample_device is None else sample_device
+        self._allocate()
+
+        self.idx = 0
+        self.last_save = 0
+        self.full = False
+        self.count = 0
+
+        # rows are numbered from the last flush, row n sits at n % capacity
+        self.num_added = 0
+        self.flushes = 0
+        self._lock = threading.RLock()
+        self._snapshot_lock = threading.Lock()
+        self._chunks = []           # (file, first row, end row) of the snapshot chunks
+        self._saved_first = 0       # rows [_saved_first, last_save) are all in the chunks
+        self._obsolete = []         # chunks to delete once a newer snapshot is committed
+
+        self.priority_alpha = priority_alpha
+        self.priority_beta = priority_beta
+        self.priority_eps = priority_eps
+        self._priorities = SumTree(capacity) if priority_alpha > 0 else None
+        self._max_priority = 1.0    # of the tree, to the alpha already
+
+        self.n_step = n_step
+        self.discount = discount
+
+        self._recorder = None
+        if record:
+            self._recorder = DatasetWriter(record, image_shape, proprioception_shape, action_shape)
+
+    def _allocate(self):
         # the proprioceptive obs is stored as float32, pixels obs as uint8
         self.ignore_image = True
         self.ignore_propri = True
 
-        if image_shape[-1] != 0:
-            self.images = np.empty((capacity, *image_shape), dtype=np.uint8)
-            self.next_images = np.empty((capacity, *image_shape), dtype=np.uint8)
+        if self.image_shape[-1] != 0:
+            self.images = self._empty(self.image_shape, np.uint8)
+            self.next_images = self._empty(self.image_shape, np.uint8)
             self.ignore_image = False
 
-        if proprioception_shape[-1] != 0:
-            self.propris = np.empty((capacity, *proprioception_shape), dtype=np.float32)
-            self.next_propris = np.empty((capacity, *proprioception_shape), dtype=np.float32)
+        if self.proprioception_shape[-1] != 0:
+            self.propris = self._empty(self.proprioception_shape, np.float32)
+            self.next_propris = self._empty(self.proprioception_shape, np.float32)
             self.ignore_propri = False
 
-        self.actions = np.empty((capacity, *action_shape), dtype=np.float32)
-        self.rewards = np.empty((capacity, 1), dtype=np.float32)
-        self.dones = np.empty((capacity, 1), dtype=np.float32)
+        self.actions = self._empty(self.action_shape, np.float32)
+        self.rewards = self._empty((1,), np.float32)
+        self.dones = self._empty((1,), np.float32)
+        self.ends = self._empty((1,), np.bool_)  # done or timeout
 
-        self.idx = 0
-        self.last_save = 0
-        self.full = False
-        self.count = 0
+        # read by the index arithmetic
+        if self.device is None:
+            self._host_rewards, self._host_ends = self.rewards, self.ends
+        else:
+            self._host_rewards = np.empty((self.capacity, 1), dtype=np.float32)
+            self._host_ends = np.empty((self.capacity, 1), dtype=np.bool_)
+
+    def _empty(self, shape, dtype):
+        shape = (self.capacity, *shape)
+        if self.device is None:
+            return np.empty(shape, dtype=dtype)
+        import torch
+        dtype = torch.from_numpy(np.empty(0, dtype=dtype)).dtype
+        return torch.empty(shape, dtype=dtype, device=self.device, pin_memory=self.pin_memory)
+
+    def _write(self, field, positions, values):
+        """Stores values at positions, an index or an array of them, of field."""
+        array = getattr(self, field)
+        if self.device is not None:
+            if field == 'rewards':
+                self._host_rewards[positions] = values
+            elif field == 'ends':
+                self._host_ends[positions] = values
+            import torch
+            if not isinstance(positions, int):
+                positions = torch.as_tensor(positions, device=self.device)
+            values = torch.as_tensor(np.ascontiguousarray(values)).to(self.device, array.dtype)
+        array[positions] = values
+
+    def _read(self, field, positions):
+        """The rows at positions of field, as a numpy array."""
+        array = getattr(self, field)
+        if self.device is None:
+            return array[positions]
+        import torch
+        return array[torch.as_tensor(positions, device=self.device)].cpu().numpy()
+
+    def _numpy(self, field):
+        array = getattr(self, field)
+        return array if self.device is None else array.cpu().numpy()
+
+    def _take(self, field, idxs):
+        """The rows idxs of field for a batch, on sample_device."""
+        array = getattr(self, field)
+        if self.device is None:
+            return array[idxs]
+        if self.sample_device == self.device:
+            return array.index_select(0, idxs)
+        # gathered to page locked memory, then copied without blocking
+        import torch
+        batch = torch.empty((len(idxs), *array.shape[1:]), dtype=array.dtype, pin_memory=True)
+        return torch.index_select(array, 0, idxs, out=batch).to(self.sample_device, non_blocking=True)
 
     def add(self, image, propri, action, reward, next_image, next_propri, done):
-        if not self.ignore_image:
-            self.images[self.idx] = image
-            self.next_images[self.idx] = next_image
-        if not self.ignore_propri:
-            self.propris[self.idx]= propri
-            self.next_propris[self.idx]= next_propri
-        self.actions[self.idx]= action
-        self.rewards[self.idx]= reward
-        self.dones[self.idx]= done
+        with self._lock:
+            if not self.ignore_image:
+                self._write('images', self.idx, image)
+                self._write('next_images', self.idx, next_image)
+            if not self.ignore_propri:
+                self._write('propris', self.idx, propri)
+                self._write('next_propris', self.idx, next_propri)
+            self._write('actions', self.idx, action)
+            self._write('rewards', self.idx, reward)
+            self._write('dones', self.idx, done)
+            self._write('ends', self.idx, done)
+            if self._priorities is not None:
+                self._priorities.update([self.idx], self._max_priority)
 
-        self.idx = (self.idx + 1) % self.capacity
-        self.full = self.full or self.idx == 0
-        self.count = self.capacity if self.full else self.idx
+            self.idx = (self.idx + 1) % self.capacity
+            self.full = self.full or self.idx == 0
+            self.count = self.capacity if self.full else self.idx
+            self.num_added += 1
+        if self._recorder is not None:
+            self._recorder.add(image, propri, action, reward, next_image, next_propri, done)
+
+    def extend(self, images, propris, actions, rewards, next_images, next_propris, dones, ends=None):
+        """Adds a batch of rows at once, e.g. read from a dataset; only the newest capacity rows are
+        kept. The episode ends default to the dones."""
+        columns = {
+            'images': images,
+            'next_images': next_images,
+            'propris': propris,
+            'next_propris': next_propris,
+            'actions': actions,
+            'rewards': rewards,
+            'dones': dones,
+            'ends': np.asarray(dones, dtype=np.bool_) if ends is None else ends,
+        }
+        n = len(actions)
+        skip = max(0, n - self.capacity)
+        with self._lock:
+            positions = (self.idx + np.arange(skip, n)) % self.capacity
+            for field in self._fields():
+                assert columns[field] is not None, 'no {} to add to the buffer'.format(field)
+                self._write(field, positions, np.asarray(columns[field])[skip:])
+            if self._priorities is not None:
+                self._priorities.update(positions, self._max_priority)
+
+            self.full = self.full or self.idx + n >= self.capacity
+            self.idx = (self.idx + n) % self.capacity
+            self.count = self.capacity if self.full else self.idx
+            self.num_added += n
 
     def sample(self):
-        idxs = np.random.randint(
-            0, self.count, size=min(self.count, self.batch_size)
-        )
+        with self._lock:
+            info = {}
+            if self._priorities is not None:
+                idxs, info = self._sample_prioritized()
+            elif self.device is not None and self.n_step == 1:
+                import torch
+                idxs = torch.randint(self.count, (min(self.count, self.batch_size),), device=self.device)
+            else:
+                idxs = np.random.randint(
+                    0, self.count, size=min(self.count, self.batch_size)
+                )
+
+            if self.n_step == 1:
+                batch = self._gather(idxs)
+            else:
+                last, rewards, info['discounts'] = self._n_step(idxs)
+                images, propris, actions, _, next_images, next_propris, dones = self._gather(idxs, last)
+                batch = images, propris, actions, rewards, next_images, next_propris, dones
+
+            return batch + (info,) if info else batch
+
+    def _sample_prioritized(self):
+        count = self.count
+        n = min(count, self.batch_size)
+        total = self._priorities.total
+        # one sample per stratum of the total
+        values = (np.arange(n) + np.random.uniform(size=n)) * (total / n)
+        # rounding can step past the last stored row, which has a zero priority
+        idxs = np.minimum(self._priorities.find(values), count - 1)
+        probs = self._priorities[idxs] / total
+        weights = (count * probs) ** -self.priority_beta
+        return idxs, {
+            'idxs': idxs,
+            'weights': (weights / weights.max()).astype(np.float32).reshape(-1, 1),
+            'num_added': self.num_added,
+            'flushes': self.flushes,
+        }
+
+    def _n_step(self, idxs):
+        """Last row, discounted reward sum and bootstrap discount of the n-step return of each row."""
+        steps = np.arange(self.n_step)
+        rows = (idxs[:, None] + steps) % self.capacity            # (batch, n_step)
+        newer = (self.idx - 1 - idxs) % self.capacity              # rows added after each one
+        ends = self._host_ends[rows, 0]
+        # a prefix of the rows: stored already, and no episode end before
+        summed = (steps <= newer[:, None]) & (np.cumsum(ends, axis=1) - ends == 0)
+        lengths = summed.sum(axis=1)
+
+        rewards = (self._host_rewards[rows, 0] * self.discount ** steps * summed).sum(axis=1)
+        last = rows[np.arange(len(idxs)), lengths - 1]
+        discounts = self.discount ** lengths
+        return last, rewards.astype(np.float32).reshape(-1, 1), discounts.astype(np.float32).reshape(-1, 1)
+
+    def mark_episode_end(self):
+        """The last row ends an episode without a done, a timeout: n-step returns stop there."""
+        with self._lock:
+            if self.count > 0:
+                self._write('ends', (self.idx - 1) % self.capacity, True)
+        if self._recorder is not None:
+            self._recorder.end_episode()
+
+    def close(self):
+        """Waits for the recording to be written."""
+        if self._recorder is not None:
+            self._recorder.close()
+
+    def update_priorities(self, info, td_errors):
+        """Sets the priorities of a batch sampled with its info, from the absolute TD errors."""
+        with self._lock:
+            if self._priorities is None or info['flushes'] != self.flushes:
+                return
+            idxs, td_errors = info['idxs'], np.asarray(td_errors).reshape(-1)
+            # rows overwritten since the batch was sampled keep the priority of the new sample
+            fresh = (idxs - info['num_added']) % self.capacity >= self.num_added - info['num_added']
+            if not fresh.any():
+                return
+            priorities = (np.abs(td_errors[fresh]) + self.priority_eps) ** self.priority_alpha
+            self._priorities.update(idxs[fresh], priorities)
+            self._max_priority = max(self._max_priority, priorities.max())
+
+    def _reset_priorities(self):
+        """Restored rows have no TD errors yet, they start at the highest priority."""
+        if self._priorities is not None:
+            self._priorities.clear()
+            self._max_priority = 1.0
+            if self.count > 0:
+                self._priorities.update(np.arange(self.count), self._max_priority)
+
+    def _gather(self, idxs, last=None):
+        """The rows idxs, with the next observations and dones of the rows last (default idxs)."""
+        last = idxs if last is None else last
+        if self.device is not None:
+            import torch
+            idxs = torch.as_tensor(idxs, device=self.device)
+            last = torch.as_tensor(last, device=self.device)
+
         if self.ignore_image:
             images = None
             next_images = None
         else:
-            images = self.images[idxs]
-            next_images = self.next_images[idxs]
+            images = self._take('images', idxs)
+            next_images = self._take('next_images', last)
             
         if self.ignore_propri:
             propris = None
             next_propris = None
         else:
-            propris = self.propris[idxs]
-            next_propris = self.next_propris[idxs]
+            propris = self._take('propris', idxs)
+            next_propris = self._take('next_propris', last)
         
-        actions = self.actions[idxs]
-        rewards = self.rewards[idxs]
-        dones = self.dones[idxs]
+        actions = self._take('actions', idxs)
+        rewards = self._take('rewards', idxs)
+        dones = self._take('dones', last)
 
         return images, propris, actions, rewards, next_images, next_propris, dones
     
     def flush(self):
-        if self.image_shape[-1] != 0:
-            self.images = np.empty((self.capacity, *self.image_shape), dtype=np.uint8)
-            self.next_images = np.empty((self.capacity, *self.image_shape), dtype=np.uint8)
-            self.ignore_image = False
-
-        if self.proprioception_shape[-1] != 0:
-            self.propris = np.empty((self.capacity, *self.proprioception_shape), dtype=np.float32)
-            self.next_propris = np.empty((self.capacity, *self.proprioception_shape), dtype=np.float32)
-            self.ignore_propri = False
+        with self._lock:
+            # the device rows are reused rather than held twice, rows are written before being read
+            if self.device is None:
+                self._allocate()
 
-        self.actions = np.empty((self.capacity, *self.action_shape), dtype=np.float32)
-        self.rewards = np.empty((self.capacity, 1), dtype=np.float32)
-        self.dones = np.empty((self.capacity, 1), dtype=np.float32)
+            self.idx = 0
+            self.last_save = 0
+            self.full = False
+            self.count = 0
 
-        self.idx = 0
-        self.last_save = 0
-        self.full = False
-        self.count = 0
+            self.num_added = 0
+            self.flushes += 1
+            self._obsolete += [name for name, _, _ in self._chunks]
+            self._chunks = []
+            self._saved_first = 0
+            self._reset_priorities()
         print("Buffer flushed. Waiting for samples...")
 
+    def _fields(self):
+        fields = []
+        if not self.ignore_image:
+            fields += ['images', 'next_images']
+        if not self.ignore_propri:
+            fields += ['propris', 'next_propris']
+        return fields + ['actions', 'rewards', 'dones', 'ends']
+
+    def snapshot(self, directory, chunk_rows=256):
+        """Writes the rows added since the previous snapshot to chunk files in directory and returns
+        the manifest restore() takes. Rows are copied under the lock a chunk at a time, so samples keep
+        coming in meanwhile; the oldest rows overwritten before being copied are left out.
+        Returns None when the buffer is flushed while writing.
+        """
+        with self._snapshot_lock:
+            with self._lock:
+                first = max(self.last_save, self.num_added - self.capacity)
+                last = self.num_added
+                self.last_save = last
+                flushes = self.flushes
+
+            os.makedirs(directory, exist_ok=True)
+            for start in range(first, last, chunk_rows):
+                end = min(start + chunk_rows, last)
+                with self._lock:
+                    if self.flushes != flushes:
+                        return None
+                    # rows overwritten before being copied are lost, the chunks start after them
+                    oldest = max(start, self.num_added - self.capacity)
+                    if oldest >= end:
+                        self._saved_first = end
+                        continue
+                    if oldest > start:
+                        self._saved_first = oldest
+                    start = oldest
+                    positions = np.arange(start, end) % self.capacity
+                    arrays = {field: self._read(field, positions) for field in self._fields()}
+
+                # row numbers restart after a flush or a restore, the names never repeat
+                name = 'chunk_{}.npz'.format(uuid.uuid4().hex)
+                _save_atomic(os.path.join(directory, name), arrays)
+                with self._lock:
+                    self._chunks.append((name, start, end))
+
+            with self._lock:
+                if self.flushes != flushes:
+                    return None
+                first = max(self._saved_first, last - self.capacity)
+                obsolete = self._obsolete + [name for name, _, end in self._chunks if end <= first]
+                self._chunks = [chunk for chunk in self._chunks if chunk[2] > first]
+                self._obsolete = []
+                return {
+                    'first': first,
+                    'last': last,
+                    'chunks': list(self._chunks),
+                    'obsolete': obsolete,
+                }
+
+    def restore(self, directory, manifest):
+        """Loads a snapshot, renumbering its rows from 0."""
+        tic = time.time()
+        first, last = manifest['first'], manifest['last']
+        with self._lock:
+            chunks = []
+            for name, start, end in manifest['chunks']:
+                lo = max(start, first)
+                positions = (np.arange(lo, end) - first) % self.capacity
+                with np.load(os.path.join(directory, name)) as data:
+                    for field in self._fields():
+                        # snapshots from before the episode ends were stored end on the dones only
+                        source = field if field in data.files or field != 'ends' else 'dones'
+                        self._write(field, positions, data[source][lo-start:])
+                chunks.append((name, start-first, end-first))
+
+            self.num_added = last - first
+            self.idx = self.num_added % self.capacity
+            self.full = self.num_added >= self.capacity
+            self.count = self.capacity if self.full else self.idx
+            self.last_save = self.num_added
+            self._saved_first = 0
+            self._chunks = chunks
+            self._reset_priorities()
+        print("Restored {} samples from {} in {:.3f}s".format(self.count, directory, time.time()-tic))
+
 
 
 class AsyncRadReplayBuffer(RadReplayBuffer):
+    """Runs in its own process: takes the samples and commands from sample_queue, and puts the
+    minibatches on minibatch_queue while the update budget allows. With a list of queues, one per
+    data-parallel update worker, each minibatch is split into a shard per queue.
+    """
     def __init__(self, image_shape, proprioception_shape, action_shape, capacity, batch_size,
-                 sample_queue, minibatch_queue, init_steps, max_updates_per_step, savepath='', loadpath=''):
-        super(AsyncRadReplayBuffer, self).__init__(image_shape, proprioception_shape, action_shape, capacity, batch_size)
+                 sample_queue, minibatch_queue, init_steps, max_updates_per_step, savepath='', loadpath='', tracer=None, restore=None,
+                 burst_updates_per_step=0, placement='', priority_alpha=0.0, priority_beta=0.4, n_step=1, discount=0.99,
+                 record_dataset='', seed_dataset='', closed=None, **storage):
+        affinity.apply(placement, 'buffer')
+        super(AsyncRadReplayBuffer, self).__init__(image_shape, proprioception_shape, action_shape, capacity, batch_size,
+                                                   priority_alpha, priority_beta, n_step=n_step, discount=discount,
+                                                   record=record_dataset, **storage)
+        tracing.set_tracer(tracer)
         self.init_steps = init_steps
         self.step = 0
         self.send_count = 0
         self.max_updates_per_step = max_updates_per_step
+        # while the env resets, extra updates are sent until all the updates reach this many per step
+        self.burst_updates_per_step = burst_updates_per_step
+        self.burst_count = 0
+        self._reset = False
+        self._reset_burst = 0   # burst_count when the reset began
         self.sample_queue = sample_queue
         self.minibatch_queue = minibatch_queue
         self._pause_update = False
         self.savepath = savepath
         self.loadpath = loadpath
-        self._lock = threading.Lock()
+        self._closed = closed   # set once 'close' has written out the recording
 
         if loadpath:
             self.load()
+        if restore is not None:
+            self.restore(*restore)
+        elif seed_dataset:
+            Dataset(seed_dataset).fill(self)
 
         self.start_thread()
 
@@ -139,6 +517,26 @@ class AsyncRadReplayBuffer(RadReplayBuffer):
                     self.save()
                 elif sample == 'flush':
                     self.flush()             
+                elif sample == 'begin reset':
+                    self.mark_episode_end()
+                    self._reset = True
+                    self._reset_burst = self.burst_count
+                elif sample == 'end reset':
+                    if self._reset and self.burst_updates_per_step > 0:
+                        print('reset burst: {} updates'.format(self.burst_count - self._reset_burst))
+                    self._reset = False
+                elif sample == 'close':
+                    self.close()
+                    if self._closed is not None:
+                        self._closed.set()
+                    return
+                else:
+                    raise NotImplementedError()
+            elif isinstance(sample[0], str):
+                if sample[0] == 'checkpoint':
+                    threading.Thread(target=self.checkpoint, args=sample[1:]).start()
+                elif sample[0] == 'priorities':  # (info, TD errors) from the update process
+                    self.update_priorities(*sample[1:])
                 else:
                     raise NotImplementedError()
             else:
@@ -148,12 +546,54 @@ class AsyncRadReplayBuffer(RadReplayBuffer):
 
     def send_to_update(self):
         while True:
-            if self._pause_update or (self.send_count > (self.step - self.init_steps) * self.max_updates_per_step) or \
-                self.count < self.batch_size:
+            budget = self._budget()
+            if self._pause_update or self.count < self.batch_size or budget is None:
                 time.sleep(0.1)
             else:
-                self.minibatch_queue.put(tuple(self.sample()))
-                self.send_count += 1
+                with tracing.span('replay_sample'):
+                    minibatch = tuple(self.sample())
+                if isinstance(self.minibatch_queue, list):
+                    for rank, minibatch_queue in enumerate(self.minibatch_queue):
+                        minibatch_queue.put(_shard(minibatch, rank, len(self.minibatch_queue)))
+                else:
+                    self.minibatch_queue.put(minibatch)
+                if budget == 'burst':
+                    self.burst_count += 1
+                else:
+                    self.send_count += 1
+
+    def _budget(self):
+        """Which budget the next update comes from: 'regular', 'burst' or None when both are spent.
+        The burst updates come on top of the regular ones, which keep their own count."""
+        steps = self.step - self.init_steps
+        if self.send_count <= steps * self.max_updates_per_step:
+            return 'regular'
+        if self._reset and self.send_count + self.burst_count < steps * self.burst_updates_per_step:
+            return 'burst'
+        return None
+
+    def snapshot(self, directory, chunk_rows=256):
+        manifest = super(AsyncRadReplayBuffer, self).snapshot(directory, chunk_rows)
+        if manifest is not None:
+            manifest['step'] = self.step
+            manifest['send_count'] = self.send_count
+            manifest['burst_count'] = self.burst_count
+        return manifest
+
+    def restore(self, directory, manifest):
+        super(AsyncRadReplayBuffer, self).restore(directory, manifest)
+        # carry on past the warmup, at the same update to sample ratio
+        self.step = manifest.get('step', self.num_added)
+        self.send_count = manifest.get('send_count', max(0, (self.step - self.init_steps) * self.max_updates_per_step))
+        self.burst_count = manifest.get('burst_count', 0)
+
+    def checkpoint(self, model_dir, step, directory):
+        """Snapshots the buffer to directory and hands the manifest to the update process, which
+        saves the rest of the checkpoint."""
+        manifest = self.snapshot(directory)
+        # written by the first data-parallel worker
+        minibatch_queue = self.minibatch_queue[0] if isinstance(self.minibatch_queue, list) else self.minibatch_queue
+        minibatch_queue.put(('checkpoint', model_dir, step, manifest))
 
     def save(self):
         if self.savepath:
@@ -172,19 +612,19 @@ class AsyncRadReplayBuffer(RadReplayBuffer):
             
             # Sleep from time to time to release lock and get more data into the buffer
             with self._lock:
-                np.save(os.path.join(self.savepath, "images.npy"), self.images)
+                np.save(os.path.join(self.savepath, "images.npy"), self._numpy('images'))
             time.sleep(0.1)
             
             with self._lock:
-                np.save(os.path.join(self.savepath, "next_images.npy"), self.next_images)
+                np.save(os.path.join(self.savepath, "next_images.npy"), self._numpy('next_images'))
             time.sleep(0.1)
 
             with self._lock:
-                np.save(os.path.join(self.savepath, "propris.npy"), self.propris)
-                np.save(os.path.join(self.savepath, "next_propris.npy"), self.next_propris)
-                np.save(os.path.join(self.savepath, "actions.npy"), self.actions)
-                np.save(os.path.join(self.savepath, "rewards.npy"), self.rewards)
-                np.save(os.path.join(self.savepath, "dones.npy"), self.dones)
+                np.save(os.path.join(self.savepath, "propris.npy"), self._numpy('propris'))
+                np.save(os.path.join(self.savepath, "next_propris.npy"), self._numpy('next_propris'))
+                np.save(os.path.join(self.savepath, "actions.npy"), self._numpy('actions'))
+                np.save(os.path.join(self.savepath, "rewards.npy"), self._numpy('rewards'))
+                np.save(os.path.join(self.savepath, "dones.npy"), self._numpy('dones'))
 
             print("Saved the buffer locally!")
             print("Took: {:.3f}s".format(time.time()-tic))
@@ -197,14 +637,44 @@ class AsyncRadReplayBuffer(RadReplayBuffer):
         self.step = data['step']
         self.count = data['count']
         self.idx = data['idx']
+        self.full = self.count == self.capacity
+        self.num_added = self.count + self.idx if self.full else self.idx
 
-        self.images = np.load(os.path.join(self.loadpath, "images.npy"))
-        self.next_images = np.load(os.path.join(self.loadpath, "next_images.npy"))
-        self.propris = np.load(os.path.join(self.loadpath, "propris.npy"))
-        self.next_propris = np.load(os.path.join(self.loadpath, "next_propris.npy"))
-        self.actions = np.load(os.path.join(self.loadpath, "actions.npy"))
-        self.rewards = np.load(os.path.join(self.loadpath, "rewards.npy"))
-        self.dones = np.load(os.path.join(self.loadpath, "dones.npy"))
+        arrays = {}
+        for field in ['images', 'next_images', 'propris', 'next_propris', 'actions', 'rewards', 'dones']:
+            arrays[field] = np.load(os.path.join(self.loadpath, field + ".npy"))
+        arrays['ends'] = arrays['dones'].astype(np.bool_)
+        if self.device is None:
+            for field, array in arrays.items():
+                setattr(self, field, array)
+            self._host_rewards, self._host_ends = self.rewards, self.ends
+        else:
+            for field, array in arrays.items():
+                self._write(field, np.arange(len(array)), array)
+        self._reset_priorities()
         
         print("Loaded the buffer from: {}".format(self.loadpath))
         print("Took: {:.3f}s".format(time.time()-tic))
+
+
+def _shard(minibatch, rank, shards):
+    """Rows rank, rank + shards, ... of a minibatch, its info dict included."""
+    batch_size = len(minibatch[2])  # the actions are always there
+    shard = []
+    for item in minibatch:
+        if isinstance(item, dict):
+            item = {key: value[rank::shards] if isinstance(value, np.ndarray) and len(value) == batch_size else value
+                    for key, value in item.items()}
+        elif item is not None:
+            item = item[rank::shards]
+        shard.append(item)
+    return tuple(shard)
+
+
+def _save_atomic(path, arrays):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
@@ -1,11 +1,12 @@
+import math
 import time
 import random
 import torch
 import torch.nn.functional as F
-from captum.attr import GuidedBackprop
+import relod.utils as utils
 from relod.algo.sac_rad_agent import SACRADLearner, SACRADPerformer
 from relod.augmentations import strong_augment
-from relod.algo.models import AttributionPredictor, ModelWrapper
+from relod.algo.models import AttributionPredictor, GuidedBackprop
 
 
 class SGQNPerformer(SACRADPerformer):
@@ -19,10 +20,10 @@ class SGQNLearner(SACRADLearner):
         assert performer != None, "SGQN needs the performer to be SGQNPerformer"
         assert 'conv' in self._args.net_params, "SGQN needs image input"
 
-        self._init_optimizers()
-
     def _init_optimizers(self):
         self.attribution_predictor = AttributionPredictor(self._args.action_shape[0], self._critic.encoder).to(self._args.device)
+        # created here (not in __init__) so it exists before the async update process is spawned
+        self._guided_backprop = GuidedBackprop(self._critic)
 
         self._actor_optimizer = torch.optim.Adam(
             self._actor.parameters(), lr=self._args.actor_lr, betas=(0.9, 0.999))
@@ -34,19 +35,26 @@ class SGQNLearner(SACRADLearner):
         self._aux_optimizer = torch.optim.Adam(
             self.attribution_predictor.parameters(), lr=self._args.aux_lr, betas=(0.9, 0.999))
 
+    def _checkpoint_objects(self):
+        return {
+            **super()._checkpoint_objects(),
+            'attribution_predictor': self.attribution_predictor,
+            'aux_optimizer': self._aux_optimizer,
+        }
+
     def _compute_attribution(self, images, proprioceptions, actions):
-        model = ModelWrapper(self._critic, propris=proprioceptions, action=actions)
-        gbp = GuidedBackprop(model)
-        attribution = gbp.attribute(images)
-        return attribution
+        return self._guided_backprop.attribute(images, proprioceptions, actions)
 
     def _compute_attribution_mask(self, obs_grad, quantile=0.95):
-        mask = []
-        for i in [0, 3, 6]:
-            attributions = obs_grad[:, i:i + 3].abs().max(dim=1)[0]
-            q = torch.quantile(attributions.flatten(1), quantile, 1)
-            mask.append((attributions >= q[:, None, None]).unsqueeze(1).repeat(1, 3, 1, 1))
-        return torch.cat(mask, dim=1)
+        # saliency per frame: max over its 3 RGB channels, all frames at once. attributions: (B, 3, H*W)
+        n, c, h, w = obs_grad.shape
+        attributions = obs_grad.abs().reshape(n, c // 3, 3, h * w).amax(dim=2)
+        # Keep the pixels >= the quantile. With torch.quantile's linear interpolation that threshold is
+        # the smallest of the top-k values, so no full sort is needed.
+        k = h * w - math.ceil(quantile * (h * w - 1))
+        q = attributions.topk(k, dim=-1, sorted=False).values.amin(dim=-1, keepdim=True)
+        mask = (attributions >= q).reshape(n, c // 3, 1, h, w)
+        return mask.expand(n, c // 3, 3, h, w).reshape(n, c, h, w)
 
     def _compute_attribution_loss(self, images, proprioceptions, actions, mask):
         mask = mask.float()
@@ -54,49 +62,56 @@ class SGQNLearner(SACRADLearner):
         aux_loss = F.binary_cross_entropy_with_logits(attrib, mask.detach())
         return attrib, aux_loss
 
-    def _update_aux(self, images, propris, actions):
+    def _update_aux(self, images, propris, actions, mask=None):
         """Updates the auxiliary network of SGQN: the AttributionPredictor."""
-        obs_grad = self._compute_attribution(images, propris, actions.detach())
-        mask = self._compute_attribution_mask(obs_grad, self._args.sgqn_quantile)
+        if mask is None:
+            obs_grad = self._compute_attribution(images, propris, actions.detach())
+            mask = self._compute_attribution_mask(obs_grad, self._args.sgqn_quantile)
 
         s_tilde = strong_augment(images, self._args.strong_augment)
         self._aux_optimizer.zero_grad()
-        pred_attrib, aux_loss = self._compute_attribution_loss(s_tilde, propris, actions, mask)
-        aux_loss.backward()
-        self._aux_optimizer.step()
+        with utils.autocast(self._args.device, self._args.amp):
+            pred_attrib, aux_loss = self._compute_attribution_loss(s_tilde, propris, actions, mask)
+        self._grad_scaler.scale(aux_loss).backward()
+        self._grad_scaler.step(self._aux_optimizer)
         return {'train/aux_loss': aux_loss.item()}
 
-    def _update_critic(self, images, proprioceptions, actions, rewards, next_images, next_proprioceptions, dones):
-        with torch.no_grad():
+    def _update_critic(self, images, proprioceptions, actions, rewards, next_images, next_proprioceptions, dones, weights=None,
+                       discounts=None, mask=None):
+        with torch.no_grad(), utils.autocast(self._args.device, self._args.amp):
             _, policy_actions, log_pis, _ = self._actor(next_images, next_proprioceptions)
             target_Q1, target_Q2 = self._critic_target(next_images, next_proprioceptions, policy_actions)
             target_V = torch.min(target_Q1, target_Q2) - self._alpha.detach() * log_pis
+            discount = self._args.discount if discounts is None else discounts
             if self._args.bootstrap_terminal:
                 # enable infinite bootstrap
-                target_Q = rewards + (self._args.discount * target_V)
+                target_Q = rewards + (discount * target_V)
             else:
-                target_Q = rewards + ((1.0 - dones) * self._args.discount * target_V)
+                target_Q = rewards + ((1.0 - dones) * discount * target_V)
 
         # get current Q estimates
-        current_Q1, current_Q2 = self._critic(images, proprioceptions, actions, detach_encoder=False)
+        with utils.autocast(self._args.device, self._args.amp):
+            current_Q1, current_Q2 = self._critic(images, proprioceptions, actions, detach_encoder=False)
 
-        critic_loss = torch.mean((current_Q1 - target_Q) ** 2 + (current_Q2 - target_Q) ** 2)
+        critic_loss, td_errors = utils.critic_loss(current_Q1, current_Q2, target_Q, weights)
 
         # SGQN specific, adding a "consistency term" to the critic loss
-        obs_grad = self._compute_attribution(images, proprioceptions, actions.detach())
-        mask = self._compute_attribution_mask(obs_grad, self._args.sgqn_quantile)
-        masked_images = images * mask
-        masked_images[mask < 1] = random.uniform(images.view(-1).min(), images.view(-1).max())
-        masked_Q1, masked_Q2 = self._critic(masked_images, proprioceptions, actions, detach_encoder=False)
+        # the attribution is computed in fp32, so that small saliency gradients don't underflow
+        if mask is None:
+            obs_grad = self._compute_attribution(images, proprioceptions, actions.detach())
+            mask = self._compute_attribution_mask(obs_grad, self._args.sgqn_quantile)
+        masked_images = torch.where(mask, images, random.uniform(images.min(), images.max()))
+        with utils.autocast(self._args.device, self._args.amp):
+            masked_Q1, masked_Q2 = self._critic(masked_images, proprioceptions, actions, detach_encoder=False)
         critic_loss += 0.5 * (torch.mean((current_Q1 - masked_Q1) ** 2 + (current_Q2 - masked_Q2) ** 2))
 
         # Optimize the critic
         self._critic_optimizer.zero_grad()
-        critic_loss.backward()
-        self._critic_optimizer.step()
-        return {'train/critic_loss': critic_loss.item()}
+        self._grad_scaler.scale(critic_loss).backward()
+        self._grad_scaler.step(self._critic_optimizer)
+        return {'train/critic_loss': critic_loss.item()}, td_errors
 
-    def _update(self, images, propris, actions, rewards, next_images, next_propris, dones):
+    def _update(self, images, propris, actions, rewards, next_images, next_propris, dones, info=None):
         tic = time.time()
         if images is not None:
             images = torch.as_tensor(images, device=self._args.device).float()
@@ -108,7 +123,16 @@ class SGQNLearner(SACRADLearner):
         rewards = torch.as_tensor(rewards, device=self._args.device)
         dones = torch.as_tensor(dones, device=self._args.device)
         
-        stats = self._update_critic(images, propris, actions, rewards, next_images, next_propris, dones)
+        # the saliency mask is computed once per update and shared by the consistency and aux losses
+        obs_grad = self._compute_attribution(images, propris, actions.detach())
+        mask = self._compute_attribution_mask(obs_grad, self._args.sgqn_quantile)
+
+        # importance weights of prioritized replay, bootstrap discounts of n-step returns
+        weights, discounts = self._replay_info(info)
+
+        stats, td_errors = self._update_critic(images, propris, actions, rewards, next_images, next_propris, dones, weights,
+                                               discounts, mask=mask)
+        self._update_priorities(info, td_errors)
         if self._num_updates % self._args.actor_update_freq == 0:
             actor_stats = self._update_actor_and_alpha(images, propris)
             stats = {**stats, **actor_stats}
@@ -117,8 +141,9 @@ class SGQNLearner(SACRADLearner):
 
         # SGQN specific update
         if self._num_updates % self._args.aux_update_freq == 0:
-            aux_stats = self._update_aux(images, propris, actions)
+            aux_stats = self._update_aux(images, propris, actions, mask)
             stats = {**stats, **aux_stats}
+        self._grad_scaler.update()
 
         stats['train/batch_reward'] = rewards.mean().item()
         stats['train/num_updates'] = self._num_updates
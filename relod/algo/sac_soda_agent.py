@@ -21,13 +21,25 @@ class SODALearner(SACRADLearner):
         super().__init__(args, performer)
         assert performer != None, "SGQN needs the performer to be SGQNPerformer"
         assert 'conv' in self._args.net_params, "SGQN needs image input"
+        self.train()
 
+    def _init_optimizers(self):
+        super()._init_optimizers()
+        # created here (not in __init__) so they exist before a checkpoint is restored and the async
+        # update process is spawned
         self.soda_predictor = SODAPredictor(self._critic.encoder, self._args.soda_projection_dim).to(self._args.device)
         self.soda_predictor_target = deepcopy(self.soda_predictor)
 
         self._aux_optimizer = torch.optim.Adam(
             self.soda_predictor.parameters(), lr=self._args.aux_lr, betas=(0.9, 0.999))
-        self.train()
+
+    def _checkpoint_objects(self):
+        return {
+            **super()._checkpoint_objects(),
+            'soda_predictor': self.soda_predictor,
+            'soda_predictor_target': self.soda_predictor_target,
+            'aux_optimizer': self._aux_optimizer,
+        }
 
     def train(self, is_training=True):
         self._performer.train(is_training)
@@ -35,11 +47,12 @@ class SODALearner(SACRADLearner):
         self.is_training = is_training
 
     def compute_soda_loss(self, x0, x1, propris):
-        h0 = self.soda_predictor(x0, propris)
-        with torch.no_grad():
-            h1 = self.soda_predictor_target.encoder(x1, propris)
-        h0 = F.normalize(h0, p=2, dim=1)
-        h1 = F.normalize(h1, p=2, dim=1)
+        with utils.autocast(self._args.device, self._args.amp):
+            h0 = self.soda_predictor(x0, propris)
+            with torch.no_grad():
+                h1 = self.soda_predictor_target.encoder(x1, propris)
+        h0 = F.normalize(h0.float(), p=2, dim=1)
+        h1 = F.normalize(h1.float(), p=2, dim=1)
         return F.mse_loss(h0, h1)
 
     def _update_aux(self, images, propris):
@@ -50,16 +63,18 @@ class SODALearner(SACRADLearner):
         soda_loss = self.compute_soda_loss(images_augm, images, propris)
 
         self._aux_optimizer.zero_grad()
-        soda_loss.backward()
-        self._aux_optimizer.step()
+        self._grad_scaler.scale(soda_loss).backward()
+        self._grad_scaler.step(self._aux_optimizer)
 
         utils.soft_update_params(self.soda_predictor, self.soda_predictor_target, self._args.soda_tau)
+        return {'train/aux_loss': soda_loss.item()}
 
-    def _update(self, images, propris, actions, rewards, next_images, next_propris, dones):
+    def _update(self, images, propris, actions, rewards, next_images, next_propris, dones, info=None):
         tic = time.time()
         if images is not None:
-            images = torch.as_tensor(images, device=self._args.device).float()
-            next_images = torch.as_tensor(next_images, device=self._args.device).float()
+            # images stay uint8 on the way to the encoder, which crops and normalizes them in one pass
+            images = torch.as_tensor(images, device=self._args.device)
+            next_images = torch.as_tensor(next_images, device=self._args.device)
         if propris is not None:
             propris = torch.as_tensor(propris, device=self._args.device).float()
             next_propris = torch.as_tensor(next_propris, device=self._args.device).float()
@@ -67,7 +82,12 @@ class SODALearner(SACRADLearner):
         rewards = torch.as_tensor(rewards, device=self._args.device)
         dones = torch.as_tensor(dones, device=self._args.device)
         
-        stats = self._update_critic(images, propris, actions, rewards, next_images, next_propris, dones)
+        # importance weights of prioritized replay, bootstrap discounts of n-step returns
+        weights, discounts = self._replay_info(info)
+
+        stats, td_errors = self._update_critic(images, propris, actions, rewards, next_images, next_propris, dones, weights,
+                                               discounts)
+        self._update_priorities(info, td_errors)
         if self._num_updates % self._args.actor_update_freq == 0:
             actor_stats = self._update_actor_and_alpha(images, propris)
             stats = {**stats, **actor_stats}
@@ -78,6 +98,7 @@ class SODALearner(SACRADLearner):
         if self._num_updates % self._args.aux_update_freq == 0:
             aux_stats = self._update_aux(images, propris)
             stats = {**stats, **aux_stats}
+        self._grad_scaler.update()
 
         stats['train/batch_reward'] = rewards.mean().item()
         stats['train/num_updates'] = self._num_updates
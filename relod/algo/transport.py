@@ -0,0 +1,508 @@
+import asyncio
+import collections
+import pickle
+import queue
+import socket
+import tempfile
+import threading
+import uuid
+import relod.tracing as tracing
+from relod.algo.comm import CHANNEL, HEADER, Batch, Session, encode_frame
+
+# put into the inboxes when the connection is lost for good, to wake up blocked receivers
+_BROKEN = object()
+
+# the writer coalesces at most this many queued data messages into one frame
+MAX_COALESCE = 64
+
+# frames are read in parts of this many bytes, hearing from the peer with each
+READ_CHUNK = 1 << 16
+
+
+class SpillFile(object):
+    """Encoded frames written to a temporary file once the in-memory send queue is full, and read
+    back in order. At most max_bytes are kept on disk; the file is rewound whenever it is emptied.
+    Not thread safe, Transport guards it with its lock.
+    """
+    def __init__(self, directory='', max_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self._file = None
+        self._directory = directory or None
+        self._write_pos = 0
+        self._read_pos = 0
+        self.frames = 0
+
+    def __len__(self):
+        return self.frames
+
+    @property
+    def nbytes(self):
+        return self._write_pos - self._read_pos
+
+    def fits(self, size):
+        return self._write_pos + size <= self.max_bytes
+
+    def put(self, header, payload):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix='relod_spill_', dir=self._directory)
+        self._file.seek(self._write_pos)
+        self._file.write(header)
+        self._file.write(payload)
+        self._write_pos += len(header) + len(payload)
+        self.frames += 1
+
+    def get(self):
+        """Returns the next frame as (header, payload)."""
+        self._file.seek(self._read_pos)
+        header = self._file.read(HEADER.size)
+        _, _, length = HEADER.unpack(header)
+        payload = self._file.read(length)
+        self._read_pos += HEADER.size + length
+        self.frames -= 1
+        if self.frames == 0:
+            self._read_pos = self._write_pos = 0
+            self._file.truncate(0)
+        return header, payload
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class Transport(object):
+    """One TCP connection carrying typed channels (CHANNEL.CMD, DATA and POLICY), run by an asyncio
+    event loop in a dedicated thread.
+
+    send() queues a message for the loop thread, which pickles and writes it. Messages are pickled
+    after send() returns, so they must not be modified afterwards. When the link falls behind:
+    - with coalesce, queued data messages are written as one Batch frame (the receiver must unpack
+      them, as RemoteWrapper and RemoteServer do);
+    - past send_queue_size queued messages, new ones are pickled into a spill file on disk (up to
+      spill_max_bytes, 0 disables it) and sent once the backlog is written;
+    - when that is full too, send() blocks. Nothing is dropped: the remote pairs every action with
+      its sample, so a lost message would desynchronize the protocol.
+
+    Incoming frames are unpickled by the loop thread into one inbox per channel, read with recv().
+    Policies are the exception: only the newest one is kept, still pickled, so the ones superseded
+    before recv() are never unpickled.
+
+    The connection is a session (see comm.Session) that survives network outages: both ends send a
+    heartbeat acknowledging what they received every heartbeat_interval seconds, and a link silent
+    for heartbeat_timeout seconds is dropped. The connecting end then reconnects, the accepting end
+    waits for it, and both resend what was not acknowledged. Meanwhile send() keeps queuing and
+    recv() waits; only after reconnect_timeout seconds do they raise RuntimeError.
+    close() sends what is still queued and tells the peer the session is over.
+    """
+    def __init__(self, send_queue_size=1000, spill_dir='', spill_max_bytes=0,
+                 coalesce=False, heartbeat_interval=1.0, heartbeat_timeout=5.0, reconnect_timeout=300):
+        self._send_queue_size = send_queue_size
+        self._coalesce = coalesce
+        self._heartbeat_interval = heartbeat_interval
+        self._heartbeat_timeout = heartbeat_timeout
+        self._reconnect_timeout = reconnect_timeout
+        self._inboxes = {
+            CHANNEL.CMD: queue.Queue(),
+            CHANNEL.DATA: queue.Queue(),
+            CHANNEL.POLICY: queue.Queue(1), # latest wins
+        }
+        # written by send(), read by the loop thread
+        self._lock = threading.Condition()
+        self._outbox = collections.deque()
+        self._spill = SpillFile(spill_dir, spill_max_bytes)
+        self._session = Session()
+        self._address = None
+        self._error = None
+        self._closed = False
+        self._closing = False
+        self._peer_closed = False
+
+        # owned by the loop thread
+        self._link = None       # (reader, writer) of the current connection
+        self._tasks = []        # reader, writer and heartbeat of the current connection
+        self._pending = None    # set when there is something to write
+        self._server = None
+        self._connected = None  # resolved by the first connection accepted
+        self._give_up = None    # fails the session if the peer does not come back in time
+        self._last_heard = 0
+
+        # statistics
+        self.sent_messages = 0
+        self.received_policies = 0
+        self.superseded_policies = 0
+        self.spilled_messages = 0
+        self.coalesced_messages = 0
+        self.blocked_sends = 0
+        self.max_queue_depth = 0
+        self.reconnects = 0
+        self.resent_frames = 0
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def connect(cls, host, port, timeout=0, **kwargs):
+        """Connects to a listening Transport, retrying for up to timeout seconds while it is not up yet."""
+        transport = cls(**kwargs)
+        transport._address = (host, port)
+        transport._session.id = uuid.uuid4().hex
+        transport._call(transport._connect(timeout))
+        return transport
+
+    @classmethod
+    def accept(cls, port, **kwargs):
+        """Listens on port and returns once one peer has connected. The port stays open for the
+        peer to resume the session."""
+        transport = cls(**kwargs)
+        transport._call(transport._listen(port))
+        return transport
+
+    @property
+    def queue_depth(self):
+        """Messages queued in memory or spilled, not written yet."""
+        with self._lock:
+            return len(self._outbox) + len(self._spill)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sent_messages': self.sent_messages,
+                'received_policies': self.received_policies,
+                'superseded_policies': self.superseded_policies,
+                'queued_messages': len(self._outbox),
+                'spilled_pending': len(self._spill),
+                'spilled_bytes_pending': self._spill.nbytes,
+                'spilled_messages': self.spilled_messages,
+                'coalesced_messages': self.coalesced_messages,
+                'blocked_sends': self.blocked_sends,
+                'max_queue_depth': self.max_queue_depth,
+                'reconnects': self.reconnects,
+                'resent_frames': self.resent_frames,
+                'superseded_unacked_policies': self._session.superseded_policies,
+            }
+
+    def call_soon(self, fn, *args):
+        """Runs fn(*args) on the loop thread, e.g. to set its CPU affinity."""
+        self._loop.call_soon_threadsafe(fn, *args)
+
+    def send(self, channel, msg, block=True, timeout=None):
+        """Queues msg on channel. When the queue and the spill file are full, blocks until there is
+        room, or raises queue.Full if block is False or timeout expires."""
+        self._check()
+        with self._lock:
+            queued = self._queue(channel, msg)
+        if not queued:
+            # pickled out of the lock, the writer keeps going meanwhile
+            frame = encode_frame(channel, msg)
+            size = len(frame[0]) + len(frame[1])
+            with self._lock:
+                room = lambda: self._error is not None or self._has_room() or self._spill.fits(size)
+                if not room():
+                    self.blocked_sends += 1
+                    if not self._lock.wait_for(room, timeout if block else 0):
+                        raise queue.Full
+                self._check()
+                if not self._queue(channel, msg):
+                    # numbered now that its place in the stream is known
+                    seq = self._session.next_seq()
+                    self._spill.put(HEADER.pack(channel, seq, len(frame[1])), frame[1])
+                    self.spilled_messages += 1
+                    self._update_depth()
+        self._loop.call_soon_threadsafe(self._wakeup)
+
+    def recv(self, channel, block=True, timeout=None):
+        """Returns the next message of channel, raises queue.Empty like queue.Queue.get."""
+        msg = self._inboxes[channel].get(block=block, timeout=timeout)
+        if msg is _BROKEN:
+            self._inboxes[channel].put(_BROKEN)
+            self._check()
+        if channel == CHANNEL.POLICY:
+            with tracing.span('recv'):
+                msg = pickle.loads(msg)
+        return msg
+
+    def close(self, timeout=10):
+        """Sends what is still queued, then ends the session and stops the loop thread."""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._call(self._drain_and_close(), timeout)
+        except Exception as e:
+            print('Transport: closing without draining,', repr(e))
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+        self._spill.close()
+
+    def _check(self):
+        if self._error is not None:
+            raise RuntimeError("socket connection broken") from self._error
+
+    def _has_room(self):
+        # nothing goes to memory while frames are spilled, to keep the order
+        return len(self._spill) == 0 and len(self._outbox) < self._send_queue_size
+
+    def _queue(self, channel, msg):
+        if not self._has_room():
+            return False
+        self._outbox.append((channel, msg, self._session.next_seq()))
+        self._update_depth()
+        return True
+
+    def _update_depth(self):
+        self.max_queue_depth = max(self.max_queue_depth, len(self._outbox) + len(self._spill))
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+        self._loop.close()
+
+    def _call(self, coro, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    def _wakeup(self):
+        if self._pending is not None:
+            self._pending.set()
+
+    async def _read_frame(self, reader):
+        header = await reader.readexactly(HEADER.size)
+        start = tracing.now_ns()
+        channel, seq, length = HEADER.unpack(header)
+        self._last_heard = self._loop.time()
+        # read in parts, each one keeps the link alive: a large frame may take longer than the timeout
+        payload = bytearray()
+        while len(payload) < length:
+            payload += await reader.readexactly(min(length - len(payload), READ_CHUNK))
+            self._last_heard = self._loop.time()
+        if channel == CHANNEL.POLICY:
+            return channel, seq, payload # unpickled by recv(), if not superseded before
+        msg = pickle.loads(payload)
+        tracing.record('recv', start)
+        return channel, seq, msg
+
+    def _write_session(self, writer, *msg):
+        writer.writelines(encode_frame(CHANNEL.SESSION, msg))
+
+    async def _connect(self, timeout):
+        deadline = self._loop.time() + timeout
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(*self._address)
+                self._write_session(writer, 'hello', self._session.id, self._session.recv_seq)
+                channel, _, msg = await asyncio.wait_for(self._read_frame(reader), self._heartbeat_timeout)
+                break
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                if self._loop.time() >= deadline:
+                    raise
+                await asyncio.sleep(0.5)
+        assert channel == CHANNEL.SESSION and msg[0] == 'hello', 'unexpected handshake {}'.format(msg)
+        if msg[1] != self._session.id:
+            writer.close()
+            raise RuntimeError('the remote does not serve this session anymore')
+        return self._resume(reader, writer, msg[2])
+
+    async def _reconnect(self):
+        try:
+            resent = await self._connect(self._reconnect_timeout)
+        except Exception as e:
+            self._broken(e)
+        else:
+            self.reconnects += 1
+            print('Transport: reconnected, resent', resent, 'frames')
+
+    async def _listen(self, port):
+        self._connected = self._loop.create_future()
+        self._server = await asyncio.start_server(self._on_connect, port=port)
+        await self._connected
+
+    async def _on_connect(self, reader, writer):
+        try:
+            channel, _, msg = await asyncio.wait_for(self._read_frame(reader), self._heartbeat_timeout)
+            assert channel == CHANNEL.SESSION and msg[0] == 'hello', 'unexpected handshake {}'.format(msg)
+        except Exception as e:
+            print('Transport: rejected a connection,', repr(e))
+            writer.close()
+            return
+
+        if self._session.id is None:
+            self._session.id = msg[1]
+        elif msg[1] != self._session.id or self._error is not None or self._closing:
+            # another robot, or a session that is over
+            self._write_session(writer, 'hello', None, 0)
+            writer.close()
+            return
+        else:
+            self.reconnects += 1
+        self._write_session(writer, 'hello', self._session.id, self._session.recv_seq)
+        resent = self._resume(reader, writer, msg[2])
+        if self.reconnects:
+            print('Transport: the peer is back, resent', resent, 'frames')
+        if not self._connected.done():
+            self._connected.set_result(None)
+
+    def _resume(self, reader, writer, peer_recv_seq):
+        """Starts serving a (new) connection: resends what the peer has not received yet and returns
+        the number of frames resent."""
+        self._drop_link()
+        if self._give_up is not None:
+            self._give_up.cancel()
+            self._give_up = None
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self._session.acked(peer_recv_seq)
+        for _, frame in self._session.unacked:
+            writer.writelines(frame)
+        self.resent_frames += len(self._session.unacked)
+
+        self._link = (reader, writer)
+        self._last_heard = self._loop.time()
+        if self._pending is None:
+            self._pending = asyncio.Event()
+        self._pending.set() # send what was queued meanwhile
+        self._tasks = [self._loop.create_task(coro) for coro in
+                       [self._read_frames(reader), self._write_frames(writer), self._heartbeat(writer)]]
+        return len(self._session.unacked)
+
+    def _drop_link(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._link is not None:
+            self._link[1].close()
+            self._link = None
+
+    def _disconnected(self, error):
+        if self._link is None:
+            return
+        self._drop_link()
+        if self._closing:
+            return
+        if self._peer_closed:
+            self._broken(error)
+            return
+        print('Transport: connection lost,', repr(error))
+        if self._address is not None:
+            self._loop.create_task(self._reconnect())
+        else:
+            self._give_up = self._loop.call_later(self._reconnect_timeout, self._broken, error)
+
+    def _take(self):
+        """Pops the next queued messages, or once the queue is empty, the next spilled frames."""
+        with self._lock:
+            items = []
+            if self._outbox:
+                while self._outbox and len(items) < MAX_COALESCE:
+                    channel, msg, seq = self._outbox.popleft()
+                    items.append((channel, msg, seq, None))
+            else:
+                while len(self._spill) and len(items) < MAX_COALESCE:
+                    frame = self._spill.get()
+                    channel, seq, _ = HEADER.unpack(frame[0])
+                    items.append((channel, None, seq, frame))
+            self._lock.notify_all()
+            return items
+
+    def _encode(self, items):
+        """Returns the (seq, frame) of the items, runs of data messages coalesced into batches
+        numbered as their last message."""
+        frames, data = [], []
+        for channel, msg, seq, frame in items + [(None, None, None, None)]:
+            if self._coalesce and channel == CHANNEL.DATA and frame is None:
+                data.append((seq, msg))
+                continue
+            if len(data) == 1:
+                frames.append((data[0][0], encode_frame(CHANNEL.DATA, data[0][1], data[0][0])))
+            elif len(data) > 1:
+                batch = Batch()
+                for _, m in data:
+                    batch.extend(m if isinstance(m, Batch) else [m])
+                frames.append((data[-1][0], encode_frame(CHANNEL.DATA, batch, data[-1][0])))
+                self.coalesced_messages += len(data)
+            data = []
+            if frame is not None:
+                frames.append((seq, frame))
+            elif channel is not None:
+                frames.append((seq, encode_frame(channel, msg, seq)))
+        return frames
+
+    async def _write_frames(self, writer):
+        try:
+            while True:
+                await self._pending.wait()
+                self._pending.clear()
+                while True:
+                    items = self._take()
+                    if not items:
+                        break
+                    with tracing.span('send'):
+                        for seq, frame in self._encode(items):
+                            # kept before writing, a connection lost now resends it
+                            self._session.sent(seq, frame)
+                            writer.writelines(frame)
+                    self.sent_messages += len(items)
+                    await writer.drain()
+                if self._closing:
+                    break
+        except ConnectionError as e:
+            self._disconnected(e)
+
+    async def _read_frames(self, reader):
+        try:
+            while True:
+                channel, seq, msg = await self._read_frame(reader)
+                if channel == CHANNEL.SESSION:
+                    if msg[0] == 'ack':
+                        self._session.acked(msg[1])
+                    elif msg[0] == 'bye':
+                        self._peer_closed = True
+                elif self._session.received(seq):
+                    self._deliver(channel, msg)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            self._disconnected(e)
+
+    async def _heartbeat(self, writer):
+        while True:
+            await asyncio.sleep(self._heartbeat_interval)
+            if self._loop.time() - self._last_heard > self._heartbeat_timeout:
+                self._disconnected(TimeoutError('no heartbeat for {}s'.format(self._heartbeat_timeout)))
+                return
+            self._write_session(writer, 'ack', self._session.recv_seq)
+
+    def _deliver(self, channel, msg):
+        if channel == CHANNEL.POLICY:
+            self.received_policies += 1
+            # the only producer, so the slot is free after this
+            try:
+                self._inboxes[channel].get_nowait()
+                self.superseded_policies += 1
+            except queue.Empty:
+                pass
+            self._inboxes[channel].put_nowait(msg)
+        else:
+            self._inboxes[channel].put(msg)
+
+    def _broken(self, error):
+        if self._error is None and not self._closed:
+            self._error = error
+            with self._lock:
+                self._lock.notify_all()
+            for inbox in self._inboxes.values():
+                try:
+                    inbox.put_nowait(_BROKEN)
+                except queue.Full:
+                    inbox.get_nowait()
+                    inbox.put_nowait(_BROKEN)
+
+    async def _drain_and_close(self):
+        self._closing = True
+        if self._link is not None:
+            self._pending.set()
+            await asyncio.wait([self._tasks[1]])
+            if self._link is not None:
+                self._write_session(self._link[1], 'bye')
+                await self._link[1].drain()
+        self._drop_link()
+        if self._give_up is not None:
+            self._give_up.cancel()
+        if self._server is not None:
+            self._server.close()
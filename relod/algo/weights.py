@@ -0,0 +1,79 @@
+"""Weights published by the async update process to the performer.
+
+The update process trains private copies of the models the performer runs, and publishes them every
+publish_every updates into one of two shared slabs, each a copy of all the model tensors. A version
+counter tells which slab holds the newest weights, and works as a seqlock: it is odd while a slab is
+written. The performer runs its models on the newest slab without copying it, the model tensors are
+views of the slab, and the writer never touches the slab of the newest version. Only a read spanning
+two publications sees a slab rewritten: it is detected and runs again, the performer never waits on
+the learner and never acts on weights of two versions.
+
+    # main process, after the models are created
+    weights = WeightSlabs(modules)
+    action = weights.read(sample_action, ob)
+    # update process, on its own copies of the modules
+    weights.publish(modules)
+"""
+import itertools
+import torch
+
+
+def _tensors(modules):
+    """The parameters and buffers of modules in a fixed order, the ones the modules share once."""
+    tensors, seen = [], set()
+    for module in modules:
+        for tensor in itertools.chain(module.parameters(), module.buffers()):
+            if id(tensor) not in seen:
+                seen.add(id(tensor))
+                tensors.append(tensor)
+    return tensors
+
+
+class WeightSlabs(object):
+    """Two shared copies of the tensors of modules, which read() binds modules to in turn."""
+    def __init__(self, modules):
+        self._modules = list(modules)
+        tensors = _tensors(self._modules)
+        self._slabs = [[tensor.detach().clone().share_memory_() for tensor in tensors] for _ in range(2)]
+        # twice the version, plus one while the next version is written
+        self._seq = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self._bound = -1
+        self._bind(0)
+
+    def __getstate__(self):
+        # the update process publishes its own modules
+        state = self.__dict__.copy()
+        state['_modules'] = None
+        return state
+
+    @property
+    def version(self):
+        return int(self._seq[0]) // 2
+
+    def _bind(self, version):
+        for tensor, published in zip(_tensors(self._modules), self._slabs[version % 2]):
+            tensor.data = published
+        self._bound = version
+
+    def read(self, fn, *args):
+        """fn(*args) run on the newest version of the weights."""
+        while True:
+            version = self.version
+            if version != self._bound:
+                self._bind(version)
+            result = fn(*args)
+            # the slab of version is rewritten from 2 * version + 3 on, when version + 2 is published
+            if int(self._seq[0]) < 2 * version + 3:
+                return result
+
+    def publish(self, modules):
+        """Copies the tensors of modules, in the order of the modules given at creation, to the slab
+        of the next version."""
+        self._seq += 1
+        slab = self._slabs[(self.version + 1) % 2]
+        with torch.no_grad():
+            for published, tensor in zip(slab, _tensors(modules)):
+                published.copy_(tensor)
+        if slab[0].is_cuda:
+            torch.cuda.synchronize(slab[0].device)
+        self._seq += 1
@@ -1,27 +1,33 @@
+import hashlib
 import os
+import queue
+import threading
+import numpy as np
 import torch
 import torch.nn.functional as F
-import torchvision.datasets as datasets
-import torchvision.transforms as TF
-import kornia
 
-# global variables for places365 dataset
-places_dataloader = None
-places_iter = None
+# global overlay source for the places365 dataset, created lazily in the process that augments
+overlay_source = None
+# where OverlaySource keeps the preprocessed images by default
+OVERLAY_CACHE_DIR = '~/.cache/relod/overlay'
 
 
 def strong_augment(obs, augm_type, overlay_alpha=0.5):
-    """Augment the observation with strong augmentations."""
+    """Augment the observation with strong augmentations. uint8 observations stay uint8, the encoder
+    crops and scales them in one pass."""
     if augm_type == 'conv':
-        return random_conv(obs.clone())
+        obs_augm = random_conv(obs.clone())
     elif augm_type == 'overlay':
-        return random_overlay(obs.clone(), alpha=overlay_alpha)
+        obs_augm = random_overlay(obs.clone(), alpha=overlay_alpha)
     elif augm_type == 'none':
         return obs.clone()
     # elif augm_type == 'splice':
     #   return random_overlay(obs.clone(), method='splice')
     else:
         raise NotImplementedError('--augment must be one of [conv, overlay, none]')
+    if obs.dtype == torch.uint8:
+        obs_augm = obs_augm.round_().clamp_(0, 255).to(torch.uint8)
+    return obs_augm
 
 
 def random_conv(x):
@@ -38,60 +44,156 @@ def random_conv(x):
 
 def random_overlay(x, dataset='places365_standard', alpha=0.5):
     """Randomly overlay an image from Places"""
-    global places_iter
-    if dataset == 'places365_standard':
-        if places_dataloader is None:
-            _load_places(batch_size=x.size(0), image_size=(x.size(-2), x.size(-1)))
-        imgs = _get_places_batch(batch_size=x.size(0)).repeat(1, x.size(1)//3, 1, 1) * 255.0
-    else:
+    global overlay_source
+    if dataset != 'places365_standard':
         raise NotImplementedError(f'overlay has not been implemented for dataset "{dataset}"')
-    return imgs * alpha + x * (1 - alpha)
-
-
-def _load_places(batch_size=256, image_size=(90, 160), num_workers=8, use_val=False):
-    global places_dataloader, places_iter
 
+    n, c, h, w = x.shape
+    if overlay_source is None or overlay_source.image_size != (h, w) or overlay_source.device != x.device:
+        overlay_source = _load_places(image_size=(h, w), device=x.device)
+    imgs = overlay_source.sample(n)
+
+    # the same overlay image is blended into every stacked frame, broadcast instead of repeated along channels
+    x = x.reshape(n, c//3, 3, h, w) * (1 - alpha) + imgs.unsqueeze(1) * alpha
+    return x.reshape(n, c, h, w)
+
+
+def _load_places(image_size=(90, 160), device='cpu', use_val=False):
+    """Loads places365 as an OverlaySource, configured through environment variables so that it
+    also works in the spawned update process:
+        DMCGB_DATASETS:             dataset root (required)
+        DMCGB_CACHE_DIR:            where the preprocessed .npy is kept (default: ~/.cache/relod/overlay)
+        RELOD_OVERLAY_MAX_IMAGES:   number of images preprocessed into the cache (default: 20000)
+        RELOD_OVERLAY_POOL_SIZE:    number of images resident on the device (default: 1024)
+    """
     data_dir = os.environ.get('DMCGB_DATASETS')
     assert data_dir is not None, 'DMCGB_DATASETS not set. Use `export DMCGB_DATASETS="/path/to/datasets"`'
-    print('DMCGB_DATASETS:', os.environ['DMCGB_DATASETS'])
-    print('data_dir', data_dir)
+    if not os.path.exists(data_dir):
+        raise FileNotFoundError(f'Failed to find places365 data at {data_dir}')
 
     partition = 'val' if use_val else 'train'
     print(f'Loading {partition} partition of places365_standard...')
-
-    if os.path.exists(data_dir):
-        fp = os.path.join(data_dir, 'places365_standard', partition)
-        if not os.path.exists(fp):
-            print(f'Warning: path {fp} does not exist, falling back to {data_dir}')
-            fp = data_dir
-        places_dataloader = torch.utils.data.DataLoader(
-            datasets.ImageFolder(fp, TF.Compose([
-                TF.RandomResizedCrop(image_size),
-                TF.RandomHorizontalFlip(),
-                TF.ToTensor()
-            ])),
-            batch_size=batch_size, shuffle=True,
-            num_workers=num_workers, pin_memory=True)
-        places_iter = iter(places_dataloader)
-        # print('Loaded image augmentation dataset from', data_dir)
-    else:
-        raise FileNotFoundError(f'Failed to find places365 data at {data_dir}')
-
-    if places_iter is None:
-        raise FileNotFoundError(f'Failed to load places365 data at {data_dir}')
-
-
-def _get_places_batch(batch_size):
-    global places_iter
-    try:
-        imgs, _ = next(places_iter)
-        if imgs.size(0) < batch_size:
-            places_iter = iter(places_dataloader)
-            imgs, _ = next(places_iter)
-    except StopIteration:
-        places_iter = iter(places_dataloader)
-        imgs, _ = next(places_iter)
-    return imgs.cuda()
+    fp = os.path.join(data_dir, 'places365_standard', partition)
+    if not os.path.exists(fp):
+        print(f'Warning: path {fp} does not exist, falling back to {data_dir}')
+        fp = data_dir
+
+    return OverlaySource(fp, image_size, device,
+                         cache_dir=os.environ.get('DMCGB_CACHE_DIR'),
+                         max_images=int(os.environ.get('RELOD_OVERLAY_MAX_IMAGES', 20000)),
+                         pool_size=int(os.environ.get('RELOD_OVERLAY_POOL_SIZE', 1024)))
+
+
+class OverlaySource(object):
+    """Source of overlay images for random_overlay.
+
+    The image folder is preprocessed once into a uint8 (N, 3, H, W) .npy at the training resolution,
+    which is then memory mapped, so only the pages that are touched are read. A pool of pool_size
+    images is kept on the device and batches are drawn from it by random indices; a background
+    thread prefetches the next pool from the memmap and it is swapped in every refresh_every
+    samples. Memory use is bounded by max_images on disk and pool_size on the device. The .npy is kept
+    in cache_dir, by default in the user's cache rather than next to the (often read-only) images.
+    """
+    IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+    def __init__(self, image_dir, image_size, device, cache_dir=None, max_images=20000,
+                 pool_size=1024, refresh_every=None, seed=None):
+        self.image_size = tuple(image_size)
+        self.device = torch.device(device)
+        if seed is None:
+            seed = torch.initial_seed() % 2**32
+
+        cache_dir = os.path.expanduser(OVERLAY_CACHE_DIR if cache_dir is None else cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        # image folders of the same name, e.g. the train partitions of two datasets, have their own file
+        image_dir = os.path.abspath(image_dir)
+        digest = hashlib.md5(image_dir.encode()).hexdigest()[:8]
+        cache_path = os.path.join(cache_dir, f'overlay_{os.path.basename(image_dir)}_{digest}'
+                                             f'_{self.image_size[0]}x{self.image_size[1]}_{max_images}.npy')
+        if not os.path.exists(cache_path):
+            self._preprocess(image_dir, cache_path, max_images, seed)
+        self._images = np.load(cache_path, mmap_mode='r')
+
+        self._pool_size = min(pool_size, len(self._images))
+        self._refresh_every = self._pool_size if refresh_every is None else refresh_every
+        self._num_sampled = 0
+        self._rng = np.random.RandomState(seed)
+        self._generator = torch.Generator(device=self.device)
+        self._generator.manual_seed(seed)
+        self._stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+        self._use_pool(*self._load_pool())
+        self._next_pools = queue.Queue(maxsize=1)
+        self._prefetcher = threading.Thread(target=self._prefetch, daemon=True)
+        self._prefetcher.start()
+
+    def _preprocess(self, image_dir, cache_path, max_images, seed):
+        files = []
+        for root, _, names in os.walk(image_dir):
+            files += [os.path.join(root, name) for name in names if name.lower().endswith(self.IMAGE_EXTENSIONS)]
+        if not files:
+            raise FileNotFoundError(f'Failed to find images in {image_dir}')
+        files.sort()
+        if len(files) > max_images:
+            files = [files[i] for i in np.random.RandomState(seed).choice(len(files), max_images, replace=False)]
+
+        import cv2
+
+        h, w = self.image_size
+        print(f'Preprocessing {len(files)} overlay images from {image_dir} into {cache_path}...')
+        tmp_path = cache_path + f'.{os.getpid()}.tmp'
+        images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(files), 3, h, w))
+        for i, f in enumerate(files):
+            image = cv2.cvtColor(cv2.imread(f), cv2.COLOR_BGR2RGB)
+            # center crop to the training aspect ratio, then resize
+            ih, iw = image.shape[:2]
+            ch, cw = min(ih, iw * h // w), min(iw, ih * w // h)
+            image = image[(ih - ch)//2:(ih - ch)//2 + ch, (iw - cw)//2:(iw - cw)//2 + cw]
+            images[i] = cv2.resize(image, (w, h), interpolation=cv2.INTER_AREA).transpose(2, 0, 1)
+        images.flush()
+        del images
+        os.replace(tmp_path, cache_path)
+
+    def _load_pool(self):
+        # sorted indices so that the memmap is read front to back
+        idxs = np.sort(self._rng.choice(len(self._images), self._pool_size, replace=False))
+        pool = torch.from_numpy(self._images[idxs])
+        if self._stream is None:
+            return pool.to(self.device), None
+
+        with torch.cuda.stream(self._stream):
+            pool = pool.pin_memory().to(self.device, non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record(self._stream)
+        return pool, ready
+
+    def _use_pool(self, pool, ready):
+        if ready is not None:
+            # the copy on the side stream comes before any sample drawn from the pool
+            torch.cuda.current_stream(self.device).wait_event(ready)
+            pool.record_stream(torch.cuda.current_stream(self.device))
+        self._pool = pool
+        self._num_sampled = 0
+
+    def _prefetch(self):
+        while True:
+            self._next_pools.put(self._load_pool())
+
+    def sample(self, batch_size):
+        """Returns a float (batch_size, 3, H, W) batch of overlay images in [0, 255] on the device."""
+        if self._num_sampled >= self._refresh_every:
+            try:
+                self._use_pool(*self._next_pools.get_nowait())
+            except queue.Empty:
+                pass # keep drawing from the current pool until the next one is ready
+        self._num_sampled += batch_size
+
+        idxs = torch.randint(len(self._pool), (batch_size,), device=self.device, generator=self._generator)
+        imgs = self._pool.index_select(0, idxs)
+        # random horizontal flips
+        flip = torch.rand(batch_size, device=self.device, generator=self._generator) < 0.5
+        imgs = torch.where(flip.view(-1, 1, 1, 1), imgs.flip(-1), imgs)
+        return imgs.float()
 
 
 def random_shift(imgs, pad=4):
@@ -100,6 +202,8 @@ def random_shift(imgs, pad=4):
     https://github.com/kornia/kornia/issues/1559#issuecomment-1033762532
     https://kornia.readthedocs.io/en/latest/augmentation.module.html#kornia.augmentation.RandomCrop
     """
+    import kornia  # slow to import, only DrQ needs it
+
     _, _, h, w = imgs.shape
     imgs = F.pad(imgs, (pad, pad, pad, pad), mode='replicate')
     return kornia.augmentation.RandomCrop((h, w))(imgs)
@@ -14,6 +14,7 @@ from senseact.devices.ur import ur_utils
 from relod.envs.visual_ur5_reacher.ur_setup import setups
 from senseact.sharedbuffer import SharedBuffer
 from senseact import utils
+import relod.tracing as tracing
 import cv2 as cv
 from relod.envs.visual_ur5_reacher.camera_communicator import CameraCommunicator, DEFAULT_HEIGHT, DEFAULT_WIDTH
 from relod.envs.visual_ur5_reacher.monitor_communicator import MonitorCommunicator
@@ -407,6 +408,7 @@ class ReacherEnv(RTRLBaseEnv, gym.core.Env):
             A tuple (observation, reward, done)
         """
 
+        start = tracing.now_ns()
         joint_sensation, joint_timestamp, _ = self._joint_buffer.read_update()
         image_sensation, image_timestamp, _ = self._image_buffer.read_update()
         if np.abs(joint_timestamp[-1] - image_timestamp[-1]) > 0.04:
@@ -421,6 +423,7 @@ class ReacherEnv(RTRLBaseEnv, gym.core.Env):
             images.append(image_sensation[0][i * image_length : (i + 1) * image_length].reshape(DEFAULT_HEIGHT, DEFAULT_WIDTH, 3))
         image_sensation = np.concatenate(images, axis=-1).astype(np.uint8)
         image_sensation = image_sensation[::DEFAULT_HEIGHT // self._image_height, ::DEFAULT_WIDTH // self._image_width, :]
+        tracing.record('image_read', start)
         reward = self._compute_reward_(image_sensation, joint_sensation[0][self._joint_indices])
         done = self._check_done()
         if self._channel_first:
@@ -1,9 +1,12 @@
 from collections import defaultdict
+import atexit
 import json
 import os
+import queue
 import shutil
+import sys
+import threading
 import torch
-import wandb
 #import torchvision
 import numpy as np
 from termcolor import colored
@@ -41,6 +44,7 @@ class MetersGroup(object):
         self._file_name = file_name
         if os.path.exists(file_name):
             os.remove(file_name)
+        self._file = open(file_name, 'a')
         self._formating = formating
         self._meters = defaultdict(AverageMeter)
 
@@ -59,8 +63,8 @@ class MetersGroup(object):
         return data
 
     def _dump_to_file(self, data):
-        with open(self._file_name, 'a') as f:
-            f.write(json.dumps(data) + '\n')
+        self._file.write(json.dumps(data) + '\n')
+        self._file.flush()
 
     def _format(self, key, value, ty):
         template = '%s: '
@@ -91,17 +95,61 @@ class MetersGroup(object):
         self._dump_to_console(data, prefix)
         self._meters.clear()
 
+    def close(self):
+        self._file.close()
+
+
+class StepBuffer(object):
+    """Scalars logged at one step, stored in preallocated arrays. Tensors are kept as they are
+    and only copied to the host by the sink thread, so logging never waits for the device."""
+    def __init__(self, capacity=64):
+        self.step = None
+        self.size = 0
+        self.keys = []
+        self.values = np.zeros(capacity, dtype=np.float64)
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        self.tensors = []
+
+    def add(self, key, value, n):
+        if self.size == len(self.values):
+            self.values = np.resize(self.values, 2 * self.size)
+            self.counts = np.resize(self.counts, 2 * self.size)
+        if type(value) == torch.Tensor:
+            self.tensors.append((self.size, value.detach()))
+        else:
+            self.values[self.size] = value
+        self.counts[self.size] = n
+        self.keys.append(key)
+        self.size += 1
+
+    def resolve(self):
+        """Copies the pending tensors to the host with a single device sync."""
+        if self.tensors:
+            idxs, tensors = zip(*self.tensors)
+            self.values[list(idxs)] = torch.stack([t.float().reshape(()) for t in tensors]).cpu().numpy()
+            self.tensors.clear()
+
+    def clear(self):
+        self.step = None
+        self.size = 0
+        self.keys.clear()
+        self.tensors.clear()
+
 
 class Logger(object):
+    """Scalars are buffered per step (double-buffered StepBuffers) and handed to a background sink
+    thread, which writes them in one batch per step to metrics.jsonl, wandb (if a run is active) and
+    TensorBoard, and keeps the train/eval meters that are printed on dump."""
     def __init__(self, log_dir, use_tb=False, config='rl'):
         self._log_dir = log_dir
+        self._tb_dir = None
         if use_tb:
-            tb_dir = os.path.join(log_dir, 'tb')
-            if os.path.exists(tb_dir):
-                shutil.rmtree(tb_dir)
-            #self._sw = SummaryWriter(tb_dir)
-        else:
-            self._sw = None
+            self._tb_dir = os.path.join(log_dir, 'tb')
+            if os.path.exists(self._tb_dir):
+                shutil.rmtree(self._tb_dir)
+        # the SummaryWriter is created on first use
+        self._sw = None
+        self._sw_lock = threading.Lock()
         self._train_mg = MetersGroup(
             os.path.join(log_dir, 'train.log'),
             formating=FORMAT_CONFIG[config]['train']
@@ -110,10 +158,70 @@ class Logger(object):
             os.path.join(log_dir, 'eval.log'),
             formating=FORMAT_CONFIG[config]['eval']
         )
+        self._jsonl = open(os.path.join(log_dir, 'metrics.jsonl'), 'w')
 
-    def _try_sw_log(self, key, value, step):
-        if self._sw is not None:
-            self._sw.add_scalar(key, value, step)
+        self._buffer = StepBuffer()
+        self._free_buffers = queue.Queue()
+        self._free_buffers.put(StepBuffer())
+        self._sink_queue = queue.Queue()
+        self._sink = threading.Thread(target=self._run_sink, daemon=True)
+        self._sink.start()
+        self._closed = False
+        atexit.register(self.close)
+
+    def _writer(self):
+        if self._tb_dir is None:
+            return None
+        with self._sw_lock:
+            if self._sw is None:
+                from torch.utils.tensorboard import SummaryWriter
+                self._sw = SummaryWriter(self._tb_dir)
+        return self._sw
+
+    def _run_sink(self):
+        while True:
+            item = self._sink_queue.get()
+            if item is None:
+                break
+            if isinstance(item, StepBuffer):
+                self._write_step(item)
+                item.clear()
+                self._free_buffers.put(item)
+            else: # ('dump', step)
+                _, step = item
+                self._train_mg.dump(step, 'train')
+                self._eval_mg.dump(step, 'eval')
+
+    def _write_step(self, buffer):
+        buffer.resolve()
+        step = buffer.step
+        record = {}
+        sw = self._writer()
+        for i, key in enumerate(buffer.keys):
+            value, n = buffer.values[i].item(), buffer.counts[i].item()
+            record[key] = value
+            if sw is not None:
+                sw.add_scalar(key, value / n, step)
+            mg = self._train_mg if key.startswith('train') else self._eval_mg
+            mg.log(key, value, n)
+
+        self._jsonl.write(json.dumps(dict(step=step, **record)) + '\n')
+        self._jsonl.flush()
+        # wandb is never imported here: only a script that started a run has loaded it
+        wandb = sys.modules.get('wandb')
+        if wandb is not None and wandb.run is not None:
+            wandb.log(record, step=step)
+
+    def _seal(self):
+        """Hands the current step to the sink thread and continues on a free buffer."""
+        if self._buffer.size == 0:
+            return
+        self._sink_queue.put(self._buffer)
+        try:
+            self._buffer = self._free_buffers.get_nowait()
+        except queue.Empty:
+            # the sink fell behind, rather than waiting for it take another buffer
+            self._buffer = StepBuffer()
     '''
     def _try_sw_log_image(self, key, image, step):
         if self._sw is not None:
@@ -122,23 +230,23 @@ class Logger(object):
             self._sw.add_image(key, grid, step)
     '''
     def _try_sw_log_video(self, key, frames, step):
-        if self._sw is not None:
+        sw = self._writer()
+        if sw is not None:
             frames = torch.from_numpy(np.array(frames))
             frames = frames.unsqueeze(0)
-            self._sw.add_video(key, frames, step, fps=30)
+            sw.add_video(key, frames, step, fps=30)
 
     def _try_sw_log_histogram(self, key, histogram, step):
-        if self._sw is not None:
-            self._sw.add_histogram(key, histogram, step)
+        sw = self._writer()
+        if sw is not None:
+            sw.add_histogram(key, histogram, step)
 
     def log(self, key, value, step, n=1):
-        wandb.log({key: value}, step=step)
         assert key.startswith('train') or key.startswith('eval')
-        if type(value) == torch.Tensor:
-            value = value.item()
-        self._try_sw_log(key, value / n, step)
-        mg = self._train_mg if key.startswith('train') else self._eval_mg
-        mg.log(key, value, n)
+        if self._buffer.step != step:
+            self._seal()
+            self._buffer.step = step
+        self._buffer.add(key, value, n)
 
     def log_param(self, key, param, step):
         self.log_histogram(key + '_w', param.weight.data, step)
@@ -162,5 +270,19 @@ class Logger(object):
         self._try_sw_log_histogram(key, histogram, step)
 
     def dump(self, step):
-        self._train_mg.dump(step, 'train')
-        self._eval_mg.dump(step, 'eval')
\ No newline at end of file
+        self._seal()
+        self._sink_queue.put(('dump', step))
+
+    def close(self):
+        """Flushes everything that was logged and closes the sinks."""
+        if self._closed:
+            return
+        self._closed = True
+        self._seal()
+        self._sink_queue.put(None)
+        self._sink.join()
+        self._jsonl.close()
+        self._train_mg.close()
+        self._eval_mg.close()
+        if self._sw is not None:
+            self._sw.close()
@@ -0,0 +1,164 @@
+"""Step tracing for the remote-local control loop.
+
+Spans are timed with the monotonic clock (CLOCK_MONOTONIC on Linux, so timestamps from different
+processes are comparable) and written into a ring of fixed-size records in shared memory. Processes
+forked after init() inherit the tracer; spawned processes get it by pickling it into their Process
+arguments and calling set_tracer() on start. Tracing is off until init() is called, in which case
+span() is a no-op.
+
+    tracing.init()
+    with tracing.span('env_step'):
+        env.step(action)
+    tracing.get_tracer().export(out_dir) # trace_stages.json and trace.json (chrome://tracing)
+"""
+import json
+import os
+import time
+import multiprocessing as mp
+import numpy as np
+
+STAGES = (
+    'env_step',
+    'image_read',
+    'sample_action',
+    'push_sample',
+    'send',
+    'recv',
+    'policy_apply',
+    'replay_sample',
+    'update',
+    'publish_weights',
+)
+STAGE_IDS = {stage: i for i, stage in enumerate(STAGES)}
+
+# fields of a record: stage id, pid, start (ns), end (ns)
+RECORD_SIZE = 4
+
+if hasattr(time, 'monotonic_ns'):
+    now_ns = time.monotonic_ns
+else:
+    def now_ns():
+        return int(time.monotonic() * 1e9)
+
+
+class Tracer(object):
+    def __init__(self, capacity=1 << 16):
+        self._capacity = capacity
+        # from the spawn context, whose locks the spawned learner processes can also be handed
+        ctx = mp.get_context('spawn')
+        self._records = ctx.RawArray('q', RECORD_SIZE * capacity)
+        self._head = ctx.Value('Q', 0)
+
+    def record(self, stage, start, end):
+        record = (STAGE_IDS[stage], os.getpid(), start, end)
+        # written under the lock, so that snapshot() never sees a slot half written
+        with self._head.get_lock():
+            i = self._head.value
+            self._head.value = i + 1
+            i = RECORD_SIZE * (i % self._capacity)
+            self._records[i:i+RECORD_SIZE] = record
+
+    def snapshot(self):
+        """Returns a copy of the records in the ring, oldest first."""
+        with self._head.get_lock():
+            head = self._head.value
+            records = np.frombuffer(self._records, dtype=np.int64).reshape(self._capacity, RECORD_SIZE).copy()
+        if head <= self._capacity:
+            return records[:head]
+        return np.roll(records, -(head % self._capacity), axis=0)
+
+    def export(self, out_dir, bins_ms=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256)):
+        """Writes per-stage latency statistics and histograms (in ms) to trace_stages.json and all
+        spans in the chrome trace event format to trace.json."""
+        records = self.snapshot()
+        durations = (records[:, 3] - records[:, 2]) / 1e6
+
+        stages = {}
+        for stage, stage_id in STAGE_IDS.items():
+            d = durations[records[:, 0] == stage_id]
+            if len(d) == 0:
+                continue
+            counts, _ = np.histogram(d, bins=(0,) + tuple(bins_ms) + (np.inf,))
+            stages[stage] = {
+                'count': len(d),
+                'mean_ms': d.mean(),
+                'p50_ms': np.percentile(d, 50),
+                'p90_ms': np.percentile(d, 90),
+                'p99_ms': np.percentile(d, 99),
+                'max_ms': d.max(),
+                'bins_ms': list(bins_ms),
+                'histogram': counts.tolist(),
+            }
+        with open(os.path.join(out_dir, 'trace_stages.json'), 'w') as f:
+            json.dump(stages, f, indent=2, default=float)
+
+        events = [{
+                'name': STAGES[stage_id],
+                'ph': 'X',
+                'ts': start / 1e3,
+                'dur': (end - start) / 1e3,
+                'pid': pid,
+                'tid': pid,
+            } for stage_id, pid, start, end in records.tolist()]
+        with open(os.path.join(out_dir, 'trace.json'), 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+        return stages
+
+
+class Span(object):
+    __slots__ = ('_tracer', '_stage', '_start')
+
+    def __init__(self, tracer, stage):
+        self._tracer = tracer
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = now_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self._tracer.record(self._stage, self._start, now_ns())
+        return False
+
+
+class NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_span = NullSpan()
+_tracer = None
+
+
+def init(capacity=1 << 16):
+    """Turns tracing on in this process and in the processes it starts afterwards."""
+    global _tracer
+    _tracer = Tracer(capacity)
+    return _tracer
+
+
+def set_tracer(tracer):
+    global _tracer
+    _tracer = tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+def span(stage):
+    if _tracer is None:
+        return _null_span
+    return Span(_tracer, stage)
+
+
+def record(stage, start):
+    """Records a span that started at start (from now_ns()) and ends now."""
+    if _tracer is not None:
+        _tracer.record(stage, start, now_ns())
@@ -1,9 +1,9 @@
+import contextlib
 import torch
 import os
 import random
 
 import numpy as np
-import matplotlib.pyplot as plt
 
 def make_dir(dir_path):
     try:
@@ -56,6 +56,8 @@ def show_learning_curve(fname, rets, ep_lens, xtick, xlimit=None, ylimit=None, s
                 np.array(rets), np.array(ep_lens), x_tick=xtick, window_len=xtick)
         
         if len(plot_rets):
+            # imported on first use, the spawned processes import this module too
+            import matplotlib.pyplot as plt
             plt.clf()
             if xlimit is not None:
                 plt.xlim(xlimit)
@@ -74,6 +76,30 @@ def soft_update_params(net, target_net, tau):
             tau * param.data + (1 - tau) * target_param.data
         )
 
+def critic_loss(current_Q1, current_Q2, target_Q, weights=None):
+    """Squared TD errors of both Q heads averaged over the batch, weighted by the importance weights
+    of prioritized replay if any, and the absolute TD error of each row. The batch may stack
+    augmented copies of the sampled transitions, the weights are repeated over them."""
+    errors = (current_Q1 - target_Q) ** 2 + (current_Q2 - target_Q) ** 2
+    if weights is not None:
+        errors = weights.repeat(errors.shape[0] // weights.shape[0], 1) * errors
+    td_errors = 0.5 * ((current_Q1 - target_Q).abs() + (current_Q2 - target_Q).abs())
+    return torch.mean(errors), td_errors.detach()
+
+def autocast(device, amp='none'):
+    """Mixed-precision context for the learner forward passes.
+    Args:
+        device (torch.device): Device the models live on
+        amp (str): One of ['none', 'fp16', 'bf16'], 'none' disables autocast
+    """
+    if amp == 'none':
+        return contextlib.suppress()
+    if amp == 'fp16':
+        return torch.cuda.amp.autocast()
+    # torch.autocast, which also covers the CPU, came with torch 1.10
+    assert hasattr(torch, 'autocast'), "bf16 training needs torch >= 1.10, use fp16 on CUDA"
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+
 class eval_mode(object):
     def __init__(self, *models):
         self.models = models
@@ -102,15 +128,35 @@ def set_seed_everywhere(seed, env=None):
         env.seed(seed)
         env.action_space.seed(seed)
 
-def random_augment(images, rad_height, rad_width):
+def crop_images(images, rad_height, rad_width, random_crop=True):
+    """Crop a batch of images and scale it to [0, 1] in one pass.
+    The crop is an index into the (uint8) input, and the dtype cast, normalization and channels-last
+    layout are fused into a single write, so the cropped float tensor is the only one materialized.
+    Args:
+        images (torch.Tensor): (N, C, H, W) uint8 images, or float images in [0, 255]
+        rad_height (int): Crop offset along the height
+        rad_width (int): Crop offset along the width
+        random_crop (bool): Random offset per image (RAD), otherwise a center crop
+    Returns:
+        A float32 (N, C, H - 2*rad_height, W - 2*rad_width) tensor in channels-last memory format
+    """
     n, c, h, w = images.shape
     _h = h - 2 * rad_height
     _w = w - 2 * rad_width
-    w1 = torch.randint(0, rad_width + 1, (n,))
-    h1 = torch.randint(0, rad_height + 1, (n,))
-    cropped_images = torch.empty((n, c, _h, _w), device=images.device).float()
-    for i, (image, w11, h11) in enumerate(zip(images, w1, h1)):
-        cropped_images[i][:] = image[:, h11:h11 + _h, w11:w11 + _w]
-    return cropped_images
-
-    
\ No newline at end of file
+    if random_crop:
+        w1 = torch.randint(0, rad_width + 1, (n,)).to(images.device)
+        h1 = torch.randint(0, rad_height + 1, (n,)).to(images.device)
+        rows = h1[:, None] + torch.arange(_h, device=images.device)
+        cols = w1[:, None] + torch.arange(_w, device=images.device)
+        images = images[torch.arange(n, device=images.device)[:, None, None, None],
+                        torch.arange(c, device=images.device)[None, :, None, None],
+                        rows[:, None, :, None],
+                        cols[:, None, None, :]]
+    else:
+        images = images[:, :, rad_height:h-rad_height, rad_width:w-rad_width]
+
+    if images.requires_grad:
+        # masked (MaDi) or attributed (SGQN) images, out= ops cannot carry their gradient
+        return images.contiguous(memory_format=torch.channels_last).float() / 255.
+    cropped_images = torch.empty((n, c, _h, _w), device=images.device, memory_format=torch.channels_last)
+    return torch.div(images, 255., out=cropped_images)
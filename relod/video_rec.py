@@ -1,8 +1,7 @@
 import os
-import imageio
 import torch
-import torchvision
-import wandb
+
+# imageio, torchvision and wandb are imported where used, the recorders are optional
 
 
 class VideoRecorder(object):
@@ -39,6 +38,7 @@ class VideoRecorder(object):
             self.frames.append(frame)
 
     def save(self, file_name):
+        import imageio
         if self.enabled:
             path = os.path.join(self.dir_name, file_name)
             imageio.mimsave(path, self.frames, fps=self.fps)
@@ -47,6 +47,7 @@ class VideoRecorder(object):
 class MaskRecorder(object):
     """Class for the MaDi algorithm to record masks and masked observations."""
     def __init__(self, dir_name, args):
+        import torchvision
         self.dir_name = dir_name
         self.algorithm = args.algorithm
         self._args = args
@@ -68,6 +69,7 @@ class MaskRecorder(object):
             self.save_mask_per_frame(obs, agent, training_step, _test_env_name)
 
     def save_obs_per_frame(self, obs, training_step, _test_env_name):
+        import torchvision
         for frame in range(self.num_frames):
             if frame == 0 or self.save_all_frames:
                 torchvision.utils.save_image(
@@ -75,6 +77,7 @@ class MaskRecorder(object):
                     os.path.join(self.dir_name, f'step{training_step}{_test_env_name}_frame{frame}_obs.png'))
 
     def save_masked_obs_per_frame(self, obs, agent, training_step, _test_env_name):
+        import torchvision
         masked_obs = agent.performer.apply_mask(obs)
         for frame in range(self.num_frames):
             if frame == 0 or self.save_all_frames:
@@ -93,6 +96,7 @@ class MaskRecorder(object):
 
 
 def log_mask_stats(mask, training_step: int, _test_env: str = ''):
+    import wandb
     mask_log_data = {
         f'eval_soft_mask/avg{_test_env}': mask.mean(),
         f'eval_soft_mask/std{_test_env}': mask.std(),
@@ -113,6 +117,7 @@ class AugmentationRecorder(object):
         self.extra_record_steps = [10, 50, 100, 500, 2000, 5000]
 
     def record(self, obs, obs_augm, step: int, masked: bool = False, descr: str = ''):
+        import torchvision
         if step % self.save_every == 0 or step in self.extra_record_steps:
             aug_type = '_masked' if masked else ''
             for frame in range(self.num_frames):
@@ -0,0 +1,128 @@
+"""Startup warmup of the models.
+
+The first forward and backward passes on a GPU pay for loading the kernels, JIT compiling the ones
+not built for the device's architecture, picking the cuDNN algorithms and growing the caching
+allocator: on a Jetson the first action used to take about a minute. Performers and learners run a
+few passes on dummy inputs of the exact image_shape and batch_size when they are built instead, and
+the driver's JIT cache is kept in a persistent directory per model config, so the next run reuses
+the compiled kernels.
+"""
+import hashlib
+import json
+import os
+import time
+import torch
+import relod.utils as utils
+
+
+def config_key(args):
+    config = (torch.__version__, torch.version.cuda, tuple(args.image_shape), tuple(args.proprioception_shape),
+              tuple(args.action_shape), args.net_params, getattr(args, 'batch_size', None))
+    return hashlib.sha1(repr(config).encode()).hexdigest()[:16]
+
+
+def cache_dir(args):
+    if not getattr(args, 'kernel_cache_dir', ''):
+        return None
+    return os.path.join(os.path.expanduser(args.kernel_cache_dir), config_key(args))
+
+
+def init_kernel_cache(args):
+    """Points the CUDA driver's JIT cache at the directory of this model config. Has to run before
+    CUDA is initialized; the processes spawned later inherit it anyway."""
+    path = cache_dir(args)
+    if path is None:
+        return
+    os.makedirs(path, exist_ok=True)
+    if torch.cuda.is_available() and torch.cuda.is_initialized() and os.environ.get('CUDA_CACHE_PATH') != path:
+        print('CUDA is already initialized, the kernel cache {} only applies to the spawned processes'.format(path))
+    os.environ['CUDA_CACHE_PATH'] = path
+    os.environ.setdefault('CUDA_CACHE_MAXSIZE', str(1 << 30))
+    # load the kernels when first used instead of all at context creation (CUDA >= 11.7)
+    os.environ.setdefault('CUDA_MODULE_LOADING', 'LAZY')
+
+
+def _dummy_obs(args, n=None):
+    shape = lambda s: tuple(s) if n is None else (n, *s)
+    images, propris = None, None
+    if args.image_shape[-1] != 0:
+        images = torch.zeros(shape(args.image_shape), dtype=torch.uint8)
+    if args.proprioception_shape[-1] != 0:
+        propris = torch.zeros(shape(args.proprioception_shape), dtype=torch.float32)
+    return images, propris
+
+
+def _fork_rng(args):
+    # the passes draw crops and noise, the seeded streams are left as they were
+    devices = [args.device] if args.device.type == 'cuda' else []
+    return torch.random.fork_rng(devices=devices)
+
+
+def _synchronize(args):
+    if args.device.type == 'cuda':
+        torch.cuda.synchronize(args.device)
+
+
+def warmup_performer(performer, args, iterations=3):
+    images, propris = _dummy_obs(args)
+    ob = (None if images is None else images.numpy(), None if propris is None else propris.numpy())
+    tic = time.time()
+    with _fork_rng(args):
+        for _ in range(iterations):
+            performer.sample_action(ob)
+    _synchronize(args)
+    _report(args, 'performer', time.time() - tic)
+
+
+def warmup_learner(learner, args, iterations=2):
+    """Forward and backward passes of the actor, critic and masker on a batch_size batch. Leaves
+    the weights, optimizers and gradients as they were."""
+    images, propris = _dummy_obs(args, args.batch_size)
+    images = None if images is None else images.to(args.device)
+    propris = None if propris is None else propris.to(args.device)
+    actions = torch.zeros((args.batch_size, *args.action_shape), device=args.device)
+    modules = [learner._actor, learner._critic]
+    masker = getattr(learner, '_masker', None)
+    if masker is not None:
+        modules.append(masker)
+
+    tic = time.time()
+    with _fork_rng(args):
+        for _ in range(iterations):
+            with utils.autocast(args.device, args.amp):
+                q1, q2 = learner._critic(images, propris, actions)
+                _, pis, log_pis, _ = learner._actor(images, propris, detach_encoder=True)
+                outputs = [q1, q2, pis, log_pis]
+                if masker is not None:
+                    n, c, h, w = images.shape
+                    outputs.append(masker(images.reshape(n * 3, c // 3, h, w)))
+            sum(output.float().sum() for output in outputs).backward()
+    for module in modules:
+        module.zero_grad(set_to_none=True)
+    _synchronize(args)
+    _report(args, 'learner', time.time() - tic)
+
+
+def _report(args, name, seconds):
+    path = cache_dir(args)
+    if path is None:
+        print('Warmed up the {} in {:.3f}s'.format(name, seconds))
+        return
+
+    record = os.path.join(path, name + '.json')
+    try:
+        with open(record) as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = None
+
+    if previous is None:
+        print('Warmed up the {} in {:.3f}s, first run with kernel cache {}'.format(name, seconds, path))
+    else:
+        print('Warmed up the {} in {:.3f}s, first run took {:.3f}s'.format(name, seconds, previous['first_seconds']))
+    with open(record, 'w') as f:
+        json.dump({
+            'first_seconds': seconds if previous is None else previous['first_seconds'],
+            'last_seconds': seconds,
+            'runs': 1 if previous is None else previous['runs'] + 1,
+        }, f)
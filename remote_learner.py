@@ -5,6 +5,8 @@ from relod.algo.sac_rad_agent import SACRADLearner, SACRADPerformer
 from relod.logger import Logger
 import time
 import relod.utils as utils
+import relod.tracing as tracing
+import relod.affinity as affinity
 import os
 import cv2
 import numpy as np
@@ -16,6 +18,10 @@ def parse_args():
     parser.add_argument('--port', default=9876, type=int)
     # misc
     parser.add_argument('--device', default='cuda:0', type=str)
+    parser.add_argument('--placement', default='', type=str, help="Cores and threads of the learner processes, see relod/affinity.py")
+    parser.add_argument('--replay_storage', default='', type=str, help="Overrides the replay storage sent by the robot",
+                        choices=['', 'numpy', 'device', 'pinned'])
+    parser.add_argument('--update_workers', default=0, type=int, help="Overrides the number of update workers sent by the robot")
 
     args = parser.parse_args()
     return args
@@ -25,6 +31,16 @@ def main():
 
     agent = RemoteWrapper(port=server_args.port)
     args = agent.recv_data()
+    # the robot's placement is for its own cores
+    args.placement = server_args.placement
+    # as is the memory of the learner device
+    if server_args.replay_storage != '':
+        args.replay_storage = server_args.replay_storage
+    if server_args.update_workers > 0:
+        args.update_workers = server_args.update_workers
+    affinity.apply(args.placement, 'control')
+    if getattr(args, 'trace', False):
+        tracing.init()
 
     os.makedirs(args.model_dir, exist_ok=True)
     os.makedirs(args.return_dir, exist_ok=True)
@@ -58,9 +74,10 @@ def main():
     print(f'Experiment starts at: {start_time}')
 
     while not experiment_done:
-        agent.learner.pause_update()
+        # the robot resets meanwhile, the learner spends that time on extra updates
+        agent.learner.begin_reset()
         (image, propri) = agent.receive_init_ob()
-        agent.learner.resume_update()
+        agent.learner.end_reset()
         ret = 0
         epi_steps = 0
         sub_steps = 0
@@ -110,9 +127,9 @@ def main():
                 sub_epi += 1
                 ret += args.reset_penalty_steps * args.reward
                 print(f'Sub episode {sub_epi} done.')
-                agent.learner.pause_update()
+                agent.learner.begin_reset()
                 (image, propri) = agent.receive_init_ob()
-                agent.learner.resume_update()
+                agent.learner.end_reset()
             
             experiment_done = total_steps >= args.env_steps
         
@@ -130,6 +147,9 @@ def main():
             L.log('train/duration', time.time() - epi_start_time, total_steps)
             L.log('train/episode_reward', ret, total_steps)
             L.log('train/episode', len(returns), total_steps)
+            policy_lag = agent.policy_lag()
+            if policy_lag is not None:
+                L.log('train/policy_lag', policy_lag, total_steps)
             L.dump(total_steps)
             if args.plot_learning_curve:
                 utils.show_learning_curve(args.return_dir+'/learning curve.png', returns, epi_lens, xtick=args.xtick)
@@ -138,10 +158,14 @@ def main():
     agent.learner.pause_update()
     agent.save_policy_to_file(args.model_dir, total_steps)
 
+    affinity.report()
     agent.close()
+    L.close()
     
     # always show a learning curve at the end
     utils.show_learning_curve(args.return_dir+'/learning curve.png', returns, epi_lens, xtick=args.xtick)
+    if getattr(args, 'trace', False):
+        tracing.get_tracer().export(args.return_dir)
     print(f"Finished in {duration}s")
 
 if __name__ == '__main__':
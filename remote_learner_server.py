@@ -0,0 +1,55 @@
+import argparse
+from relod.algo.remote_server import RemoteServer
+from relod.algo.sac_rad_agent import SACRADLearner, SACRADPerformer
+from relod.algo.sac_drq_agent import SACDrQLearner, SACDrQPerformer
+from relod.algo.sac_svea_agent import SVEALearner, SVEAPerformer
+from relod.algo.sac_sgqn_agent import SGQNLearner, SGQNPerformer
+from relod.algo.sac_soda_agent import SODALearner, SODAPerformer
+from relod.algo.sac_madi_agent import MaDiLearner, MaDiPerformer
+
+ALGORITHMS = {
+    'rad': (SACRADPerformer, SACRADLearner),
+    'drq': (SACDrQPerformer, SACDrQLearner),
+    'svea': (SVEAPerformer, SVEALearner),
+    'sgqn': (SGQNPerformer, SGQNLearner),
+    'soda': (SODAPerformer, SODALearner),
+    'madi': (MaDiPerformer, MaDiLearner),
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    # server
+    parser.add_argument('--num_robots', default=2, type=int, help="Number of robots served before exiting")
+    parser.add_argument('--buffer_mode', default='shared', type=str, help="One learner for all robots or one per robot",
+                        choices=['shared', 'per_robot'])
+    parser.add_argument('--algorithm', default='rad', type=str, help="Algorithms in ['rad', 'drq', 'svea', 'sgqn', 'soda', 'madi']")
+    # agent
+    parser.add_argument('--port', default=9876, type=int)
+    # misc
+    parser.add_argument('--device', default='', type=str, help="Overrides the device sent by the robots")
+    parser.add_argument('--placement', default='', type=str, help="Cores and threads of the learner processes, see relod/affinity.py")
+    parser.add_argument('--replay_storage', default='', type=str, help="Overrides the replay storage sent by the robots",
+                        choices=['', 'numpy', 'device', 'pinned'])
+    parser.add_argument('--update_workers', default=0, type=int, help="Overrides the number of update workers sent by the robots")
+
+    args = parser.parse_args()
+    return args
+
+def main():
+    server_args = parse_args()
+
+    performer_class, learner_class = ALGORITHMS[server_args.algorithm]
+    server = RemoteServer(performer_class, learner_class,
+                          port=server_args.port,
+                          buffer_mode=server_args.buffer_mode,
+                          num_robots=server_args.num_robots,
+                          device=server_args.device,
+                          placement=server_args.placement,
+                          replay_storage=server_args.replay_storage,
+                          update_workers=server_args.update_workers)
+    server.serve()
+    print('All robots finished')
+
+if __name__ == '__main__':
+    main()
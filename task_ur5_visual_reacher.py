@@ -3,10 +3,11 @@ import argparse
 import time
 import cv2
 import os
-import wandb
 import multiprocessing
 import numpy as np
 import relod.utils as utils
+import relod.tracing as tracing
+import relod.affinity as affinity
 import matplotlib.pyplot as plt
 from relod.logger import Logger
 from relod.video_rec import MaskRecorder, AugmentationRecorder
@@ -80,6 +81,16 @@ def parse_args():
     parser.add_argument('--batch_size', default=128, type=int)
     parser.add_argument('--sync_mode', default=False, action='store_true')
     parser.add_argument('--max_updates_per_step', default=0.6, type=float)
+    parser.add_argument('--burst_updates_per_step', default=0, type=float, help="Replay ratio cap of the extra async updates while the env resets, 0 for none")
+    parser.add_argument('--per_alpha', default=0, type=float, help="Prioritized replay exponent of the TD errors, 0 samples uniformly")
+    parser.add_argument('--per_beta', default=0.4, type=float, help="Importance sampling exponent of prioritized replay")
+    parser.add_argument('--n_step', default=1, type=int, help="Length of the n-step returns sampled from the replay buffer")
+    parser.add_argument('--replay_storage', default='numpy', type=str, help="Where the replay buffer lives, on the learner device keeps it in the update process",
+                        choices=['numpy', 'device', 'pinned'])
+    parser.add_argument('--record_dataset', default='', type=str, help="Directory the samples are recorded to, see relod/algo/dataset.py")
+    parser.add_argument('--seed_dataset', default='', type=str, help="Directory of a recorded dataset the replay buffer starts with")
+    parser.add_argument('--update_workers', default=1, type=int, help="Async update processes splitting each minibatch, see relod/algo/data_parallel.py")
+    parser.add_argument('--publish_every', default=1, type=int, help="Async updates between the weights published to the performer, see relod/algo/weights.py")
     parser.add_argument('--update_every', default=50, type=int)
     parser.add_argument('--update_epochs', default=50, type=int)
     # critic
@@ -117,6 +128,15 @@ def parse_args():
     # agent
     parser.add_argument('--remote_ip', default='localhost', type=str)
     parser.add_argument('--port', default=9876, type=int)
+    parser.add_argument('--uplink_codec', default='raw', type=str, help="Codec of the image frames sent to the remote in ['raw', 'png', 'jpeg', 'lz4']")
+    parser.add_argument('--jpeg_quality', default=90, type=int)
+    parser.add_argument('--uplink_batch', default=1, type=int, help="Transitions sent per message in remote-local mode")
+    parser.add_argument('--spill_dir', default='', type=str, help="Directory of the uplink spill file, '' for the system temp directory")
+    parser.add_argument('--spill_max_mb', default=1024, type=float, help="Samples spilled to disk while the uplink stalls, 0 blocks instead")
+    parser.add_argument('--reconnect_timeout', default=300, type=float, help="Seconds to try reconnecting to the remote after the connection drops")
+    parser.add_argument('--kernel_cache_dir', default='~/.cache/relod/kernels', type=str, help="Persistent CUDA kernel cache, one directory per model config, '' to disable")
+    parser.add_argument('--no_warmup', dest='warmup', default=True, action='store_false', help="Skip the warmup passes of the models at startup")
+    parser.add_argument('--placement', default='', type=str, help="Cores and threads per role, e.g. 'sensor=0;control=1;buffer=2;update=3-5@3', 'auto', or '' for none (see relod/affinity.py)")
     parser.add_argument('--mode', default='l', type=str, help="Modes in ['r', 'l', 'rl', 'e'] ")
     # misc
     parser.add_argument('--run_type', default='experiment', type=str)
@@ -132,6 +152,8 @@ def parse_args():
     parser.add_argument('--save_model_freq', default=10000, type=int)
     parser.add_argument('--load_model', default=-1, type=int)
     parser.add_argument('--device', default='cuda:0', type=str)
+    parser.add_argument('--amp', default='none', type=str, help="Mixed-precision training in ['none', 'fp16', 'bf16']. fp16 needs CUDA", choices=['none', 'fp16', 'bf16'])
+    parser.add_argument('--trace', default=False, action='store_true', help="Record step timing spans, exported to trace_stages.json and trace.json")
     parser.add_argument('--lock', default=False, action='store_true')
     parser.add_argument('--wandb_mode', default='online', type=str, help="Either online, offline, or disabled")
 
@@ -141,17 +163,14 @@ def parse_args():
     args.async_mode = not args.sync_mode
     return args
 
-def set_one_thread():
-  '''
-  N.B: Pytorch over-allocates resources and hogs CPU, which makes experiments very slow!
-  Set number of threads for pytorch to 1 to avoid this issue. This is a temporary workaround.
-  '''
-  os.environ['OMP_NUM_THREADS'] = '1'
-  os.environ['MKL_NUM_THREADS'] = '1'
-  torch.set_num_threads(1)
-
 def main():
     args = parse_args()
+    if args.trace:
+        # before the env and agent are created, so that their processes inherit the tracer
+        tracing.init()
+
+    # before the env and agent start their processes, which inherit it until they place themselves
+    affinity.apply(args.placement, 'control')
 
     if args.mode == 'r':
         mode = MODE.REMOTE_ONLY
@@ -199,6 +218,7 @@ def main():
         background_color = args.background_color,
         sparse_reward=args.use_sparse_reward,
     )
+    affinity.apply_children(args.placement, 'sensor')
 
     utils.set_seed_everywhere(args.seed, None)
 
@@ -226,7 +246,10 @@ def main():
     args.net_params = config
 
     episode_length_step = int(args.episode_length_time / args.dt)
-    agent = LocalWrapper(episode_length_step, mode, remote_ip=args.remote_ip, port=args.port)
+    agent = LocalWrapper(episode_length_step, mode, remote_ip=args.remote_ip, port=args.port,
+                         uplink_codec=args.uplink_codec, jpeg_quality=args.jpeg_quality, uplink_batch=args.uplink_batch,
+                         spill_dir=args.spill_dir, spill_max_mb=args.spill_max_mb,
+                         reconnect_timeout=args.reconnect_timeout, placement=args.placement)
     agent.send_data(args)
     print(f"Algorithm: {args.algorithm}")
     mask_rec = None
@@ -270,7 +293,8 @@ def main():
     else:
         raise NotImplementedError()
 
-    # start a new wandb run to track this script
+    # start a new wandb run to track this script, imported here so the spawned processes skip it
+    import wandb
     wandb.init(
         project="madi",
         config=vars(args),
@@ -290,13 +314,6 @@ def main():
 
     if args.load_model > -1:
         agent.load_policy_from_file(args.model_dir, args.load_model)
-    
-    # First inference took a while (~1 min), do it before the agent-env interaction loop
-    if mode != MODE.REMOTE_ONLY:
-        agent.performer.sample_action((image, prop))
-        agent.performer.sample_action((image, prop))
-        agent.performer.sample_action((image, prop))
-
 
     # Experiment block starts
     experiment_done = False
@@ -379,7 +396,8 @@ def main():
             action = agent.sample_action((image, prop))
 
             # step in the environment
-            next_image, next_prop, reward, epi_done, _ = env.step(action)
+            with tracing.span('env_step'):
+                next_image, next_prop, reward, epi_done, _ = env.step(action)
 
             # store
             agent.push_sample((image, prop), action, reward, (next_image, next_prop), epi_done)
@@ -409,6 +427,7 @@ def main():
                 total_steps += args.reset_penalty_steps
                 print(f'Sub episode {sub_epi} done.')
 
+                agent.begin_reset()
                 image, prop = env.reset()
                 agent.send_init_ob((image, prop))
                 sub_epi += 1
@@ -455,12 +474,16 @@ def main():
     np.savetxt(args.return_dir+"/train_rewards.txt", train_rewards)
 
     env.reset()
+    affinity.report()
     agent.close()
     env.close()
 
     # always show a learning curve at the end
     if mode == MODE.LOCAL_ONLY:
+        L.close()
         utils.show_learning_curve(args.return_dir+'/learning curve.png', returns, epi_lens, xtick=args.xtick)
+    if args.trace:
+        tracing.get_tracer().export(args.return_dir)
     print(f"Finished in {duration}s")
 
 
@@ -509,5 +532,4 @@ def eval(total_steps, args, agent, env, mask_rec, L):
 
 
 if __name__ == '__main__':
-    # set_one_thread()
     main()
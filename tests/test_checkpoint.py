@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import torch
+
+from relod.algo import checkpoint
+from relod.algo.sac_rad_buffer import RadReplayBuffer
+
+
+def make_buffer(capacity=8):
+    return RadReplayBuffer((3, 2, 2), (2,), (1,), capacity, batch_size=4)
+
+
+def add_rows(buffer, first, last):
+    """Row i holds i in every field, so that restored rows can be told apart."""
+    for i in range(first, last):
+        buffer.add(np.full((3, 2, 2), i, np.uint8), np.full(2, i, np.float32), np.full(1, i, np.float32), float(i),
+                   np.full((3, 2, 2), i, np.uint8), np.full(2, i, np.float32), 0.0)
+
+
+def rows(buffer):
+    """The actions of the rows in the buffer, oldest first."""
+    order = (buffer.idx + np.arange(buffer.count)) % buffer.capacity if buffer.full else np.arange(buffer.count)
+    return buffer.actions[order, 0].tolist()
+
+
+def test_capture_restore_round_trip():
+    model = torch.nn.Linear(3, 2)
+    optimizer = torch.optim.Adam(model.parameters())
+    model(torch.ones(1, 3)).sum().backward()
+    optimizer.step()
+    log_alpha = torch.zeros(()).share_memory_()
+    objects = {'model': model, 'optimizer': optimizer, 'log_alpha': log_alpha, 'scheduler': None}
+
+    state = checkpoint.capture(objects, num_updates=7, step=11)
+    weight = model.weight.detach().clone()
+    exp_avg = optimizer.state[model.weight]['exp_avg'].clone()
+    with torch.no_grad():
+        model.weight.add_(1)
+        log_alpha.fill_(3)
+    optimizer.step()
+
+    checkpoint.restore(objects, state)
+    assert torch.equal(model.weight, weight)
+    assert torch.equal(optimizer.state[model.weight]['exp_avg'], exp_avg)
+    assert float(log_alpha) == 0 and log_alpha.is_shared()
+    assert state['num_updates'] == 7 and state['step'] == 11
+
+
+def test_save_load_and_latest(tmp_path):
+    model_dir = str(tmp_path)
+    assert checkpoint.latest(model_dir) is None
+    assert checkpoint.load(model_dir, 5) is None
+
+    checkpoint.save(model_dir, 5, {'num_updates': 1}, {'first': 0, 'last': 0, 'chunks': [], 'obsolete': []})
+    assert checkpoint.latest(model_dir) == 5
+    learner_state, manifest = checkpoint.load(model_dir, 5)
+    assert learner_state == {'num_updates': 1}
+    assert manifest['last'] == 0
+
+
+def test_save_twice_at_the_same_step(tmp_path):
+    model_dir = str(tmp_path)
+    checkpoint.save(model_dir, 5, {'num_updates': 1})
+    checkpoint.save(model_dir, 5, {'num_updates': 2})
+    assert checkpoint.load(model_dir, 5)[0] == {'num_updates': 2}
+    assert not os.path.exists(checkpoint.checkpoint_dir(model_dir, 5) + '.old')
+
+
+def test_load_falls_back_to_the_checkpoint_being_replaced(tmp_path):
+    model_dir = str(tmp_path)
+    checkpoint.save(model_dir, 5, {'num_updates': 1})
+    # stopped after moving the old checkpoint aside, before the new one is in place
+    path = checkpoint.checkpoint_dir(model_dir, 5)
+    os.rename(path, path + '.old')
+    assert checkpoint.load(model_dir, 5)[0] == {'num_updates': 1}
+
+
+def test_buffer_snapshot_restore(tmp_path):
+    directory = str(tmp_path)
+    buffer = make_buffer()
+    add_rows(buffer, 0, 5)
+    buffer.snapshot(directory, chunk_rows=2)
+    # wraps around, the rows 0-3 are overwritten and the next snapshot drops their chunks
+    add_rows(buffer, 5, 12)
+    manifest = buffer.snapshot(directory, chunk_rows=2)
+    assert manifest['obsolete']
+    for name in manifest['obsolete']:
+        os.remove(os.path.join(directory, name))
+
+    restored = make_buffer()
+    restored.restore(directory, manifest)
+    assert rows(restored) == rows(buffer) == [float(i) for i in range(4, 12)]
+    assert restored.count == buffer.capacity and restored.full
+    assert restored.images[restored.idx - 1, 0, 0, 0] == 11
+
+    # the restored buffer carries on from its rows
+    add_rows(restored, 12, 14)
+    assert rows(restored) == [float(i) for i in range(6, 14)]
@@ -0,0 +1,73 @@
+import pickle
+
+import numpy as np
+import pytest
+
+pytest.importorskip('cv2')
+from relod.algo.codec import Frame, FrameDecoder, FrameEncoder, lz4_frame  # noqa: E402
+
+
+def episode(steps, frames=3, channels=3, h=6, w=8, seed=0):
+    """Observations of stacked frames, each stack the previous one shifted by the newest frame."""
+    rng = np.random.RandomState(seed)
+    new = [rng.randint(0, 256, (channels, h, w)).astype(np.uint8) for _ in range(steps + frames - 1)]
+    return [(np.concatenate(new[t:t+frames]), np.full(2, t, np.float32)) for t in range(steps)]
+
+
+def round_trip(encoder, decoder, obs):
+    # pickled as on the uplink
+    return [decoder.decode(pickle.loads(pickle.dumps(encoder.encode(ob)))) for ob in obs]
+
+
+@pytest.mark.parametrize('codec', ['raw', 'png', 'lz4'])
+def test_lossless_round_trip(codec):
+    if codec == 'lz4' and lz4_frame is None:
+        pytest.skip('no lz4')
+    encoder, decoder = FrameEncoder(codec), FrameDecoder()
+    obs = episode(5) + episode(4, seed=1)
+    for ob, decoded in zip(obs, round_trip(encoder, decoder, obs)):
+        assert np.array_equal(decoded[0], ob[0])
+        assert np.array_equal(decoded[1], ob[1])
+    # a key frame at the start of each episode, the newest frame only otherwise
+    assert encoder.key_frames == 2
+    assert encoder.raw_bytes == (3 + 4 + 3 + 3) * 3 * 6 * 8
+
+
+def test_only_the_newest_frame_is_sent():
+    encoder = FrameEncoder('raw')
+    first, second = episode(2)
+    key = encoder.encode(first)[0]
+    partial = encoder.encode(second)[0]
+    assert isinstance(partial, Frame) and key.key and not partial.key
+    assert len(key.data) == 3 and len(partial.data) == 1
+    assert len(partial) == 3 * 6 * 8
+
+
+def test_forced_key_frame_and_single_channel_frames():
+    encoder, decoder = FrameEncoder('png', channels=1), FrameDecoder()
+    obs = episode(3, frames=4, channels=1)
+    decoded = [decoder.decode(encoder.encode(ob, key=(t == 2))) for t, ob in enumerate(obs)]
+    assert all(np.array_equal(d[0], ob[0]) for d, ob in zip(decoded, obs))
+    assert encoder.key_frames == 2
+
+
+def test_jpeg_round_trip_is_close():
+    encoder, decoder = FrameEncoder('jpeg', jpeg_quality=95), FrameDecoder()
+    smooth = np.tile(np.linspace(0, 255, 8, dtype=np.uint8), (9, 6, 1))
+    decoded = decoder.decode(encoder.encode((smooth, None)))
+    assert decoded[0].shape == smooth.shape
+    assert np.abs(decoded[0].astype(int) - smooth).mean() < 8
+
+
+def test_observations_without_images_pass_through():
+    encoder, decoder = FrameEncoder('raw'), FrameDecoder()
+    for ob in [(None, np.zeros(3)), np.zeros(3), (np.zeros((3, 4, 4), np.float32), None)]:
+        assert decoder.decode(encoder.encode(ob)) is ob
+
+
+def test_partial_frame_before_a_key_frame():
+    encoder = FrameEncoder('raw')
+    first, second = episode(2)
+    encoder.encode(first)
+    with pytest.raises(AssertionError):
+        FrameDecoder().decode(encoder.encode(second))
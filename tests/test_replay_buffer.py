@@ -0,0 +1,160 @@
+import numpy as np
+import pytest
+
+from relod.algo.sac_rad_buffer import RadReplayBuffer, SumTree
+
+
+def make_buffer(capacity=8, batch_size=4, **kwargs):
+    return RadReplayBuffer((0, 0, 0), (2,), (1,), capacity, batch_size, **kwargs)
+
+
+def add_rows(buffer, first, last, done_rows=()):
+    """Row i has the reward i and the action i, so that sampled rows can be told apart."""
+    for i in range(first, last):
+        buffer.add(None, np.full(2, i, np.float32), np.full(1, i, np.float32), float(i), None,
+                   np.full(2, i + 0.5, np.float32), float(i in done_rows))
+
+
+@pytest.mark.parametrize('capacity', [1, 5, 8, 13])
+def test_sum_tree_update_and_find(capacity):
+    tree = SumTree(capacity)
+    values = np.arange(1, capacity + 1, dtype=np.float64)
+    tree.update(np.arange(capacity), values)
+    assert tree.total == values.sum()
+    assert np.array_equal(tree[np.arange(capacity)], values)
+
+    # every leaf owns [prefix, prefix + value), the padding leaves past capacity own nothing
+    prefixes = np.concatenate([[0], np.cumsum(values)[:-1]])
+    assert np.array_equal(tree.find(prefixes), np.arange(capacity))
+    assert np.array_equal(tree.find(prefixes + values - 1e-9), np.arange(capacity))
+
+    tree.update([capacity - 1], 0.0)
+    assert tree.total == values[:-1].sum()
+    if capacity > 1:
+        assert tree.find([tree.total - 1e-9])[0] == capacity - 2
+
+
+def test_sum_tree_update_of_repeated_leaves():
+    tree = SumTree(6)
+    tree.update([2, 2, 3], [1.0, 1.0, 2.0])
+    assert tree.total == 3.0
+    tree.clear()
+    assert tree.total == 0.0
+
+
+def test_sum_tree_skips_leaves_of_zero_priority():
+    tree = SumTree(3)
+    tree.update([0, 1, 2], [0.0, 1.0, 0.0])
+    assert tree.find([0.0, 0.5, 1.0 - 1e-9]).tolist() == [1, 1, 1]
+
+
+def test_prioritized_sampling_is_stratified():
+    buffer = make_buffer(capacity=8, batch_size=8, priority_alpha=1.0)
+    add_rows(buffer, 0, 8)
+    # equal priorities: one row per stratum, each row once
+    _, _, actions, _, _, _, _, info = buffer.sample()
+    assert sorted(actions[:, 0].tolist()) == list(range(8))
+    assert np.allclose(info['weights'], 1.0)
+
+
+def test_prioritized_sampling_follows_the_priorities():
+    np.random.seed(0)
+    buffer = make_buffer(capacity=4, batch_size=4, priority_alpha=1.0, priority_beta=1.0, priority_eps=0.0)
+    add_rows(buffer, 0, 4)
+    info = {'idxs': np.arange(4), 'num_added': buffer.num_added, 'flushes': buffer.flushes}
+    buffer.update_priorities(info, np.array([1.0, 1.0, 1.0, 5.0]))
+
+    counts = np.zeros(4)
+    for _ in range(500):
+        *_, info = buffer.sample()
+        counts += np.bincount(info['idxs'], minlength=4)
+    assert np.allclose(counts / counts.sum(), [0.125, 0.125, 0.125, 0.625], atol=0.02)
+    # (N * P)^-beta over its max: the row of priority 5 is five times less weighted
+    weights = dict(zip(info['idxs'].tolist(), info['weights'][:, 0].tolist()))
+    assert weights[3] == pytest.approx(0.2)
+
+
+def test_priorities_of_overwritten_rows_are_kept():
+    buffer = make_buffer(capacity=4, batch_size=4, priority_alpha=1.0, priority_eps=0.0)
+    add_rows(buffer, 0, 4)
+    *_, info = buffer.sample()
+    # rows 0 and 1 are overwritten by new samples before the TD errors come back
+    add_rows(buffer, 4, 6)
+    buffer.update_priorities(info, np.full(len(info['idxs']), 0.5))
+    priorities = buffer._priorities[np.arange(4)]
+    assert priorities.tolist() == [1.0, 1.0, 0.5, 0.5]
+
+    # after a wrap-around every sampled row is overwritten
+    *_, info = buffer.sample()
+    add_rows(buffer, 6, 10)
+    buffer.update_priorities(info, np.full(len(info['idxs']), 0.25))
+    assert buffer._priorities[np.arange(4)].tolist() == [1.0, 1.0, 1.0, 1.0]
+
+
+def test_priorities_sampled_before_a_flush_are_dropped():
+    buffer = make_buffer(capacity=4, batch_size=4, priority_alpha=1.0)
+    add_rows(buffer, 0, 4)
+    *_, info = buffer.sample()
+    buffer.flush()
+    add_rows(buffer, 0, 4)
+    buffer.update_priorities(info, np.full(len(info['idxs']), 0.5))
+    assert buffer._priorities[np.arange(4)].tolist() == [1.0, 1.0, 1.0, 1.0]
+
+
+def test_prioritized_sampling_of_a_partial_buffer():
+    np.random.seed(1)
+    buffer = make_buffer(capacity=8, batch_size=8, priority_alpha=0.6)
+    add_rows(buffer, 0, 3)
+    for _ in range(50):
+        *_, info = buffer.sample()
+        # the empty rows have no priority and are never drawn
+        assert len(info['idxs']) == 3 and info['idxs'].max() < 3
+
+
+def n_step_returns(buffer):
+    """{row: (reward, discount, next proprioception, done)} of every row in the buffer."""
+    np.random.seed(2)
+    returns = {}
+    for _ in range(200):
+        _, _, actions, rewards, _, next_propris, dones, info = buffer.sample()
+        for i, row in enumerate(actions[:, 0].astype(int).tolist()):
+            returns[row] = (float(rewards[i, 0]), float(info['discounts'][i, 0]), float(next_propris[i, 0]),
+                            float(dones[i, 0]))
+    assert len(returns) == buffer.count
+    return returns
+
+
+def test_n_step_returns():
+    buffer = make_buffer(capacity=8, batch_size=8, n_step=3, discount=0.5)
+    add_rows(buffer, 0, 6)
+    returns = n_step_returns(buffer)
+    assert returns[0] == (0 + 0.5 * 1 + 0.25 * 2, 0.125, 2.5, 0.0)
+    assert returns[2] == (2 + 0.5 * 3 + 0.25 * 4, 0.125, 4.5, 0.0)
+    # the newest rows sum what is stored
+    assert returns[4] == (4 + 0.5 * 5, 0.25, 5.5, 0.0)
+    assert returns[5] == (5.0, 0.5, 5.5, 0.0)
+
+
+def test_n_step_returns_stop_at_episode_ends():
+    buffer = make_buffer(capacity=8, batch_size=8, n_step=3, discount=0.5)
+    add_rows(buffer, 0, 3, done_rows=(2,))
+    add_rows(buffer, 3, 5)
+    buffer.mark_episode_end()   # a timeout after row 4
+    add_rows(buffer, 5, 8)
+    returns = n_step_returns(buffer)
+    # the done row is summed, and bootstraps from its own next observation and done
+    assert returns[1] == (1 + 0.5 * 2, 0.25, 2.5, 1.0)
+    assert returns[2] == (2.0, 0.5, 2.5, 1.0)
+    # a timeout stops the sum without a done
+    assert returns[3] == (3 + 0.5 * 4, 0.25, 4.5, 0.0)
+    assert returns[4] == (4.0, 0.5, 4.5, 0.0)
+    assert returns[5] == (5 + 0.5 * 6 + 0.25 * 7, 0.125, 7.5, 0.0)
+
+
+def test_n_step_returns_across_the_wrap_around():
+    buffer = make_buffer(capacity=4, batch_size=4, n_step=3, discount=0.5)
+    add_rows(buffer, 0, 7)  # rows 3-6, row 3 sits at the last position
+    returns = n_step_returns(buffer)
+    assert returns[3] == (3 + 0.5 * 4 + 0.25 * 5, 0.125, 5.5, 0.0)
+    assert returns[5] == (5 + 0.5 * 6, 0.25, 6.5, 0.0)
+    assert returns[6] == (6.0, 0.5, 6.5, 0.0)
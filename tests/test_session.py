@@ -0,0 +1,39 @@
+from relod.algo.comm import CHANNEL, Session, encode_frame
+
+
+def send(session, channel, msg):
+    seq = session.next_seq()
+    session.sent(seq, encode_frame(channel, msg, seq))
+    return seq
+
+
+def unacked_seqs(session):
+    return [seq for seq, _ in session.unacked]
+
+
+def test_only_the_newest_unacked_policy_is_kept():
+    session = Session('a')
+    send(session, CHANNEL.POLICY, 'p1')
+    send(session, CHANNEL.DATA, 'd2')
+    send(session, CHANNEL.POLICY, 'p3')
+    send(session, CHANNEL.CMD, 'c4')
+    send(session, CHANNEL.POLICY, 'p5')
+    assert unacked_seqs(session) == [2, 4, 5]
+    assert session.superseded_policies == 2
+
+
+def test_acked_policy_is_not_dropped_twice():
+    session = Session('a')
+    send(session, CHANNEL.POLICY, 'p1')
+    send(session, CHANNEL.DATA, 'd2')
+    session.acked(2)
+    send(session, CHANNEL.POLICY, 'p3')
+    assert unacked_seqs(session) == [3]
+    assert session.superseded_policies == 0
+
+
+def test_receiver_skips_the_gaps_of_dropped_policies():
+    receiver = Session('a')
+    assert receiver.received(2)
+    assert receiver.received(5)
+    assert not receiver.received(4)
@@ -3,10 +3,10 @@ import argparse
 import time
 import cv2
 import os
-import wandb
 import multiprocessing
 import numpy as np
 import relod.utils as utils
+import relod.affinity as affinity
 import matplotlib.pyplot as plt
 from relod.logger import Logger
 from relod.video_rec import MaskRecorder, AugmentationRecorder
@@ -123,6 +123,7 @@ def parse_args():
     parser.add_argument('--device', default='cuda:0', type=str)
     parser.add_argument('--lock', default=False, action='store_true')
     parser.add_argument('--wandb_mode', default='online', type=str, help="Either online, offline, or disabled")
+    parser.add_argument('--placement', default='', type=str, help="Cores and threads per role, e.g. 'sensor=0;control=1;buffer=2;update=3-5@3', 'auto', or '' for none (see relod/affinity.py)")
 
     args = parser.parse_args()
     assert args.mode in ['r', 'l', 'rl', 'e']
@@ -130,18 +131,12 @@ def parse_args():
     args.async_mode = not args.sync_mode
     return args
 
-def set_one_thread():
-  '''
-  N.B: Pytorch over-allocates resources and hogs CPU, which makes experiments very slow!
-  Set number of threads for pytorch to 1 to avoid this issue. This is a temporary workaround.
-  '''
-  os.environ['OMP_NUM_THREADS'] = '1'
-  os.environ['MKL_NUM_THREADS'] = '1'
-  torch.set_num_threads(1)
-
 def main():
     args = parse_args()
 
+    # before the env and agent start their processes, which inherit it until they place themselves
+    affinity.apply(args.placement, 'control')
+
     if args.mode == 'r':
         mode = MODE.REMOTE_ONLY
     elif args.mode == 'l':
@@ -187,6 +182,7 @@ def main():
         reward_tol = args.reward_tol,
         background_color = args.background_color,
     )
+    affinity.apply_children(args.placement, 'sensor')
 
     utils.set_seed_everywhere(args.seed, None)
 
@@ -204,7 +200,8 @@ def main():
     args.env_action_space = env.action_space
     args.net_params = config
 
-    # start a new wandb run to track this script
+    # start a new wandb run to track this script, imported here so the spawned processes skip it
+    import wandb
     wandb.init(
         project="madi",
         config=vars(args),
@@ -214,7 +211,7 @@ def main():
     )
 
     episode_length_step = int(args.episode_length_time / args.dt)
-    agent = LocalWrapper(episode_length_step, mode, remote_ip=args.remote_ip, port=args.port)
+    agent = LocalWrapper(episode_length_step, mode, remote_ip=args.remote_ip, port=args.port, placement=args.placement)
     agent.send_data(args)
     print(f"Algorithm: {args.algorithm}")
     mask_rec = None
@@ -432,11 +429,13 @@ def main():
     np.savetxt(args.return_dir+"/train_rewards.txt", train_rewards)
 
     env.reset()
+    affinity.report()
     agent.close()
     env.close()
 
     # always show a learning curve at the end
     if mode == MODE.LOCAL_ONLY:
+        L.close()
         utils.show_learning_curve(args.return_dir+'/learning curve.png', returns, epi_lens, xtick=args.xtick)
     print(f"Finished in {duration}s")
 
@@ -486,5 +485,4 @@ def eval(total_steps, args, agent, env, mask_rec, L):
 
 
 if __name__ == '__main__':
-    # set_one_thread()
     main()